@@ -112,7 +112,10 @@ def cli():
 @click.option('--blocks_stored', default=0, show_default=True, type=int, help='# of blocks stored during previous runs.')
 @click.option('--blocks_skipped', default=0, show_default=True, type=int, help='# of blocks skipped on previour runs.')
 @click.option('--api_conflicts', default=0, show_default=True, type=int, help='# of api_conflics found during previous runs.')
-def gather_scraper_data(start_height, stop_height, start_hash, blocks_stored, blocks_skipped, api_conflicts):
+@click.option('--force_merge', is_flag=True, help='Force merge the written indices after the run.')
+@click.option('--async_storage', is_flag=True, help='Store gathered blocks in the background while gathering the next blocks.')
+@click.option('--spool', is_flag=True, help='Write gathered blocks to the on-disk spool first, they are stored by a background drainer.')
+def gather_scraper_data(start_height, stop_height, start_hash, blocks_stored, blocks_skipped, api_conflicts, force_merge, async_storage, spool):
     """
     Gathers block data from implemented scrapers and store it in elasticsearch. 
     If using parameters; make sure start_hash and start_height are from the 
@@ -137,7 +140,10 @@ def gather_scraper_data(start_height, stop_height, start_hash, blocks_stored, bl
                                               stop_height=stop_height,
                                               blocks_stored=blocks_stored,
                                               blocks_skipped=blocks_skipped,
-                                              api_conflicts=api_conflicts)
+                                              api_conflicts=api_conflicts,
+                                              force_merge=force_merge,
+                                              async_storage=async_storage,
+                                              spool=spool)
     except Exception as ex:
         logger.exception("An exception occured during runtime: {}".format(str(ex)))
         print("An error occured:")
@@ -207,9 +213,10 @@ def delete_doc_by_id(index, doc_id):
 
 @cli.command()
 @click.option('--index', default=None, help='Name of index from which to remove the duplicates.')
-def remove_duplicates(index):
+@click.option('--field', default='block_height', show_default=True, type=click.Choice(['block_height', 'block_hash']), help='Field that identifies duplicate documents.')
+def remove_duplicates(index, field):
     '''
-    Removes duplicates from the index based on the block_height
+    Removes duplicates from the index based on the block_height (or block_hash)
     of the stored documents. Keeps one record stored.
     '''
     BMPI = BMPIFunctions(config=config, logger=logger)
@@ -217,7 +224,7 @@ def remove_duplicates(index):
     
     try:
         print("Deleting duplicates from the index: {}".format(index))
-        BMPI.remove_duplicates(index)
+        BMPI.remove_duplicates(index, field)
         print("Done.")
         
     except Exception as ex:
@@ -250,7 +257,8 @@ def store_block(block_height, block_hash):
 @click.option('--start_height', default=0, show_default=True, type=int, help='Starting height of the blocks that needs to be deleted.')
 @click.option('--end_height', default=0, show_default=True, type=int, help='End height of the last block that needs to be deleted.')
 @click.option('--should_delete', is_flag=True)
-def delete_stored_blocks_between_heights(start_height, end_height, should_delete):
+@click.option('--requests_per_second', default=None, type=float, help='Throttles the deletion, unthrottled by default.')
+def delete_stored_blocks_between_heights(start_height, end_height, should_delete, requests_per_second):
     '''
     Deletes stored blocks from index "blocks_from_scrapers" between the specified heights. 
     The parameter start_height should be smaller then end_height.
@@ -261,7 +269,8 @@ def delete_stored_blocks_between_heights(start_height, end_height, should_delete
         assert(start_height<=end_height)
         index = "blocks_from_scrapers"
         print("Deleting stored blocks between heights {} and {}".format(start_height, end_height))
-        BMPI.deleteStoredBlocksFromElasticsearch(index=index, start_height=start_height, end_height=end_height, should_delete=should_delete)
+        BMPI.deleteStoredBlocksFromElasticsearch(index=index, start_height=start_height, end_height=end_height,
+                                                 should_delete=should_delete, requests_per_second=requests_per_second)
         print("Done.")
         
     except Exception as ex:
@@ -287,15 +296,16 @@ def print_scrapers():
 
 
 @cli.command()
+@click.option('--requests_per_second', default=None, type=float, help='Throttles the reindex, unthrottled by default.')
 @click.confirmation_option(prompt='Are you sure you want to reindex the data to a new index?')
-def reindex_blocks():
+def reindex_blocks(requests_per_second):
     '''
     Moving block data to new block index.
     '''
     BMPI = BMPIFunctions(config=config, logger=logger)
     try:
         print("Moving block data to updated index.")
-        BMPI.reindexBlocksFromScraperData()
+        BMPI.reindexBlocksFromScraperData(requests_per_second=requests_per_second)
         print("Done.")
         
     except Exception as ex:
@@ -303,6 +313,163 @@ def reindex_blocks():
         print("Error message: {}".format(str(ex)))
         sys.exit(1)
 
+@cli.command()
+@click.option('--run_id', required=True, type=str, help='The run_id of the attribution run to delete.')
+@click.confirmation_option(prompt='Are you sure you want to delete all results of this run?')
+def drop_attribution_run(run_id):
+    '''
+    Deletes all attribution results of a run by dropping its partition.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        print("Dropping attribution run: {}".format(run_id))
+        if not BMPI.dropAttributionRun(run_id):
+            print("No partition found for this run.")
+        print("Done.")
+        
+    except Exception as ex:
+        print("An error occured:")
+        print("Error message: {}".format(str(ex)))
+        sys.exit(1)
+
+@cli.command()
+@click.option('--block_height', required=True, type=int, help='A height within the partition to delete.')
+@click.confirmation_option(prompt='Are you sure you want to delete all blocks in this partition?')
+def drop_block_partition(block_height):
+    '''
+    Deletes all stored blocks of the height partition that contains block_height.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        print("Dropping the block partition containing height: {}".format(block_height))
+        if not BMPI.dropBlockPartition(block_height):
+            print("No partition found for this height.")
+        print("Done.")
+        
+    except Exception as ex:
+        print("An error occured:")
+        print("Error message: {}".format(str(ex)))
+        sys.exit(1)
+
+@cli.command()
+@click.option('--statistic', required=True, type=click.Choice(['pool_share', 'blocks_per_period', 'agreement']), help='Statistic to compute.')
+@click.option('--run_id', required=True, type=str, help='Run id of the attribution run.')
+@click.option('--field', default='My_updated_attribution', show_default=True, type=str, help='Attribution field with the pool names.')
+@click.option('--compare_field', default='0xB10C_attribution', show_default=True, type=str, help='Attribution field compared to --field, for the agreement statistic.')
+@click.option('--interval', default='month', show_default=True, type=click.Choice(['day', 'week', 'month', 'quarter', 'year']), help='Period length, for the blocks_per_period statistic.')
+@click.option('--start_height', default=None, type=int, help='Only count blocks from this height.')
+@click.option('--end_height', default=None, type=int, help='Only count blocks up to this height.')
+def pool_statistics(statistic, run_id, field, compare_field, interval, start_height, end_height):
+    '''
+    Prints pool statistics of an attribution run, computed by Elasticsearch aggregations.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        BMPI.printPoolStatistics(statistic=statistic,
+                                 run_id=run_id,
+                                 field=field,
+                                 compare_field=compare_field,
+                                 interval=interval,
+                                 start_height=start_height,
+                                 end_height=end_height)
+        
+    except Exception as ex:
+        print("An error occured:")
+        print("Error message: {}".format(str(ex)))
+        sys.exit(1)
+
+@cli.command()
+@click.option('--run_id', required=True, type=str, help='Run id of the attribution run.')
+def rebuild_rollups(run_id):
+    '''
+    Rebuilds the per day per pool rollup rows of an attribution run from its stored attributions.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        BMPI.rebuildRollups(run_id=run_id)
+        print("Done.")
+        
+    except Exception as ex:
+        print("An error occured:")
+        print("Error message: {}".format(str(ex)))
+        sys.exit(1)
+
+@cli.command()
+@click.option('--run_id', required=True, type=str, help='Run id of the attribution run.')
+@click.option('--field', default='My_updated_attribution', show_default=True, type=str, help='Attribution field with the pool names.')
+@click.option('--interval', default='month', show_default=True, type=click.Choice(['day', 'week', 'month', 'quarter', 'year']), help='Period length.')
+@click.option('--start_day', default=None, type=str, help='First day to include (yyyy-mm-dd).')
+@click.option('--end_day', default=None, type=str, help='Last day to include (yyyy-mm-dd).')
+def pool_share_history(run_id, field, interval, start_day, end_day):
+    '''
+    Prints the share of every pool per period, read from the rollup index.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        BMPI.printPoolShareHistory(run_id=run_id, field=field, interval=interval, start_day=start_day, end_day=end_day)
+        
+    except Exception as ex:
+        print("An error occured:")
+        print("Error message: {}".format(str(ex)))
+        sys.exit(1)
+
+@cli.command()
+def drain_spool():
+    '''
+    Stores the records left in the on-disk spool by an earlier gather run.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        BMPI.drainSpool()
+        print("Done.")
+        
+    except Exception as ex:
+        print("An error occured:")
+        print("Error message: {}".format(str(ex)))
+        sys.exit(1)
+
+@cli.command()
+@click.option('--task_id', default=None, type=str, help='Id of the task to track, tracks all pending tasks by default.')
+def track_tasks(task_id):
+    '''
+    Tracks the progress of server side delete and reindex tasks, e.g. to
+    resume tracking after the client was disconnected.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        outcomes = BMPI.trackTasks(task_id)
+        if not outcomes:
+            print("No pending tasks found.")
+        for tracked_task_id, outcome in outcomes.items():
+            print("Task {} finished: {}".format(tracked_task_id, outcome))
+        print("Done.")
+        
+    except Exception as ex:
+        print("An error occured:")
+        print("Error message: {}".format(str(ex)))
+        sys.exit(1)
+
+@cli.command()
+@click.option('--index', default=None, type=str, help='Name of the index to migrate, migrates all indices by default.')
+@click.confirmation_option(prompt='Are you sure you want to migrate the data to the current index mappings?')
+def migrate_indices(index):
+    '''
+    Reindexes stored data into indices with the current mapping version
+    and swaps the index aliases to the new indices.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        print("Migrating indices to the current mapping version.")
+        if not BMPI.migrateIndices(index):
+            print("Migration failed, please check the logs.")
+            sys.exit(1)
+        print("Done.")
+
+    except Exception as ex:
+        print("An error occured:")
+        print("Error message: {}".format(str(ex)))
+        sys.exit(1)
+
 @cli.command()
 def combine_known_pool_data():
     '''
@@ -325,7 +492,9 @@ def combine_known_pool_data():
 @click.option('--run_id', default=None, type=str, help='Enter a run_id (str), by default it uses current date and time.')
 @click.option('--start_height', type=int, help='Start height of block to stored block to be analysed.')
 @click.option('--end_height', type=int, help='Height of the last block to be analysed.')
-def attribute_pool_names(run_id, update_pool_data, start_height, end_height):
+@click.option('--compact', is_flag=True, help='Store the results in the compact_attributions index with pool ids instead of pool names.')
+@click.option('--workers', default=1, show_default=True, type=int, help='Number of processes that attribute blocks in parallel.')
+def attribute_pool_names(run_id, start_height, end_height, compact, workers):
     '''
     Reads block data from the blocks_from_scrapers_updated index,
     calls the attribute_blocks module to determine pool name for each block,
@@ -339,7 +508,107 @@ def attribute_pool_names(run_id, update_pool_data, start_height, end_height):
         
         BMPI.attributePoolNames(run_id=run_id,
                                 start_height=start_height, 
-                                end_height=end_height)
+                                end_height=end_height,
+                                compact=compact,
+                                workers=workers)
+        print("Done.")
+        
+    except Exception as e:
+        print("An error occured:")
+        print("Error message: {}".format(str(e)))
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--base_run_id', required=True, type=str, help='Attribution run made with the previous known-pools data.')
+@click.option('--run_id', required=True, type=str, help='Attribution run to create with the current known-pools data.')
+@click.option('--old_known_pools', required=True, type=click.Path(exists=True, file_okay=False), help='Copy of the known-pools directory the base run was made with.')
+@click.option('--start_height', required=True, type=int, help='First height of the base run to use.')
+@click.option('--end_height', required=True, type=int, help='Last height of the base run to use.')
+def reattribute_changed_blocks(base_run_id, run_id, old_known_pools, start_height, end_height):
+    '''
+    Creates a new attribution run after the known-pools data changed, by only
+    attributing the blocks with a changed coinbase tag or payout address again
+    and copying the other attributions of the base run.
+    '''
+    assert(start_height <= end_height)
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        copied, attributed = BMPI.reattributeChangedBlocks(base_run_id=base_run_id,
+                                                           run_id=run_id,
+                                                           old_known_pools_path=os.path.join(old_known_pools, ""),
+                                                           start_height=start_height,
+                                                           end_height=end_height)
+        print("Copied {} attributions, attributed {} changed blocks.".format(copied, attributed))
+    except Exception as e:
+        print("An error occured:")
+        print("Error message: {}".format(str(e)))
+        sys.exit(1)
+
+        
+@cli.command()
+@click.option('--run_id', required=True, type=str, help='Run id of the attribution run.')
+@click.option('--start_height', required=True, type=int, help='Height of the first block to export.')
+@click.option('--end_height', required=True, type=int, help='Height of the last block to export.')
+@click.option('--output_file', required=True, type=str, help='File to write the attributions to, one JSON document per line.')
+def export_compact_attributions(run_id, start_height, end_height, output_file):
+    '''
+    Exports compact attributions as full block_attributions documents.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        BMPI.exportCompactAttributions(run_id=run_id, start_height=start_height, end_height=end_height, output_file=output_file)
+        print("Done.")
+        
+    except Exception as e:
+        print("An error occured:")
+        print("Error message: {}".format(str(e)))
+        sys.exit(1)
+
+        
+@cli.command()
+@click.option('--start_height', default=None, type=int, help='Only count conflicts from this height.')
+@click.option('--end_height', default=None, type=int, help='Only count conflicts up to this height.')
+def conflict_statistics(start_height, end_height):
+    '''
+    Prints the number of API conflicts per conflicting field.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        BMPI.printConflictStatistics(start_height=start_height, end_height=end_height)
+        
+    except Exception as e:
+        print("An error occured:")
+        print("Error message: {}".format(str(e)))
+        sys.exit(1)
+
+@cli.command()
+@click.option('--start_height', required=True, type=int, help='Height of the first conflict to export.')
+@click.option('--end_height', required=True, type=int, help='Height of the last conflict to export.')
+@click.option('--output_file', required=True, type=str, help='File to write the conflicts to, one JSON document per line.')
+def export_conflicts(start_height, end_height, output_file):
+    '''
+    Exports API conflicts with the block gathered by every scraper.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        BMPI.exportConflicts(start_height=start_height, end_height=end_height, output_file=output_file)
+        print("Done.")
+        
+    except Exception as e:
+        print("An error occured:")
+        print("Error message: {}".format(str(e)))
+        sys.exit(1)
+
+@cli.command()
+@click.confirmation_option(prompt='Are you sure you want to rewrite the stored API conflicts?')
+def delta_encode_conflicts():
+    '''
+    Rewrites API conflicts stored with the full block of every scraper into delta encoded records.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        BMPI.deltaEncodeStoredConflicts()
         print("Done.")
         
     except Exception as e:
@@ -443,6 +712,22 @@ def compile_pool_name_files():
         print("Error message: {}".format(str(ex)))
         sys.exit(1)
 
+@cli.command()
+def compile_known_pools():
+    '''
+    Compiles the known-pools data files into known-pools/pools.snapshot, which
+    the attribution loads instead of the json files until they change.
+    '''
+    BMPI = BMPIFunctions(config=config, logger=logger)
+    try:
+        print("Compiling the known-pools data.")
+        snapshot_path = BMPI.compileKnownPools()
+        print("Written to {}".format(snapshot_path))
+    except Exception as ex:
+        print("An error occured:")
+        print("Error message: {}".format(str(ex)))
+        sys.exit(1)
+
 @cli.command()  
 def count_payout_addresses():
     '''
@@ -24,6 +24,7 @@ from .blockstream_scraper import BlockstreamScraper
 #from .blockcypher_scraper import BlockcypherScraper
 #from .btc_scraper import BtcScraper
 from ..utils import Utils
+from ..conflicts import encode_conflict
 
 
 import time
@@ -108,17 +109,10 @@ class ScraperController:
 
     
     def __constructConflictingApiInformationDataEntry(self, block_hash, block_info_list):
-        entry = {
-            "block_hash": block_hash,
-            "block_height": None,
-            "gathered_data": [
-                {
-                "scraper": str(scraper),
-                "block": block
-                } 
-                for scraper, block in zip(self.scrapers, block_info_list)]
-            }
-        return entry
+        # Stored as the first block plus the differing fields per scraper, see conflicts.py
+        return encode_conflict(block_hash=block_hash,
+                               scraper_names=[str(scraper) for scraper in self.scrapers],
+                               blocks=block_info_list)
         
     
     def __constructConflictingPoolNameAttributionDataEntry(self, block, tag_match_pool_name, address_match_pool_name):
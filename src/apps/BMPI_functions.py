@@ -6,13 +6,29 @@
 @author: Mischa van Reede
 """
 
+import gc
+import math
 import json
 import time
 import sys
+import queue
+import itertools
+import multiprocessing
+import asyncio
+import threading
 
 from datetime import datetime
+from contextlib import contextmanager, nullcontext
 
-from .elastic import ElasticsearchController, ElasticsearchIndexes
+from .elastic import ElasticsearchIndexes
+from .async_elastic import AsyncElasticsearchController
+from .analytics import PoolAnalytics, format_table
+from .rollup import PoolRollup
+from .compact_attributions import PoolDictionary, compact_attribution, expand_attribution
+from .conflicts import encode_conflict, decode_conflict, conflicts_by_field
+from .storage import StorageController, create_storage_controller
+from .spool import RecordSpool
+from .pool_data_diff import load_pool_datasets, diff_pool_data
 from .attribute_blocks import BlockAnalyser
 from .API_scrapers.scraper_controller import ScraperController
 from .utils import Utils
@@ -32,53 +48,49 @@ class BMPIFunctions():
         self.skipped_blocks_list = []
         self.API_conflicts = []
         
+        # Set while gathered records are stored asynchronously
+        self.async_storage = None
+        # Set while gathered records are written to the on-disk spool first
+        self.spool = None
+        # Set in attribution workers if the storage backend allows one writer at a time
+        self.__write_lock = None
+        
         # Init modules
         self.__initialize_modules()
 
     def __initialize_modules(self):
         
-        
-        self.es_controller = ElasticsearchController(config=self.config, logger=self.logger)
+        # The storage backend is created on first use, so commands that do not
+        # store anything also work without a running Elasticsearch instance.
+        self.__storage_controller = None
         
         self.scraper_controller = ScraperController(config=self.config, logger=self.logger)
         
         self.block_analyser = None
 
     
+    @property
+    def storage_controller(self):
+        # Storage backend selected in settings.conf, see storage.py
+        if self.__storage_controller is None:
+            self.__storage_controller = create_storage_controller(config=self.config, logger=self.logger)
+        return self.__storage_controller
+    
     def removeALLStoredElasticsearchData(self):
         self.logger.info("Removing all data from elasticsearch.")
         for index_name in ElasticsearchIndexes.INDEX_NAMES:
-            self.es_controller.delete_index(index_name)
+            self.storage_controller.delete_index(index_name)
         self.logger.info("All data removed.")
     
         
-    def remove_duplicates(self, index):
+    def remove_duplicates(self, index, field="block_height"):
         self.logger.debug("Removing duplicates from {}".format(index))
-        #gather list of all blockheights
-        results = self.es_controller.query_all_docs(index=index)
-        self.logger.debug("Returned a total of {} results".format(len(results)))
-        
-        #Keep track of heights, use set to avoid duplicates:
-        height_set = set()
-               
-        for doc in results:
-            height = doc['block_height']
-            height_set.add(height)
-        
-        self.logger.debug('Found a total of {} unique heights'.format(len(height_set)))
-        
-        for height in height_set:
-        #for each blockheight
-            self.logger.debug("Handling height: {}".format(height))
-            # construct query
-            height_query = "block_height:{}".format(height)
-            # delete duplicate method from elastic.py
-            self.es_controller.remove_all_but_one_by_query(index=index, query=height_query)
-        self.logger.debug("Done deleting duplicate api conflicts.")
+        deleted = self.storage_controller.remove_duplicates(index=index, field=field)
+        self.logger.debug("Done deleting {} duplicate documents.".format(deleted))
     
     def removeStoredElasticsearchData(self, index):
         self.logger.info("Removing the all data in index: {}".format(index))
-        self.es_controller.delete_index(index)
+        self.storage_controller.delete_index(index)
         self.logger.info("Data removed.")
     
 
@@ -87,11 +99,18 @@ class BMPIFunctions():
                                          stop_height=0,
                                          blocks_stored=0,
                                          blocks_skipped=0,
-                                         api_conflicts=0):
+                                         api_conflicts=0,
+                                         force_merge=False,
+                                         async_storage=False,
+                                         spool=False):
         '''
         This method is used to gather relevant block data from the implemented
         blockchain web service API scrapers. It traverses the entire blockchain
-        starting at the latest block_height.
+        starting at the latest block_height. The indices are in bulk ingest mode
+        while gathering, force_merge merges their segments afterwards.
+        With async_storage, gathered blocks are stored in the background while
+        the next blocks are gathered. With spool, every gathered record is
+        written to the on-disk spool first and shipped to storage by a drainer.
 
         '''
         assert(start_height>=stop_height)
@@ -112,115 +131,252 @@ class BMPIFunctions():
         total_blocks_skipped = blocks_skipped # 0 if not set
         total_number_of_api_conflicts = api_conflicts # 0 if not set
         
-        while block_height >= stop_height:
-            succesfully_gathered_block = False
-            exception_encoutered = False
-            conflict_encountered = False
+        gather_indices = ["blocks_from_scrapers_updated", "skipped_blocks", "api_block_data_conflicts"]
+        with self.storage_controller.bulk_ingest(index_names=gather_indices, force_merge=force_merge), self.__asyncStorage(enabled=async_storage), self.__spooledStorage(enabled=spool):
+            while block_height >= stop_height:
+                succesfully_gathered_block = False
+                exception_encoutered = False
+                conflict_encountered = False
+                
+                # Move the records of the previous iteration to disk right away.
+                if self.spool is not None:
+                    self.__spoolGatheredRecords()
             
-            # Store blocks when %block_store_interval blocks are gathered.
-            if (block_height % block_store_interval == 0) or forced_stopped or (block_height == (stop_height+1)):
+                # Store blocks when %block_store_interval blocks are gathered.
+                if (block_height % block_store_interval == 0) or forced_stopped or (block_height == (stop_height+1)):
                 
-                total_blocks_stored += len(self.block_list)
-                total_blocks_skipped += len(self.skipped_blocks_list)
-                total_number_of_api_conflicts += len(self.API_conflicts) 
+                    total_blocks_stored += len(self.block_list)
+                    total_blocks_skipped += len(self.skipped_blocks_list)
+                    total_number_of_api_conflicts += len(self.API_conflicts) 
                 
-                self.performInterimBlockStorage()
+                    self.performInterimBlockStorage()
                 
-                self.logger.info("Total number of blocks successfully stored: {}".format(total_blocks_stored))
-                self.logger.info("Total number of blocks skipped: {}".format(total_blocks_skipped))
-                self.logger.info("Total number of blocks API conflicts: {}".format(total_number_of_api_conflicts))
+                    self.logger.info("Total number of blocks successfully stored: {}".format(total_blocks_stored))
+                    self.logger.info("Total number of blocks skipped: {}".format(total_blocks_skipped))
+                    self.logger.info("Total number of blocks API conflicts: {}".format(total_number_of_api_conflicts))
                 
-            if forced_stopped:
-                sys.exit()
+                if forced_stopped:
+                    sys.exit()
           
-            try: # Gathering new block
-                self.logger.info("Gathering block at height: {}".format(block_height))
-                result = self.scraper_controller.getBlockInfoFromScrapers(block_hash)
-                #self.logger.debug("Found block: {}".format(result))
+                try: # Gathering new block
+                    self.logger.info("Gathering block at height: {}".format(block_height))
+                    result = self.scraper_controller.getBlockInfoFromScrapers(block_hash)
+                    #self.logger.debug("Found block: {}".format(result))
                 
-            except KeyboardInterrupt:
-                forced_stopped = True
-                self.logger.info("Gracefully stopping application.")
-                continue
-            
-            except Exception as e:
-                # Catch timeout exc and other exceptions
-                self.logger.warning("Exception encountered.")
-                exception_encoutered = True
-                exception_type = type(e).__name__
-                self.logger.info("Type of exception: {}".format(exception_type))
-                self.logger.debug(str(e))
-                skipped_blocks_entry = {
-                        "block_height": block_height,
-                        "block_hash": block_hash,
-                        "reason_for_skipping": "Exception encountered: {}".format(exception_type)
-                        }
-                self.skipped_blocks_list.append(skipped_blocks_entry)
+                except KeyboardInterrupt:
+                    forced_stopped = True
+                    self.logger.info("Gracefully stopping application.")
+                    continue
             
-            else: # No exception found and some result is returned.
-                succesfully_gathered_block = (result['status'] == "success")
-                conflict_encountered = (result['status'] == "conflict")
+                except Exception as e:
+                    # Catch timeout exc and other exceptions
+                    self.logger.warning("Exception encountered.")
+                    exception_encoutered = True
+                    exception_type = type(e).__name__
+                    self.logger.info("Type of exception: {}".format(exception_type))
+                    self.logger.debug(str(e))
+                    skipped_blocks_entry = {
+                            "block_height": block_height,
+                            "block_hash": block_hash,
+                            "reason_for_skipping": "Exception encountered: {}".format(exception_type)
+                            }
+                    self.skipped_blocks_list.append(skipped_blocks_entry)
             
-            if succesfully_gathered_block:
-                # Set variables (block_hash and block_height) for next iteration of outer while
-                block = result['block']
-                self.block_list.append(block)
-                block_hash = block['prev_block_hash']
-                block_height -= 1
-                self.logger.debug("Block succesfully gathered.\n")
-                continue # continue with next iteration
+                else: # No exception found and some result is returned.
+                    succesfully_gathered_block = (result['status'] == "success")
+                    conflict_encountered = (result['status'] == "conflict")
             
-            if exception_encoutered:
-                block_hash, block_height = self.findValidPrecedingHashAndHeight(block_height)
-                self.logger.debug("Block hash found for next iteration.\n")
-                continue 
-                
-            if conflict_encountered:
-                self.logger.info("Conflict encountered.")
-                # Set block height to conflict entry
-                result['conflict_entry']['block_height'] = block_height
-                # Add conflict block to list
-                self.API_conflicts.append(result['conflict_entry'])
-                # Add skipped block
-                skipped_blocks_entry = {
-                    "block_height": block_height,
-                    "block_hash": block_hash,
-                    "reason_for_skipping": "Conflicting API information."
-                    }
-                self.skipped_blocks_list.append(skipped_blocks_entry)
-               
-                # Set variables (block_hash and block_height) for next iteration of outer while
-                if result['prev_hash_equal']:
-                    block_hash = result['prev_hash']
+                if succesfully_gathered_block:
+                    # Set variables (block_hash and block_height) for next iteration of outer while
+                    block = result['block']
+                    self.block_list.append(block)
+                    block_hash = block['prev_block_hash']
                     block_height -= 1
-                    self.logger.debug("Block hash found for next iteration.\n")
+                    self.logger.debug("Block succesfully gathered.\n")
                     continue # continue with next iteration
-                else:     
+            
+                if exception_encoutered:
                     block_hash, block_height = self.findValidPrecedingHashAndHeight(block_height)
                     self.logger.debug("Block hash found for next iteration.\n")
-                    continue # 4.
-            self.logger.error("Code should not reach this part.")
-        # End of outer while      
+                    continue 
+                
+                if conflict_encountered:
+                    self.logger.info("Conflict encountered.")
+                    # Set block height to conflict entry
+                    result['conflict_entry']['block_height'] = block_height
+                    # Add conflict block to list
+                    self.API_conflicts.append(result['conflict_entry'])
+                    # Add skipped block
+                    skipped_blocks_entry = {
+                        "block_height": block_height,
+                        "block_hash": block_hash,
+                        "reason_for_skipping": "Conflicting API information."
+                        }
+                    self.skipped_blocks_list.append(skipped_blocks_entry)
+               
+                    # Set variables (block_hash and block_height) for next iteration of outer while
+                    if result['prev_hash_equal']:
+                        block_hash = result['prev_hash']
+                        block_height -= 1
+                        self.logger.debug("Block hash found for next iteration.\n")
+                        continue # continue with next iteration
+                    else:     
+                        block_hash, block_height = self.findValidPrecedingHashAndHeight(block_height)
+                        self.logger.debug("Block hash found for next iteration.\n")
+                        continue # 4.
+                self.logger.error("Code should not reach this part.")
+            # End of outer while      
         self.logger.info("END of loop: Crawling API's for block data complete.")    
     
 
+    @contextmanager
+    def __asyncStorage(self, enabled):
+        '''
+        Runs an event loop with an AsyncElasticsearchController in a background
+        thread. While active, performInterimBlockStorage hands the gathered
+        records to it instead of waiting for Elasticsearch. On exit all pending
+        writes are awaited and records of failed writes are stored synchronously.
+        '''
+        if not enabled:
+            yield
+            return
+        if not self.storage_controller.supports(StorageController.ASYNC_STORAGE):
+            self.logger.warning("Asynchronous storage is not supported by the storage backend, storing synchronously.")
+            yield
+            return
+        
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name="async-storage", daemon=True)
+        thread.start()
+        
+        async def create_controller():
+            # Create the async client within the event loop it is used in
+            return AsyncElasticsearchController(config=self.config, logger=self.logger)
+        
+        self.async_storage = {
+            "loop": loop,
+            "controller": asyncio.run_coroutine_threadsafe(create_controller(), loop).result(),
+            "pending": []
+            }
+        self.logger.info("Storing gathered records asynchronously.")
+        try:
+            yield
+        finally:
+            self.__collectAsyncStorageResults(wait=True)
+            asyncio.run_coroutine_threadsafe(self.async_storage["controller"].close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            self.async_storage = None
+            # Store records of failed asynchronous writes
+            self.performInterimBlockStorage()
+            self.logger.info("Asynchronous storage stopped.")
+    
+    @contextmanager
+    def __spooledStorage(self, enabled):
+        '''
+        Writes gathered records to the on-disk spool (see spool.py) before
+        they are stored. A drainer thread ships the spooled records to the
+        storage backend, so gathering continues while the backend is down.
+        On exit the spool is drained, segments that could not be shipped are
+        shipped by the next run.
+        '''
+        if not enabled:
+            yield
+            return
+        
+        # The drainer thread gets its own storage controller (and connection)
+        self.spool = RecordSpool(logger=self.logger,
+                                 storage_controller=create_storage_controller(config=self.config, logger=self.logger),
+                                 spool_dir=self.config.get('Spool', 'spool_path', fallback='../spool'),
+                                 segment_records=self.config.getint('Spool', 'segment_records', fallback=1000),
+                                 sync_every=self.config.getint('Spool', 'sync_every', fallback=10))
+        self.spool.start_drainer()
+        try:
+            yield
+        finally:
+            self.__spoolGatheredRecords()
+            self.spool.close()
+            self.spool = None
+    
+    def __spoolGatheredRecords(self):
+        for source_list, index_name in [(self.block_list, "blocks_from_scrapers_updated"),
+                                        (self.skipped_blocks_list, "skipped_blocks"),
+                                        (self.API_conflicts, "api_block_data_conflicts")]:
+            for record in source_list:
+                self.spool.append(record=record, index_name=index_name)
+            source_list.clear()
+    
+    def drainSpool(self):
+        # Ships the spooled records left by an earlier run to the storage backend.
+        spool = RecordSpool(logger=self.logger,
+                            storage_controller=self.storage_controller,
+                            spool_dir=self.config.get('Spool', 'spool_path', fallback='../spool'),
+                            writer=False)
+        self.logger.info("{} spool segments pending.".format(len(spool.pending_segments())))
+        if spool.drain():
+            self.logger.info("Spool drained.")
+        else:
+            self.logger.error("Spool could not be drained completely. Please check the logs.")
+    
+    def __collectAsyncStorageResults(self, wait):
+        # Checks finished asynchronous writes, records of failed writes are put
+        # back in the list they came from to be stored with the next flush.
+        still_pending = []
+        for future, records, source_list in self.async_storage["pending"]:
+            if not wait and not future.done():
+                still_pending.append((future, records, source_list))
+                continue
+            try:
+                failed_records = future.result()
+            except Exception as ex:
+                self.logger.error("Asynchronous storage raised an exception: {}".format(str(ex)))
+                failed_records = records
+            if failed_records:
+                self.logger.error("Failed to store {} records asynchronously, retrying with the next flush.".format(len(failed_records)))
+                source_list.extend(failed_records)
+        self.async_storage["pending"] = still_pending
+    
     def performInterimBlockStorage(self):
+        if self.spool is not None:
+            # Records are stored by the spool drainer, seal the segments so they are shipped now
+            self.__spoolGatheredRecords()
+            self.spool.flush()
+            return
+        
+        if self.async_storage is not None:
+            # Hand the records to the background event loop and continue gathering
+            self.__collectAsyncStorageResults(wait=False)
+            for source_list, index_name in [(self.block_list, "blocks_from_scrapers_updated"),
+                                            (self.skipped_blocks_list, "skipped_blocks"),
+                                            (self.API_conflicts, "api_block_data_conflicts")]:
+                if len(source_list) > 0:
+                    records = list(source_list)
+                    source_list.clear()
+                    # Partitions are resolved (and created) here, the event loop does not use the synchronous controller
+                    write_indices = [self.storage_controller.get_write_index(index_name, record) for record in records]
+                    future = asyncio.run_coroutine_threadsafe(
+                        self.async_storage["controller"].bulk_store(records=records, index_name=index_name, write_indices=write_indices),
+                        self.async_storage["loop"])
+                    self.async_storage["pending"].append((future, records, source_list))
+            self.logger.info("{} asynchronous writes pending.".format(len(self.async_storage["pending"])))
+            return
+        
         # Store succesfully gathered blocks
-        if self.es_controller.bulk_store(records=self.block_list, index_name="blocks_from_scrapers_updated"):
+        if self.storage_controller.bulk_store(records=self.block_list, index_name="blocks_from_scrapers_updated"):
             self.logger.info("Succesfully stored last {} blocks".format(len(self.block_list)))
             self.block_list.clear()
         else:
             self.logger.error("Failed to store blocks in es. Please check the logs.")
         # Store skipped blocks
         if len(self.skipped_blocks_list) > 0:
-            if self.es_controller.bulk_store(records=self.skipped_blocks_list, index_name="skipped_blocks"):
+            if self.storage_controller.bulk_store(records=self.skipped_blocks_list, index_name="skipped_blocks"):
                 self.logger.info("Succesfully stored last {} skipped blocks".format(len(self.skipped_blocks_list)))
                 self.skipped_blocks_list.clear()
             else:
                 self.logger.error("Failed to store skipped blocks heights in es. Please check the logs.")
         # Store API data conflicts
         if len(self.API_conflicts) > 0:
-            if self.es_controller.bulk_store(records=self.API_conflicts, index_name="api_block_data_conflicts"):
+            if self.storage_controller.bulk_store(records=self.API_conflicts, index_name="api_block_data_conflicts"):
                 self.logger.info("Succesfully stored last {} API data conflicts".format(len(self.API_conflicts)))
                 self.API_conflicts.clear()
             else:
@@ -345,49 +501,86 @@ class BMPIFunctions():
     def gatherMissingBlocksFromScrapers(self):
    
         skipped_index = "skipped_blocks"
+        chunk_size = 1000
         
         skip_reasons = set()
-        # Get records of skipped blocks
-        #skipped_blocks = self.es_controller.query_all_docs(index=skipped_index)
-        skipped_blocks = self.es_controller.query_all_docs_with_metadata(index=skipped_index)
-        #skipped_blocks = self.es_controller.query_es(query="*", index=skipped_index)
-        
-        # Reverse list to start at lower block heights
-        
-        skipped_blocks.reverse()
+        success = 0
+        failed = 0
+        already_stored = 0
         
-        for record in skipped_blocks:
-            # Add reason for skipping this block to set of reasons
-            skip_reasons.add(record["data"]["reason_for_skipping"])
+        # Stream the records of skipped blocks, starting at the lowest block height
+        skipped_blocks = self.storage_controller.scan_docs(index=skipped_index,
+                                                           fields=["block_height", "block_hash", "reason_for_skipping"],
+                                                           sort=["block_height", "block_hash"],
+                                                           page_size=chunk_size)
+        while True:
+            chunk = [{"id": record["_id"], "data": record["_source"]} for record in itertools.islice(skipped_blocks, chunk_size)]
+            if not chunk:
+                break
+            
+            # Check in one go which of the skipped blocks in this chunk have been stored since.
+            stored_blocks = self.storage_controller.get_blocks_by_hashes(
+                block_hashes=[record["data"]["block_hash"] for record in chunk if record["data"].get("block_hash")])
+            
+            for record in chunk:
+                # Add reason for skipping this block to set of reasons
+                skip_reasons.add(record["data"]["reason_for_skipping"])
+                
+                if stored_blocks.get(record["data"].get("block_hash")):
+                    self.logger.info("Block {} is already stored, removing skipped block record.".format(record["data"]["block_height"]))
+                    already_stored += 1
+                    self.deleteDocByID(index=skipped_index,
+                                       doc_id=record["id"])
+                    continue
+                
+                # Trying to re-gather skipped block
+                if (self.gatherSpecificBlock(block_height=record["data"]["block_height"],
+                                                  block_hash=record["data"]["block_hash"],
+                                                  store_block=(True))):
+                    self.logger.info("Successfully re-gathered block: {}".format(record["data"]["block_height"]))
+                    success += 1
+       
+                else:
+                    self.logger.warning("Failed to re-gather block: {}".format(record["data"]["block_height"]))
+                    failed += 1
+                
+                # Delete old record from skipped blocks index
+                # if conflict occurs new document is already stored so deleting
+                # the old is ok.
+                self.deleteDocByID(index=skipped_index, 
+                                    doc_id=record["id"])
         
         self.logger.info("Found a total of {} reasons for skipping blocks.".format(len(skip_reasons)))
         self.logger.info("Namely: {}".format(list(skip_reasons)))
-              
-        success = 0
-        failed = 0
-               
-        for record in skipped_blocks:
-            # Trying to re-gather skipped block
-            if (self.gatherSpecificBlock(block_height=record["data"]["block_height"],
-                                              block_hash=record["data"]["block_hash"],
-                                              store_block=(True))):
-                self.logger.info("Successfully re-gathered block: {}".format(record["data"]["block_height"]))
-                success += 1
-   
-            else:
-                self.logger.warning("Failed to re-gather block: {}".format(record["data"]["block_height"]))
-                failed += 1
-            
-            # Delete old record from skipped blocks index
-            # if conflict occurs new document is already stored so deleting
-            # the old is ok.
-            self.deleteDocByID(index=skipped_index, 
-                                doc_id=record["id"])   
-          
-        self.logger.info("Re-gathering complete. Successfull: {},  Failed: {}".format(success, failed))
+        self.logger.info("Re-gathering complete. Successfull: {},  Failed: {},  Already stored: {}".format(success, failed, already_stored))
         return
     
     
+    def __iterStoredBlocks(self, index, start_height, end_height, skipped_heights, fields=None):
+        '''
+        Streams one stored block per height between start_height and end_height
+        (inclusive) in ascending order. Duplicate blocks at a height are ignored,
+        heights without a stored block are appended to skipped_heights.
+        '''
+        expected_height = start_height
+        for block in self.storage_controller.iter_blocks(start_height=start_height,
+                                                    end_height=end_height,
+                                                    fields=fields,
+                                                    index=index):
+            height = block["block_height"]
+            if height < expected_height:
+                self.logger.debug("Ignoring duplicate block at height {}".format(height))
+                continue
+            if height > expected_height:
+                self.logger.warning("No stored block found for heights {} up to {}".format(expected_height, height-1))
+                skipped_heights.extend(range(expected_height, height))
+            expected_height = height + 1
+            yield block
+
+        if expected_height <= end_height:
+            self.logger.warning("No stored block found for heights {} up to {}".format(expected_height, end_height))
+            skipped_heights.extend(range(expected_height, end_height+1))
+
     def updatePoolDataWithPayoutAddressData(self):
         
         start_height = 700000
@@ -397,160 +590,68 @@ class BMPIFunctions():
         self.block_analyser = BlockAnalyser(config=self.config, logger=self.logger)
         
         self.logger.info("Start looping over blocks.")
-        for height in range(start_height, end_height+1):
-            self.logger.info("Attributing pool name to block: {}".format(height))
-            # get block from elasticsearch
-            query = "block_height:{}".format(height)
-            
-            results = None
-            for attempt in range(3):
-                results = self.es_controller.query_es(index=block_data_index, query=query)
-                if results:
-                    break
-                else:
-                    time.sleep(3)
-            if results is None:
-                self.logger.warning("Couldn't get a response from the ES instance for block height: {}".format(height))
-                skipped_heights.append(height)
-                continue # Go to next height in outer loop
-            
-            
-            if len(results) == 0:
-                # No result found with matching block height, go to next height
-                skipped_heights.append(height)
-                self.logger.warning("Found 0 results for height {}".format(height))
-                continue
-                
-            elif len(results) > 1:
-                self.logger.debug("Found {} results for height {}".format(len(results), height))
-                block = None
-                for doc in results:
-                    if doc["_source"]['block_height'] == height:
-                        block = doc["_source"]
-                        break 
-                if block == None:
-                    # No result found with exact matching block height
-                    self.logger.info("No stored block found for height: {}".format(height))
-                    continue
-            else:
-                block = results[0]["_source"]
-        
-            
-            # Attribute block, and update if new address is found.
-            coinbase_message = block["coinbase_message"]
-            payout_addresses = list(block["payout_addresses"])
-            update_data = True
-            self.block_analyser.updateMyPoolData(coinbase_message, payout_addresses, update_data)
+        try:
+            # Entries journaled by an update run that did not finish are added first
+            self.block_analyser.openPoolDataJournal()
+            for block in self.__iterStoredBlocks(index=block_data_index,
+                                                 start_height=start_height,
+                                                 end_height=end_height,
+                                                 skipped_heights=skipped_heights,
+                                                 fields=["block_height", "block_hash", "coinbase_message", "payout_addresses"]):
+                self.logger.info("Attributing pool name to block: {}".format(block["block_height"]))
+    
+                # Attribute block, and update if new address is found.
+                coinbase_message = block["coinbase_message"]
+                payout_addresses = list(block["payout_addresses"])
+                update_data = True
+                self.block_analyser.updateMyPoolData(coinbase_message, payout_addresses, update_data)
+        finally:
+            # Also on errors, journaled addresses would be written by the next run otherwise.
+            self.block_analyser.persistMyPoolData()
             
         self.logger.info("Done looping over all blocks.")
         self.logger.info("Skipped the following heights: {}".format(skipped_heights))
         return
     
     @Utils.printTiming
-    def attributePoolNames(self, run_id=None, start_height=None, end_height=None):
+    def attributePoolNames(self, run_id=None, start_height=None, end_height=None, compact=False, batch_size=1000, workers=1):
         '''
         Reads block data from the blocks_from_scrapers_updated index,
         calls the attribute_blocks module to determine pool name for each block,
-        writes results to the block_attributions index.
+        writes results to the block_attributions index. With compact, the
+        results are written to the compact_attributions index instead, see
+        compact_attributions.py. Blocks are attributed and stored per batch_size blocks.
+        With more than one worker, the height range is attributed by that many processes.
         '''
                 
         self.block_analyser = BlockAnalyser(config=self.config, logger=self.logger)
         if not run_id:
             self.logger.info("Using current time and date as run_id.")
             run_id = str(datetime.now().strftime("%b/%m/%Y %H:%M:%S"))
-        
-        block_data_index = "blocks_from_scrapers_updated"
-        name_attribution_index = "block_attributions"
-        skipped_heights = []
    
         self.logger.info("Starting attribution algorithm with following variables:")
-        self.logger.info("Run_id: {}, start_height: {}, end_height: {}".format(run_id, start_height, end_height))
+        self.logger.info("Run_id: {}, start_height: {}, end_height: {}, workers: {}".format(run_id, start_height, end_height, workers))
         
-        assert(run_id and (start_height <= end_height) and (start_height >= 0) and (end_height >= 0))
-        for height in range(start_height, end_height+1):
-            self.logger.info("Attributing pool name to block: {}".format(height))
-            # get block from elasticsearch
-            query = "block_height:{}".format(height)
-            
-            results = None
-            for attempt in range(3):
-                results = self.es_controller.query_es(index=block_data_index, query=query)
-                if results:
-                    break
-                else:
-                    time.sleep(3)
-            if results is None:
-                self.logger.warning("Couldn't get a response from the ES instance for block height: {}".format(height))
-                skipped_heights.append(height)
-                continue # Go to next height in outer loop
-            
-            
-            if len(results) == 0:
-                # No result found with matching block height, go to next height
-                skipped_heights.append(height)
-                self.logger.debug("Found 0 results for height {}".format(height))
-                continue
-                
-            elif len(results) > 1:
-                self.logger.debug("Found {} results for height {}".format(len(results), height))
-                block = None
-                for doc in results:
-                    if doc["_source"]['block_height'] == height:
-                        block = doc["_source"]
-                        break 
-                if block == None:
-                    # No result found with exact matching block height
-                    self.logger.info("No stored block found for height: {}".format(height))
-                    continue
-            else:
-                block = results[0]["_source"]
-            
-            # extract block information
-            block_hash = block["block_hash"]
-            block_height = block["block_height"]
-            time_stamp = block["timestamp"]
-            coinbase_message = block["coinbase_message"]
-            payout_addresses = list(block["payout_addresses"])
-            fee_reward = block["fee_block_reward"]
-            total_reward = block["total_block_reward"]
-            
-            # attribute pool name based on block information
-            results = self.block_analyser.AttributePoolName(coinbase_message=coinbase_message, 
-                                                            payout_addresses=payout_addresses)
-
-            # construct a results document to be stored in index block_attributions
-            data_entry = {
-                "run_id": run_id,
-                "block_height": block_height,
-                "block_hash": block_hash,
-                "timestamp" : time_stamp,
-                "coinbase_message": coinbase_message,
-                "payout_addresses": list(payout_addresses),
-                "fee_block_reward": fee_reward,
-                "total_block_reward": total_reward,
-                "0xB10C_results": results["0xB10C"],
-                "0xB10C_attribution": results["0xB10C"]["pool_name"],
-                "Blockchain_com_results": results["Blockchain_com"],
-                "Blockchain_com_attribution": results["Blockchain_com"]["pool_name"],
-                "BTC_com_results": results["BTC_com"],
-                "BTC_com_attribution": results["BTC_com"]["pool_name"],
-                "My_inital_results": results["My_initial_attribution"],
-                "My_initial_attribution": results["My_initial_attribution"]["pool_name"],
-                "My_updated_results": results["My_updated_attribution"],
-                "My_updated_attribution": results["My_updated_attribution"]["pool_name"]
-                }
-            # store result document
-            for attempt in range(3):
-                if self.es_controller.store(record=data_entry, index_name=name_attribution_index):
-                    self.logger.info("Results stored successfully.")
-                    break
-                else:
-                    self.logger.warning("Storing of results failed. Trying again.")
-                    time.sleep(3)
-            
-                self.logger.error("Couldnt store results of block at height: {}".format(height))
-                skipped_heights.append(height)
-            self.logger.info("Continuing with the next block_height.\n")
+        assert(run_id and (start_height <= end_height) and (start_height >= 0) and (end_height >= 0) and (workers >= 1))
+        pool_dictionary = None
+        if compact:
+            pool_dictionary = PoolDictionary(storage_controller=self.storage_controller, logger=self.logger)
+            if not pool_dictionary.add_names(self.block_analyser.getPoolNames()):
+                raise RuntimeError("Could not store the pool dictionary.")
+        
+        if workers > 1:
+            skipped_heights = self.__attributeInWorkers(run_id=run_id,
+                                                        start_height=start_height,
+                                                        end_height=end_height,
+                                                        batch_size=batch_size,
+                                                        pool_dictionary=pool_dictionary,
+                                                        workers=workers)
+        else:
+            skipped_heights = self.__attributeHeightRange(run_id=run_id,
+                                                          start_height=start_height,
+                                                          end_height=end_height,
+                                                          batch_size=batch_size,
+                                                          pool_dictionary=pool_dictionary)
         
         # Done, finishing up
         self.logger.info("Block attributions complete for all blocks.")
@@ -559,53 +660,325 @@ class BMPIFunctions():
         if len(skipped_heights) > 0:
             self.logger.info("Writing skipped heights to skipped_heights_log.json file")
             entry = {
-                str(run_id) : skipped_heights
+                str(run_id) : sorted(skipped_heights)
                 }
             current_path = Utils.getCurrentPath()
             with open(current_path + '/../logs/skipped_heights.json', mode='w', encoding='utf-8') as outfile:
                 json.dump(entry, outfile, indent=4)
                 self.logger.debug("Skipped heights saved to log file 'skipped_heights.json'")
     
+    def __attributeHeightRange(self, run_id, start_height, end_height, batch_size, pool_dictionary):
+        '''
+        Attributes and stores the blocks between start_height and end_height,
+        in compact form if a pool_dictionary is given. Returns the skipped heights.
+        If attributing fails, the batches stored before are kept and only the
+        heights after them are skipped.
+        '''
+        block_data_index = "blocks_from_scrapers_updated"
+        name_attribution_index = "block_attributions" if pool_dictionary is None else "compact_attributions"
+        skipped_heights = []
+        # First height of which the attribution is not stored (or skipped) yet
+        next_height = start_height
+        
+        rollup = None
+        try:
+            # Per day per pool counts, updated as the attributions are stored
+            if self.storage_controller.supports(StorageController.AGGREGATIONS):
+                rollup = PoolRollup(es_controller=self.storage_controller, logger=self.logger)
+            
+            stored_blocks = self.__iterStoredBlocks(index=block_data_index,
+                                                    start_height=start_height,
+                                                    end_height=end_height,
+                                                    skipped_heights=skipped_heights)
+            while True:
+                blocks = list(itertools.islice(stored_blocks, batch_size))
+                if not blocks:
+                    break
+                heights = [block["block_height"] for block in blocks]
+                self.logger.info("Attributing pool names to blocks {} - {}".format(heights[0], heights[-1]))
+                
+                # attribute pool names and construct the results documents to be stored in index block_attributions
+                documents = self.block_analyser.attributeBatch(blocks=blocks, run_id=run_id)
+                records = documents
+                if pool_dictionary is not None:
+                    records = [compact_attribution(attribution=document, pool_dictionary=pool_dictionary) for document in documents]
+                
+                # store result documents
+                if not self.__storeAttributions(records=records, documents=documents, index=name_attribution_index, rollup=rollup):
+                    self.logger.error("Couldnt store results of blocks at heights {} - {}".format(heights[0], heights[-1]))
+                    skipped_heights.extend(heights)
+                next_height = heights[-1] + 1
+        except Exception as ex:
+            self.logger.exception("Failed to attribute blocks {} - {}: {}".format(next_height, end_height, str(ex)))
+            # Heights after next_height without a stored block can be in skipped_heights already
+            already_skipped = set(skipped_heights)
+            skipped_heights.extend(height for height in range(next_height, end_height+1) if height not in already_skipped)
+        
+        if rollup is not None and not rollup.flush():
+            self.logger.error("Rollup rows of run {} are incomplete, run rebuild_rollups to fix them.".format(run_id))
+        self.logger.info("Attribution memo: {hits} hits, {misses} misses, {size} entries.".format(**self.block_analyser.memoStatistics()))
+        return skipped_heights
+    
+    def __storeAttributions(self, records, documents, index, rollup):
+        # Stores the records of a batch, trying 3 times, and counts the block_attributions documents in the rollup.
+        for attempt in range(3):
+            with self.__write_lock or nullcontext():
+                is_stored = self.storage_controller.bulk_store(records=records, index_name=index)
+            if is_stored:
+                self.logger.info("Results stored successfully.")
+                if rollup is not None:
+                    for document in documents:
+                        rollup.add(document)
+                return True
+            else:
+                self.logger.warning("Storing of results failed. Trying again.")
+                time.sleep(3)
+        return False
+    
+    def __attributeInWorkers(self, run_id, start_height, end_height, batch_size, pool_dictionary, workers, max_range_size=10000):
+        '''
+        Attributes the height range with forked worker processes, that take
+        sub ranges from a queue. There are about 4 sub ranges per worker, of
+        at most max_range_size heights. The pool tables of the BlockAnalyser
+        are built once, before forking, and shared copy-on-write.
+        Returns the skipped heights of all workers.
+        '''
+        range_size = min(max_range_size, math.ceil((end_height - start_height + 1) / (workers * 4)))
+        context = multiprocessing.get_context("fork")
+        write_lock = None
+        if not self.storage_controller.supports(StorageController.CONCURRENT_WRITES):
+            self.logger.info("The storage backend allows one writer at a time, the workers store their results in turn.")
+            write_lock = context.Lock()
+        height_ranges = context.Queue()
+        results = context.Queue()
+        for range_start in range(start_height, end_height+1, range_size):
+            height_ranges.put((range_start, min(range_start+range_size-1, end_height)))
+        for _ in range(workers):
+            height_ranges.put(None)
+        
+        # Keep the garbage collector from writing to (and so copying) the shared pages
+        gc.freeze()
+        processes = [context.Process(target=self.__attributionWorker,
+                                     args=(height_ranges, results, run_id, batch_size, pool_dictionary, write_lock),
+                                     name="attribution-worker-{}".format(worker))
+                     for worker in range(workers)]
+        for process in processes:
+            process.start()
+        gc.unfreeze()
+        self.logger.info("Started {} attribution workers.".format(workers))
+        
+        skipped_heights = []
+        finished_workers = 0
+        while finished_workers < workers:
+            try:
+                skipped_heights.extend(results.get(timeout=10))
+                finished_workers += 1
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    self.logger.error("{} attribution workers stopped without reporting their results.".format(workers - finished_workers))
+                    break
+        for process in processes:
+            process.join()
+        return skipped_heights
+    
+    def __attributionWorker(self, height_ranges, results, run_id, batch_size, pool_dictionary, write_lock):
+        # Runs in a forked process, which opens its own connection to the storage backend.
+        self.__storage_controller = None
+        self.__write_lock = write_lock
+        skipped_heights = []
+        try:
+            # A failing range reports the heights it did not store as skipped, see __attributeHeightRange
+            for start_height, end_height in iter(height_ranges.get, None):
+                skipped_heights.extend(self.__attributeHeightRange(run_id=run_id,
+                                                                   start_height=start_height,
+                                                                   end_height=end_height,
+                                                                   batch_size=batch_size,
+                                                                   pool_dictionary=pool_dictionary))
+        finally:
+            results.put(skipped_heights)
+    
+    @Utils.printTiming
+    def reattributeChangedBlocks(self, base_run_id, run_id, old_known_pools_path, start_height, end_height, batch_size=1000):
+        '''
+        Creates the attribution run run_id from the run base_run_id after the
+        known-pools data changed. old_known_pools_path is a copy of the known-pools
+        directory base_run_id was attributed with. Only the blocks that contain a
+        coinbase tag or payout address whose attribution changed (see pool_data_diff.py)
+        are attributed again, the other attributions of the base run are copied.
+        Heights missing from the base run are not attributed.
+        Returns the number of copied and of attributed blocks.
+        '''
+        assert(base_run_id and run_id and (base_run_id != run_id) and (start_height <= end_height))
+        changes = diff_pool_data(old_datasets=load_pool_datasets(old_known_pools_path, self.logger),
+                                 new_datasets=load_pool_datasets("../known-pools/", self.logger))
+        self.logger.info("{} coinbase tags and {} payout addresses changed.".format(len(changes["coinbase_tags"]), len(changes["payout_addresses"])))
+        changed_heights = set(self.storage_controller.find_block_heights(coinbase_tags=changes["coinbase_tags"],
+                                                                         payout_addresses=changes["payout_addresses"],
+                                                                         start_height=start_height,
+                                                                         end_height=end_height))
+        self.logger.info("{} blocks contain a changed tag or address.".format(len(changed_heights)))
+        
+        self.block_analyser = BlockAnalyser(config=self.config, logger=self.logger)
+        rollup = None
+        if self.storage_controller.supports(StorageController.AGGREGATIONS):
+            rollup = PoolRollup(es_controller=self.storage_controller, logger=self.logger)
+        
+        # Copy the unchanged attributions, collect the heights to attribute again
+        copied = 0
+        reattribute_heights = []
+        base_attributions = self.storage_controller.iter_blocks(start_height=start_height,
+                                                                end_height=end_height,
+                                                                index="block_attributions",
+                                                                run_id=base_run_id)
+        while True:
+            chunk = list(itertools.islice(base_attributions, batch_size))
+            if not chunk:
+                break
+            documents = []
+            for document in chunk:
+                if document["block_height"] in changed_heights:
+                    reattribute_heights.append(document["block_height"])
+                else:
+                    documents.append(dict(document, run_id=run_id))
+            if documents and not self.__storeAttributions(records=documents, documents=documents, index="block_attributions", rollup=rollup):
+                raise RuntimeError("Could not copy the attributions of blocks {} - {}".format(chunk[0]["block_height"], chunk[-1]["block_height"]))
+            copied += len(documents)
+        
+        for offset in range(0, len(reattribute_heights), batch_size):
+            heights = reattribute_heights[offset:offset+batch_size]
+            self.logger.info("Attributing pool names to {} changed blocks from height {}".format(len(heights), heights[0]))
+            stored_blocks = self.storage_controller.get_blocks_by_heights(heights=heights)
+            blocks = []
+            for height in heights:
+                if not stored_blocks[height]:
+                    self.logger.warning("No stored block found for height {}".format(height))
+                    continue
+                # The block iter_blocks (and so attributePoolNames) uses if there are duplicates
+                blocks.append(min((hit["_source"] for hit in stored_blocks[height]), key=lambda block: block["block_hash"] or ""))
+            documents = self.block_analyser.attributeBatch(blocks=blocks, run_id=run_id)
+            if not self.__storeAttributions(records=documents, documents=documents, index="block_attributions", rollup=rollup):
+                raise RuntimeError("Could not store the attributions of blocks {} - {}".format(heights[0], heights[-1]))
+        
+        if rollup is not None and not rollup.flush():
+            self.logger.error("Rollup rows of run {} are incomplete, run rebuild_rollups to fix them.".format(run_id))
+        self.logger.info("Copied {} attributions of run {}, attributed {} changed blocks.".format(copied, base_run_id, len(reattribute_heights)))
+        return copied, len(reattribute_heights)
+    
+    def iterExpandedAttributions(self, run_id, start_height, end_height, chunk_size=1000):
+        '''
+        Yields the compact attributions of a run as block_attributions documents,
+        ordered by height. The referenced blocks are looked up per chunk.
+        '''
+        pool_dictionary = PoolDictionary(storage_controller=self.storage_controller, logger=self.logger)
+        compact_attributions = self.storage_controller.iter_blocks(start_height=start_height,
+                                                                   end_height=end_height,
+                                                                   index="compact_attributions",
+                                                                   run_id=run_id)
+        while True:
+            chunk = list(itertools.islice(compact_attributions, chunk_size))
+            if not chunk:
+                break
+            blocks = self.storage_controller.get_blocks_by_hashes(block_hashes=[document["block_hash"] for document in chunk])
+            for document in chunk:
+                hits = blocks.get(document["block_hash"])
+                if not hits:
+                    self.logger.warning("Block {} of a compact attribution is not stored, skipping it.".format(document["block_height"]))
+                    continue
+                yield expand_attribution(document=document, block=hits[0]["_source"], pool_dictionary=pool_dictionary)
+    
+    def exportCompactAttributions(self, run_id, start_height, end_height, output_file):
+        # Writes the expanded compact attributions of a run to a file, one JSON document per line
+        exported = 0
+        with open(output_file, mode='w', encoding='utf-8') as outfile:
+            for attribution in self.iterExpandedAttributions(run_id=run_id, start_height=start_height, end_height=end_height):
+                outfile.write(json.dumps(attribution) + "\n")
+                exported += 1
+        self.logger.info("Exported {} attributions of run {} to {}".format(exported, run_id, output_file))
+    
+    def iterConflicts(self, start_height, end_height):
+        # Yields the API conflicts between two heights with the block of every scraper, see conflicts.py
+        for record in self.storage_controller.iter_blocks(start_height=start_height,
+                                                          end_height=end_height,
+                                                          index="api_block_data_conflicts"):
+            yield decode_conflict(record)
     
+    def exportConflicts(self, start_height, end_height, output_file):
+        exported = 0
+        with open(output_file, mode='w', encoding='utf-8') as outfile:
+            for conflict in self.iterConflicts(start_height=start_height, end_height=end_height):
+                outfile.write(json.dumps(conflict) + "\n")
+                exported += 1
+        self.logger.info("Exported {} API conflicts to {}".format(exported, output_file))
     
+    def printConflictStatistics(self, start_height=None, end_height=None):
+        # Prints the number of API conflicts per conflicting field
+        self.storage_controller.require(StorageController.AGGREGATIONS, "Conflict statistics")
+        print(format_table(conflicts_by_field(es_controller=self.storage_controller, start_height=start_height, end_height=end_height)))
     
-    def deleteStoredBlocksFromElasticsearch(self, index, start_height, end_height, should_delete=False):
+    def deltaEncodeStoredConflicts(self, chunk_size=1000):
+        '''
+        Rewrites API conflicts stored with the block of every scraper
+        (gathered_data) into delta encoded records.
+        '''
+        conflicts_index = "api_block_data_conflicts"
+        encoded = 0
+        legacy_conflicts = (hit for hit in self.storage_controller.scan_docs(index=conflicts_index, page_size=chunk_size)
+                            if "gathered_data" in hit["_source"])
+        while True:
+            chunk = list(itertools.islice(legacy_conflicts, chunk_size))
+            if not chunk:
+                break
+            records = []
+            for hit in chunk:
+                record = encode_conflict(block_hash=hit["_source"]["block_hash"],
+                                         scraper_names=[entry["scraper"] for entry in hit["_source"]["gathered_data"]],
+                                         blocks=[entry["block"] for entry in hit["_source"]["gathered_data"]])
+                record["block_height"] = hit["_source"]["block_height"]
+                records.append(record)
+            if not self.storage_controller.bulk_store(records=records, index_name=conflicts_index):
+                raise RuntimeError("Failed to store the delta encoded conflicts.")
+            self.storage_controller.bulk_delete(chunk)
+            encoded += len(records)
+            self.logger.info("Delta encoded {} API conflicts.".format(encoded))
+        self.logger.info("Done, delta encoded a total of {} API conflicts.".format(encoded))
+    
+    def deleteStoredBlocksFromElasticsearch(self, index, start_height, end_height, should_delete=False, requests_per_second=None):
         '''
         Deletes blocks between start_height and end_height that are stored in
-        the provided index in the elasticsearch instance. 
+        the provided index in the elasticsearch instance. The deletion runs as
+        a server side task, without should_delete the matching blocks are only
+        counted.
         '''
-        self.logger.info("Deleting documents between heights {} and {}".format(start_height, end_height))
-        total_mismatch_list = []
-        for height in range(start_height, end_height+1, 1):
-            mismatches = []
-            query = "block_height:{}".format(height)
+        if should_delete:
+            self.logger.info("Deleting documents between heights {} and {}".format(start_height, end_height))
+            deleted = self.storage_controller.delete_by_range(index=index,
+                                                              start_height=start_height,
+                                                              end_height=end_height,
+                                                              requests_per_second=requests_per_second)
+            if deleted is None:
+                self.logger.error("Deleting documents failed.")
+                return
+            self.logger.info("Done deleting documents. Deleted {} documents in total.".format(deleted))
+            return
+
+        self.logger.info("Counting documents between heights {} and {}".format(start_height, end_height))
+        chunk_size = 1000
+        total_found = 0
+        missing_heights = []
+        for chunk_start in range(start_height, end_height+1, chunk_size):
+            heights = range(chunk_start, min(chunk_start+chunk_size, end_height+1))
             # get stored docs from es
-            results = self.es_controller.query_es(index=index, query=query)
-            self.logger.info("Found {} matches for block at height {}".format(len(results), height))
-            self.logger.debug("Looping over results.")
-            
-            for result in results:
-                doc_id = result["_id"]
-                height_from_doc = result["_source"]["block_height"]
-                self.logger.debug("Handling document: {} at height {}. Height in doc: {}".format(doc_id, height, height_from_doc))
-                if height_from_doc == height:
-                    #height matches, delete doc
-                    self.logger.debug("Height matches.")
-                    doc_type= "_doc"
-                    index_name = "blocks_from_scrapers_updated"
-                    if should_delete:
-                        self.es_controller.delete_doc(index=index_name, doc_type=doc_type, doc_id=doc_id)
-                else:
-                    self.logger.warning("Height doesn't match. Not deleting this document.")
-                    mismatches.append((height, doc_id))
-            self.logger.info("Found {} mismatches in height field for results at height {}.".format(len(mismatches), height))
-            total_mismatch_list.extend(mismatches)
-        self.logger.info("Done deleting documents.")
-        self.logger.info("Found {} mismatches in total".format(len(total_mismatch_list)))
-        self.logger.debug("Printing mismatches: {}".format(total_mismatch_list))
+            results = self.storage_controller.get_blocks_by_heights(heights=heights, index=index)
+            found = sum(len(results[height]) for height in heights)
+            missing_heights.extend(height for height in heights if not results[height])
+            self.logger.info("Found {} documents for heights {} up to {}".format(found, heights[0], heights[-1]))
+            total_found += found
+        self.logger.info("Found {} documents in total, use should_delete to delete them.".format(total_found))
+        self.logger.info("Found no stored documents for {} heights".format(len(missing_heights)))
+        self.logger.debug("Heights without documents: {}".format(missing_heights))
     
     
-    def reindexBlocksFromScraperData(self):
+    def reindexBlocksFromScraperData(self, requests_per_second=None, force_merge=True):
         '''
         Reindex existing block data from blocks_from_scrapers to updated
         blocks_from_scrapers_updated index.
@@ -615,10 +988,102 @@ class BMPIFunctions():
         new_index = "blocks_from_scrapers_updated"
         
         self.logger.info("Reindexing data from {} to {}".format(old_index, new_index))
-        self.es_controller.reindex_data(source_index=old_index, dest_index=new_index)
+        with self.storage_controller.bulk_ingest(index_names=[new_index], force_merge=force_merge):
+            self.storage_controller.reindex_data(source_index=old_index, dest_index=new_index, requests_per_second=requests_per_second)
         self.logger.info("Reindexing complete.")
         
+    
+    def migrateIndices(self, index=None):
+        '''
+        Moves the data of the given index, or of all indices, to a concrete
+        index with the current mapping version behind an alias.
+        '''
+        index_names = [index] if index else ElasticsearchIndexes.INDEX_NAMES
+        failed = []
+        for index_name in index_names:
+            self.logger.info("Migrating index {}".format(index_name))
+            if not self.storage_controller.migrate_index(index_name):
+                failed.append(index_name)
+        if failed:
+            self.logger.error("Migration failed for indices: {}".format(failed))
+        else:
+            self.logger.info("Migration complete.")
+        return not failed
+    
+    def dropAttributionRun(self, run_id):
+        '''
+        Removes all attribution results of a run by deleting its partition
+        of the block_attributions index.
+        '''
+        index = "block_attributions"
+        partition = self.storage_controller.get_partition_for_value(index_name=index, value=run_id)
+        if partition is None:
+            self.logger.warning("No partition found for run_id: {}".format(run_id))
+            return False
+        return self.storage_controller.drop_partition(index_name=index, partition=partition)
+    
+    def dropBlockPartition(self, block_height):
+        '''
+        Removes all stored blocks in the height partition that contains block_height.
+        '''
+        index = "blocks_from_scrapers_updated"
+        partition = self.storage_controller.get_partition_for_value(index_name=index, value=block_height)
+        if partition is None:
+            self.logger.warning("No partition found for height: {}".format(block_height))
+            return False
+        return self.storage_controller.drop_partition(index_name=index, partition=partition)
+    
+    def trackTasks(self, task_id=None):
+        '''
+        Polls the progress of a server side task, or of all tasks submitted by
+        this application that were not tracked to completion, until they are done.
+        Returns a dict that maps the tracked task ids to "completed" or "failed".
+        '''
+        self.storage_controller.require(StorageController.SERVER_SIDE_TASKS, "Tracking tasks")
+        task_ids = [task_id] if task_id else list(self.storage_controller.get_pending_tasks())
+        if not task_ids:
+            self.logger.info("No pending tasks found.")
+        outcomes = {}
+        for pending_task_id in task_ids:
+            result = self.storage_controller.wait_for_task(pending_task_id)
+            outcomes[pending_task_id] = "failed" if result is None else "completed"
+            self.logger.info("Task {} finished: {}".format(pending_task_id, outcomes[pending_task_id]))
+        return outcomes
         
+        
+    def printPoolStatistics(self, statistic, run_id, field="My_updated_attribution", compare_field=None,
+                            interval="month", start_height=None, end_height=None):
+        # Prints a pool statistic of an attribution run, see analytics.py
+        self.storage_controller.require(StorageController.AGGREGATIONS, "Pool statistics")
+        analytics = PoolAnalytics(es_controller=self.storage_controller, logger=self.logger)
+        
+        if statistic == "pool_share":
+            table = analytics.pool_share(run_id=run_id, field=field, start_height=start_height, end_height=end_height)
+        elif statistic == "blocks_per_period":
+            table = analytics.blocks_per_pool_per_period(run_id=run_id, field=field, interval=interval,
+                                                         start_height=start_height, end_height=end_height)
+        elif statistic == "agreement":
+            table = analytics.attribution_agreement(run_id=run_id, field=field, compare_field=compare_field or "My_updated_attribution",
+                                                    start_height=start_height, end_height=end_height)
+        else:
+            raise ValueError("Unknown statistic: {}".format(statistic))
+        
+        print(format_table(table))
+        if "summary" in table:
+            print(json.dumps(table["summary"], indent=4))
+    
+    def rebuildRollups(self, run_id):
+        self.storage_controller.require(StorageController.AGGREGATIONS, "Rollups")
+        rollup = PoolRollup(es_controller=self.storage_controller, logger=self.logger)
+        rollup.rebuild(run_id=run_id)
+    
+    def printPoolShareHistory(self, run_id, field="My_updated_attribution", interval="month", start_day=None, end_day=None):
+        # Prints the share of every pool per period, read from the rollup index
+        self.storage_controller.require(StorageController.AGGREGATIONS, "Rollups")
+        rollup = PoolRollup(es_controller=self.storage_controller, logger=self.logger)
+        print(format_table(rollup.pool_share_history(run_id=run_id, field=field, interval=interval,
+                                                     start_day=start_day, end_day=end_day)))
+    
     def printScrapers(self):
         self.logger.info("Printing scrapers for testing purposes.")
         for scraper in self.scraper_controller.scrapers:
@@ -630,9 +1095,14 @@ class BMPIFunctions():
     
     def deleteDocByID(self, index, doc_id):
         self.logger.info("Deleting document [{}] from index [{}]".format(doc_id, index))
-        self.es_controller.delete_doc(index=index, doc_type="_doc", doc_id=doc_id)
+        self.storage_controller.delete_doc(index=index, doc_type="_doc", doc_id=doc_id)
         self.logger.info("Document deleted.")
         
+    def compileKnownPools(self):
+        # Writes the known-pools snapshot, see pool_snapshot.py
+        block_analyser = BlockAnalyser(config=self.config, logger=self.logger, use_snapshot=False)
+        return block_analyser.compileSnapshot()
+    
     def compilePoolNameFiles(self):
         # load pools.json in vars
         
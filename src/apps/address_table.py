@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+A class file for a compact table of payout addresses.
+
+AddressTable stores, per payout address, which attribution sources know the
+address and the pool id every source attributes it to. Instead of a dict with
+the address strings as keys, the addresses are hashed to 64-bit keys that are
+kept in a sorted array, with the source bitmask and the pool ids in parallel
+arrays:
+
+    keys      [k0, k1, k2, ...]                     8 bytes per address
+    masks     [m0, m1, m2, ...]                     1 byte per address
+    pool_ids  [k0 source 0, k0 source 1, ...]       4 bytes per address and source
+
+which is about 30 bytes per address instead of the few hundred bytes of a
+string key and its dict entry. The arrays hold no Python objects, so worker
+processes forked from the process that built the table share its pages.
+The arrays can also be memoryviews of a memory mapped file, see from_buffers().
+
+Two different addresses hashing to the same key are not told apart. With
+64-bit keys the chance of this is negligible for the number of known addresses.
+
+@author: Mischa van Reede
+"""
+
+import hashlib
+from array import array
+from bisect import bisect_left
+
+
+class AddressTable():
+
+    # Pool id of a source that does not know the address
+    NO_POOL = -1
+
+
+    def __init__(self, source_count, entries=()):
+        """
+        Parameters
+        ----------
+        source_count : int
+            Number of attribution sources, at most 8.
+        entries : iterable of (address, source, pool_id), optional
+            Initial entries, see add().
+
+        """
+        if not 0 < source_count <= 8:
+            raise ValueError("An address table supports 1 to 8 sources, got {}".format(source_count))
+        self.source_count = source_count
+
+        self.__keys = array('Q')
+        self.__masks = array('B')
+        self.__pool_ids = array('i')
+        self.__build(entries)
+
+    @classmethod
+    def from_buffers(cls, source_count, keys, masks, pool_ids):
+        """
+        Creates a table on the arrays returned by buffers(), e.g. memoryviews
+        (cast to 'Q', 'B' and 'i') of a memory mapped file. The buffers are
+        copied to arrays on the first add().
+        """
+        table = cls(source_count)
+        table.__keys = keys
+        table.__masks = masks
+        table.__pool_ids = pool_ids
+        return table
+
+    def buffers(self):
+        # The keys, masks and pool ids arrays
+        return self.__keys, self.__masks, self.__pool_ids
+
+    @staticmethod
+    def address_key(address):
+        # 64-bit key of an address
+        return int.from_bytes(hashlib.blake2b(address.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def __build(self, entries):
+        # Collects the entries per key first, sorting once is faster than inserting one by one.
+        rows = {}
+        for address, source, pool_id in entries:
+            key = self.address_key(address)
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = [0] + [self.NO_POOL] * self.source_count
+            row[0] |= 1 << source
+            row[1 + source] = pool_id
+        for key in sorted(rows):
+            row = rows[key]
+            self.__keys.append(key)
+            self.__masks.append(row[0])
+            self.__pool_ids.extend(row[1:])
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __contains__(self, address):
+        return self.__index(self.address_key(address)) is not None
+
+    def __index(self, key):
+        index = bisect_left(self.__keys, key)
+        if index < len(self.__keys) and self.__keys[index] == key:
+            return index
+        return None
+
+    def __entry(self, index):
+        start = index * self.source_count
+        return self.__masks[index], self.__pool_ids[start:start + self.source_count]
+
+    def add(self, address, source, pool_id):
+        """
+        Sets the pool id of source for address. Inserting shifts the arrays,
+        use the constructor to add many addresses at once.
+        """
+        if not isinstance(self.__keys, array):
+            self.__keys = array('Q', self.__keys)
+            self.__masks = array('B', self.__masks)
+            self.__pool_ids = array('i', self.__pool_ids)
+        key = self.address_key(address)
+        index = bisect_left(self.__keys, key)
+        if index == len(self.__keys) or self.__keys[index] != key:
+            self.__keys.insert(index, key)
+            self.__masks.insert(index, 0)
+            start = index * self.source_count
+            self.__pool_ids[start:start] = array('i', [self.NO_POOL] * self.source_count)
+        self.__masks[index] |= 1 << source
+        self.__pool_ids[index * self.source_count + source] = pool_id
+
+    def get(self, address):
+        """
+        Returns
+        -------
+        entry : (int, array) or None
+            Bitmask of the sources that know the address and the pool id per
+            source (NO_POOL for the other sources), None for unknown addresses.
+
+        """
+        index = self.__index(self.address_key(address))
+        return None if index is None else self.__entry(index)
+
+    def get_many(self, addresses):
+        """
+        Looks up a batch of addresses in one merge pass over the sorted keys.
+
+        Returns
+        -------
+        entries : list
+            The entry of every address as returned by get(), in the order of addresses.
+
+        """
+        keys = [self.address_key(address) for address in addresses]
+        found = {}
+        low = 0
+        for key in sorted(set(keys)):
+            low = bisect_left(self.__keys, key, low)
+            if low < len(self.__keys) and self.__keys[low] == key:
+                found[key] = self.__entry(low)
+        return [found.get(key) for key in keys]
+
+    def nbytes(self):
+        # Memory used by the arrays
+        return sum(len(values) * values.itemsize for values in [self.__keys, self.__masks, self.__pool_ids])
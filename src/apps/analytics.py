@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+A class file with pool statistics over the block_attributions index.
+
+The statistics are computed by Elasticsearch aggregations (terms,
+date_histogram, filters) on the documents of a single attribution run, so
+no documents are transferred to the client. Every statistic is returned as
+a compact table: a dict with a list of column names and a list of rows.
+
+@author: Mischa van Reede
+"""
+
+
+ATTRIBUTION_FIELDS = ["0xB10C_attribution",
+                      "Blockchain_com_attribution",
+                      "BTC_com_attribution",
+                      "My_initial_attribution",
+                      "My_updated_attribution"]
+
+UNKNOWN_POOL = "Unknown"
+
+
+def format_table(table):
+    # Returns the table as tab separated text, e.g. to print it.
+    lines = ["\t".join(table["columns"])]
+    lines.extend("\t".join(str(value) for value in row) for row in table["rows"])
+    return "\n".join(lines)
+
+
+class PoolAnalytics():
+
+
+    def __init__(self, es_controller, logger, index="block_attributions"):
+        self.es_controller = es_controller
+        self.logger = logger
+        self.index = index
+
+    def __search_index(self, run_id):
+        # Only the partition of the run has to be searched, falls back to the alias.
+        return self.es_controller.get_partition_for_value(self.index, run_id) or self.index
+
+    def __filters(self, run_id, start_height, end_height):
+        filters = [{"term": {"run_id": run_id}}]
+        height_range = {}
+        if start_height is not None:
+            height_range["gte"] = start_height
+        if end_height is not None:
+            height_range["lte"] = end_height
+        if height_range:
+            filters.append({"range": {"block_height": height_range}})
+        return filters
+
+    def __check_field(self, field):
+        if field not in ATTRIBUTION_FIELDS:
+            raise ValueError("Unknown attribution field: {}, use one of {}".format(field, ATTRIBUTION_FIELDS))
+
+    def __aggregate(self, run_id, start_height, end_height, aggs):
+        self.logger.debug("Aggregating attributions of run [{}] between heights {} and {}".format(run_id, start_height, end_height))
+        return self.es_controller.aggregate(index=self.__search_index(run_id),
+                                            aggs=aggs,
+                                            filters=self.__filters(run_id, start_height, end_height))
+
+    #============================================
+    # Statistics
+    #============================================
+
+    def pool_share(self, run_id, field="My_updated_attribution", start_height=None, end_height=None, max_pools=500):
+        """
+        Number of blocks, share of the blocks and block rewards per pool.
+
+        Parameters
+        ----------
+        run_id : string
+            Attribution run to compute the statistic for.
+        field : string
+            Attribution field that holds the pool name, see ATTRIBUTION_FIELDS.
+        start_height, end_height : int, optional
+            Only count blocks in this height range (inclusive).
+        max_pools : int
+            Maximum number of pools returned, ordered by number of blocks.
+
+        Returns
+        -------
+        table : dict
+            Columns pool, blocks, share, total_block_reward, fee_block_reward.
+
+        """
+        self.__check_field(field)
+        aggregations = self.__aggregate(run_id, start_height, end_height, {
+            "pools": {
+                "terms": {"field": field, "size": max_pools},
+                "aggs": {
+                    "total_block_reward": {"sum": {"field": "total_block_reward"}},
+                    "fee_block_reward": {"sum": {"field": "fee_block_reward"}}
+                    }
+                },
+            "blocks": {"value_count": {"field": "block_height"}}
+            })
+        total_blocks = aggregations["blocks"]["value"]
+        rows = [[bucket["key"],
+                 bucket["doc_count"],
+                 round(bucket["doc_count"] / total_blocks, 6) if total_blocks else 0,
+                 int(bucket["total_block_reward"]["value"]),
+                 int(bucket["fee_block_reward"]["value"])]
+                for bucket in aggregations["pools"]["buckets"]]
+        return {"columns": ["pool", "blocks", "share", "total_block_reward", "fee_block_reward"], "rows": rows}
+
+    def blocks_per_pool_per_period(self, run_id, field="My_updated_attribution", interval="month", start_height=None, end_height=None, max_pools=500):
+        """
+        Number of blocks and block rewards per pool per calendar interval.
+
+        Parameters
+        ----------
+        interval : string
+            Calendar interval of a period: day, week, month, quarter or year.
+        Other parameters as in pool_share.
+
+        Returns
+        -------
+        table : dict
+            Columns period, pool, blocks, total_block_reward. Periods are
+            formatted as yyyy-MM-dd (first day of the period).
+
+        """
+        self.__check_field(field)
+        aggregations = self.__aggregate(run_id, start_height, end_height, {
+            "periods": {
+                "date_histogram": {
+                    "field": "timestamp",
+                    "calendar_interval": interval,
+                    "format": "yyyy-MM-dd",
+                    "min_doc_count": 1
+                    },
+                "aggs": {
+                    "pools": {
+                        "terms": {"field": field, "size": max_pools},
+                        "aggs": {"total_block_reward": {"sum": {"field": "total_block_reward"}}}
+                        }
+                    }
+                }
+            })
+        rows = [[period["key_as_string"], pool["key"], pool["doc_count"], int(pool["total_block_reward"]["value"])]
+                for period in aggregations["periods"]["buckets"]
+                for pool in period["pools"]["buckets"]]
+        return {"columns": ["period", "pool", "blocks", "total_block_reward"], "rows": rows}
+
+    def attribution_agreement(self, run_id, field="0xB10C_attribution", compare_field="My_updated_attribution", start_height=None, end_height=None, max_pools=500):
+        """
+        Agreement matrix of two attribution fields: the number of blocks per
+        combination of pool names, with the share of blocks both agree on and
+        the number of blocks each field leaves unknown.
+
+        Returns
+        -------
+        table : dict
+            Columns <field>, <compare_field>, blocks for every combination of
+            pool names that occurs, and a summary dict with the keys blocks,
+            agreeing_blocks, agreement, <field>_unknown and <compare_field>_unknown.
+
+        """
+        self.__check_field(field)
+        self.__check_field(compare_field)
+        aggregations = self.__aggregate(run_id, start_height, end_height, {
+            "matrix": {
+                "terms": {"field": field, "size": max_pools},
+                "aggs": {
+                    "compared": {"terms": {"field": compare_field, "size": max_pools}}
+                    }
+                },
+            "summary": {
+                "filters": {
+                    "filters": {
+                        "blocks": {"match_all": {}},
+                        "agreeing_blocks": {"script": {"script": {
+                            "source": "doc[params.field].size() > 0 && doc[params.compare_field].size() > 0 && doc[params.field].value == doc[params.compare_field].value",
+                            "params": {"field": field, "compare_field": compare_field}
+                            }}},
+                        field + "_unknown": {"term": {field: UNKNOWN_POOL}},
+                        compare_field + "_unknown": {"term": {compare_field: UNKNOWN_POOL}}
+                        }
+                    }
+                }
+            })
+        rows = [[bucket["key"], compared["key"], compared["doc_count"]]
+                for bucket in aggregations["matrix"]["buckets"]
+                for compared in bucket["compared"]["buckets"]]
+        summary = {name: bucket["doc_count"] for name, bucket in aggregations["summary"]["buckets"].items()}
+        summary["agreement"] = round(summary["agreeing_blocks"] / summary["blocks"], 6) if summary["blocks"] else 0
+        return {"columns": [field, compare_field, "blocks"], "rows": rows, "summary": summary}
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+A class file used to interact with the elasticsearch instance from an asyncio event loop.
+
+Offers the same store, bulk store, streaming search and delete operations as
+ElasticsearchController on the AsyncElasticsearch client, so storage requests
+can run concurrently with (network bound) scraping. Index creation and the
+routing of records to partitions is left to the synchronous controller: the
+caller resolves the write index of every record with
+ElasticsearchController.get_write_index in its own thread, before handing the
+records to the event loop, so the loop never makes blocking requests.
+
+Requires the aiohttp package.
+
+@author: Mischa van Reede
+"""
+
+import time
+import asyncio
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_bulk, async_streaming_bulk
+
+from .elastic import ElasticsearchController
+
+
+class AsyncElasticsearchController():
+
+
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.es_connection = self.__connect_elasticsearch()
+        # Seconds writers wait for an index that migrate_index made read-only
+        self.write_block_timeout = self.config.getint('Elasticsearch', 'write_block_timeout', fallback=3600)
+
+
+    def __connect_elasticsearch(self):
+        """
+        Creates an AsyncElasticsearch client using the specified values from the config file.
+        The connection is opened on the first request.
+
+        Returns
+        -------
+        es : AsyncElasticsearch Object
+
+        """
+        es_host = self.config.get('Elasticsearch', 'elasticsearch_host')
+        es_port = self.config.get('Elasticsearch', 'elasticsearch_port')
+        credentials = {'http_auth': (self.config.get('Elasticsearch', 'user'), self.config.get('Elasticsearch', 'password'))}
+
+        self.logger.debug("Creating async Elasticsearch client for: {host}/{port}".format(host=es_host, port=es_port))
+        return AsyncElasticsearch([{'host': es_host, 'port': es_port}], **credentials)
+
+    async def close(self):
+        await self.es_connection.close()
+        self.logger.debug("Async Elasticsearch client closed.")
+
+    #============================================
+    # Methods for interacting with the instance
+    #============================================
+    async def store(self, record, write_index):
+        """
+            Store a data record in a specified index
+
+        Parameters
+        ----------
+        record : dict
+        write_index : string
+            Concrete index (partition) to store the record in, see ElasticsearchController.get_write_index.
+
+        Returns
+        -------
+        is_stored : Boolean
+            True if record is stored succesfully.
+        """
+        target_index = write_index
+        max_tries = 5
+        write_block_deadline = None
+        try_count = 0
+        while try_count < max_tries:
+            try:
+                self.logger.debug("Storing object in index: {}".format(target_index))
+                await self.es_connection.index(index=target_index, body=record)
+                return True
+            except Exception as ex:
+                if ElasticsearchController.is_write_block(ex):
+                    write_block_deadline = write_block_deadline or time.monotonic() + self.write_block_timeout
+                    if time.monotonic() < write_block_deadline:
+                        self.logger.info("Index [{}] is read-only while it is migrated, waiting to store the document.".format(target_index))
+                        await asyncio.sleep(1)
+                        continue
+                try_count += 1
+                self.logger.error("An error occurred when storing the document: {}".format(str(ex)))
+                self.logger.info("Trying to store data again. Attempt {} out of {}".format(try_count, max_tries))
+                await asyncio.sleep(1)
+        self.logger.error("All {} attemps to store the record failed. Skip trying to store this record".format(max_tries))
+        return False
+
+    async def bulk_store(self, records, index_name, write_indices):
+        """
+        Stores many records in one go. Only the records that failed are sent
+        again, records that were stored are not duplicated by a retry.
+
+        Parameters
+        ----------
+        records : list of dicts
+        index_name : string
+            Index (alias) the records belong to, used for logging.
+        write_indices : list of strings
+            Concrete index (partition) of every record, see ElasticsearchController.get_write_index.
+
+        Returns
+        -------
+        failed_records : list
+            Records that could not be stored, empty if all records are stored succesfully.
+        """
+        actions = [
+            {
+                "_index": write_index,
+                "_source": record
+            }
+            for record, write_index in zip(records, write_indices)
+        ]
+
+        max_tries = 5
+        write_block_deadline = None
+        try_count = 0
+        while try_count < max_tries:
+            self.logger.info("Storing [{}] records in index: [{}]".format(len(actions), index_name))
+            failed_actions = []
+            write_blocked = False
+            position = 0
+            try:
+                # Results are yielded in the order of the actions
+                results = async_streaming_bulk(self.es_connection, actions=actions, raise_on_error=False, raise_on_exception=False)
+                async for ok, item in results:
+                    if not ok:
+                        failed_actions.append(actions[position])
+                        write_blocked = write_blocked or ElasticsearchController.is_write_block(item)
+                    position += 1
+            except Exception as ex:
+                self.logger.error("An error occurred when storing the documents: {}".format(str(ex)))
+                # Results of the actions after position are unknown
+                failed_actions.extend(actions[position:])
+                write_blocked = ElasticsearchController.is_write_block(ex)
+            if not failed_actions:
+                self.logger.debug("Storing records was succesful")
+                return []
+            actions = failed_actions
+            if write_blocked:
+                write_block_deadline = write_block_deadline or time.monotonic() + self.write_block_timeout
+                if time.monotonic() < write_block_deadline:
+                    self.logger.info("Index [{}] is read-only while it is migrated, waiting to store {} documents.".format(index_name, len(actions)))
+                    await asyncio.sleep(1)
+                    continue
+            try_count += 1
+            self.logger.error("Failed to store {} documents.".format(len(actions)))
+            self.logger.info("Trying to store the failed documents again. Attempt {} out of {}".format(try_count, max_tries))
+            await asyncio.sleep(1)
+        self.logger.error("All {} attemps to store the record failed.".format(max_tries))
+        return [action["_source"] for action in actions]
+
+    async def iter_blocks(self, start_height, end_height, fields=None, index="blocks_from_scrapers_updated", page_size=5000, keep_alive="5m"):
+        """
+        Async generator version of ElasticsearchController.iter_blocks, yields the stored
+        blocks with start_height <= block_height <= end_height ordered by height.
+
+        """
+        self.logger.debug("Streaming blocks between heights {} and {} from index [{}]".format(start_height, end_height, index))
+        # Searches all partitions, shards without blocks in the range are skipped by the range filter
+        pit_id = (await self.es_connection.open_point_in_time(index=index, keep_alive=keep_alive))["id"]
+        body = {
+            "size": page_size,
+            "query": {
+                "bool": {
+                    "filter": [{"range": {"block_height": {"gte": start_height, "lte": end_height}}}]
+                    }
+                },
+            "sort": [{"block_height": "asc"}, {"block_hash": "asc"}],
+            "track_total_hits": False,
+            "pit": {"id": pit_id, "keep_alive": keep_alive}
+            }
+        if fields is not None:
+            body["_source"] = list(fields)
+
+        try:
+            while True:
+                response = await self.es_connection.search(body=body)
+                hits = response["hits"]["hits"]
+                for hit in hits:
+                    yield hit["_source"]
+                if len(hits) < page_size:
+                    break
+                pit_id = response.get("pit_id", pit_id)
+                body["pit"]["id"] = pit_id
+                body["search_after"] = hits[-1]["sort"]
+        finally:
+            await self.es_connection.close_point_in_time(body={"id": pit_id})
+        self.logger.debug("Done streaming blocks.")
+
+    async def delete_doc(self, index, doc_id):
+        """
+        Delete document with doc_id from specified index, from the concrete
+        index it is found in, see ElasticsearchController.delete_doc.
+
+        """
+        self.logger.debug("Deleting doc with id {} from index {}".format(doc_id, index))
+        response = await self.es_connection.search(index=index, body={"query": {"ids": {"values": [doc_id]}}, "_source": False})
+        hits = response["hits"]["hits"]
+        if not hits:
+            self.logger.warning("No document with id {} found in index {}".format(doc_id, index))
+            return
+        for hit in hits:
+            await self.es_connection.delete(index=hit["_index"], id=doc_id)
+        self.logger.debug("Doc deleted.")
+
+    async def bulk_delete(self, docs):
+        """
+        Deletes many documents, given as dicts with _index and _id, in one go.
+
+        Returns
+        -------
+        deleted : int
+            Number of deleted documents.
+
+        """
+        actions = [
+            {
+                "_op_type": "delete",
+                "_index": doc["_index"],
+                "_id": doc["_id"]
+            }
+            for doc in docs
+        ]
+        deleted, errors = await async_bulk(self.es_connection, actions=actions, raise_on_error=False)
+        if errors:
+            self.logger.error("Failed to delete {} documents: {}".format(len(errors), errors[:10]))
+        self.logger.debug("Deleted {} documents.".format(deleted))
+        return deleted
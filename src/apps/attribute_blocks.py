@@ -6,49 +6,62 @@
 """
 
 import json
-from .utils import Utils
+from collections import OrderedDict
+from .tag_matcher import TagMatcher
+from .address_table import AddressTable
+from .bloom_filter import BloomFilter
+from .pool_journal import PoolDataJournal
+from .pool_snapshot import SNAPSHOT_FILE, source_hashes, write_snapshot, load_snapshot
 
 class BlockAnalyser():
     
+    # Keys of the per source results of AttributePoolName, in the order of __datasets()
+    SOURCES = ["0xB10C", "Blockchain_com", "BTC_com", "My_initial_attribution", "My_updated_attribution"]
+    
+    # Name and file (relative to the known-pools directory) of the dataset of every source, in the order of SOURCES.
+    # External known pools file data, sources are in known-pools/sources
+    DATASET_FILES = [("0xB10C", "data/0xB10C.json"),
+                     ("Blockchain.com", "data/blockchain-com.json"),
+                     ("BTC.com", "data/btc-com.json"),
+                     ("My Data", "updated_pools.json"),
+                     ("My Updated Data", "updated_pools.json")]
       
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, memo_size=10000, known_pools_path="../known-pools/", use_snapshot=True):
         self.logger = logger
         self.config = config
+        self.known_pools_path = known_pools_path
         
-        # Load json file data into memory
+        # LRU memo of the per source results of AttributePoolName
+        self.memo_size = memo_size
+        self.__memo = OrderedDict()
+        self.__memo_hits = 0
+        self.__memo_misses = 0
         
-        # Known pools data base path
-        base_path = "../known-pools/"
-    
-        # External known pools file data, sources are in known-pools/sources
-        B10C_known_pools_file_path =            base_path + "data/0xB10C.json"
-        blockchain_com_known_pools_file_path =  base_path + "data/blockchain-com.json"
-        btc_com_known_pools_file_path =         base_path + "data/btc-com.json"
-    
-        # My pool data1
-        my_pools_file_path =  base_path + "updated_pools.json"
-        my_updated_pools_file_path =  base_path + "updated_pools.json"
+        # Journal of the entries added to my_pool_data, see __update_my_pool_data.
+        # It is kept next to the loaded known-pools files, only a BlockAnalyser that
+        # updates the pool data takes it, see openPoolDataJournal.
+        compact_interval = self.config.getint("KnownPools", "journal_compact_interval", fallback=60)
+        self.__pool_data_journal = PoolDataJournal(logger=self.logger,
+                                                   data_file_path=known_pools_path + "pools.json",
+                                                   compact_interval=compact_interval)
+        self.__owns_pool_data_journal = False
+        self.__pool_data_updated = False
         
-        B10C_data = {
-                "name": "0xB10C",
-                "data": self.__load_json(B10C_known_pools_file_path)
-            }
-        blockchain_data = {
-                "name": "Blockchain.com",
-                "data": self.__load_json(blockchain_com_known_pools_file_path)
-            }
-        btc_data = {
-                "name": "BTC.com",
-                "data": self.__load_json(btc_com_known_pools_file_path)
-            }
-        my_pool_data = {
-                "name": "My Data",
-                "data": self.__load_json(my_pools_file_path)
-            }
-        my_pool_data_updated = {
-                "name": "My Updated Data",
-                "data": self.__load_json(my_updated_pools_file_path)
+        # Load the compiled snapshot of the data if it is up to date (see pool_snapshot.py), json file data otherwise
+        snapshot = None
+        if use_snapshot:
+            snapshot = load_snapshot(snapshot_path=known_pools_path + SNAPSHOT_FILE, hashes=self.__sourceHashes(),
+                                     sources=self.__snapshotSources(), logger=self.logger)
+        if snapshot is not None:
+            datasets = snapshot["data"]["datasets"]
+        else:
+            datasets = [self.__load_json(known_pools_path + file_path) for _, file_path in self.DATASET_FILES]
+        B10C_data, blockchain_data, btc_data, my_pool_data, my_pool_data_updated = [
+            {
+                "name": name,
+                "data": data
             }
+            for (name, _), data in zip(self.DATASET_FILES, datasets)]
         
         # All data from external sources
         self.B10C_data = B10C_data
@@ -59,8 +72,134 @@ class BlockAnalyser():
         self.my_pool_data = my_pool_data
         self.my_pool_data_updated = my_pool_data_updated
         
+        if snapshot is not None:
+            for pool_data, tag_matcher in zip(self.__datasets(), snapshot["data"]["tag_matchers"]):
+                if tag_matcher is not None:
+                    pool_data["tag_matcher"] = TagMatcher.from_state(tag_matcher)
+            self.__loadUnifiedIndex(snapshot)
+        else:
+            for pool_data in self.__datasets():
+                self.__compileTagMatcher(pool_data)
+            self.__buildUnifiedIndex()
+        
         self.logger.info("BlockAnalyser object initialized.")
         
+    def __datasets(self):
+        return [self.B10C_data, self.blockchain_data, self.btc_data, self.my_pool_data, self.my_pool_data_updated]
+    
+    def __buildUnifiedIndex(self):
+        '''
+        Merges the coinbase tags and payout addresses of all datasets, so that
+        AttributePoolName finds the matches of all sources in a single pass.
+        Pool names are stored as ids, see __poolId.
+            - Every tag maps to a list of (source, rank of the tag in its dataset, pool id).
+            - Every address maps to (bitmask of the sources that know it, pool id per source),
+              in a compact AddressTable (see address_table.py).
+            - A Bloom filter over all addresses skips the table lookup of unknown addresses.
+        Only my_pool_data keeps its payout_addresses dict, it is written back to
+        pools.json. The dicts of the other datasets are released once they are in the table.
+        '''
+        self.__pool_ids = {}
+        self.__pool_names = []
+        self.__buildUnifiedTags()
+        self.__buildAddressFilter(self.__payoutAddresses())
+        self.__unified_addresses = AddressTable(len(self.SOURCES), self.__addressEntries())
+        for pool_data in self.__datasets():
+            if pool_data is not self.my_pool_data and pool_data["data"] is not None:
+                pool_data["data"].pop("payout_addresses")
+        self.logger.debug("Unified index holds {} tags and {} addresses ({} bytes) of {} pools.".format(
+            len(self.__unified_tags), len(self.__unified_addresses), self.__unified_addresses.nbytes(), len(self.__pool_names)))
+    
+    def __addressEntries(self):
+        for source, pool_data in enumerate(self.__datasets()):
+            if pool_data["data"] is None:
+                continue
+            for address, record in pool_data["data"]["payout_addresses"].items():
+                yield address, source, self.__poolId(record["name"])
+    
+    def __payoutAddresses(self, datasets=None):
+        # Sorted payout addresses of all datasets, before they are released
+        addresses = set()
+        for data in datasets or [pool_data["data"] for pool_data in self.__datasets()]:
+            if data is not None:
+                addresses.update(data["payout_addresses"])
+        return sorted(addresses)
+    
+    def __sourcePayoutAddresses(self):
+        # The payout_addresses of most datasets are released, read them again from the known-pools files
+        return self.__payoutAddresses([self.__load_json(self.known_pools_path + file_path) for _, file_path in self.DATASET_FILES])
+    
+    def __buildAddressFilter(self, payout_addresses):
+        # Sized for twice the known addresses, room for the addresses added by __update_my_pool_data
+        self.__address_filter = BloomFilter(capacity=2 * len(payout_addresses) + 1000, error_rate=0.01)
+        self.__address_filter.update(payout_addresses)
+    
+    def __loadUnifiedIndex(self, snapshot):
+        # The unified index of a snapshot made by compileSnapshot. The address
+        # filter depends on the hash seed of the process, it is built again.
+        data = snapshot["data"]
+        self.__pool_names = data["pool_names"]
+        self.__pool_ids = {pool_name: pool_id for pool_id, pool_name in enumerate(self.__pool_names)}
+        self.__unified_tags = data["unified_tags"]
+        self.__unified_tag_matcher = TagMatcher.from_state(data["tag_matcher"])
+        self.__buildAddressFilter(data["payout_addresses"])
+        self.__unified_addresses = AddressTable.from_buffers(len(self.SOURCES), snapshot["keys"], snapshot["masks"], snapshot["pool_ids"])
+    
+    def __snapshotSources(self):
+        # Sources and their dataset files, a snapshot is only loaded if they did not change
+        return [[source, file_path] for source, (_, file_path) in zip(self.SOURCES, self.DATASET_FILES)]
+    
+    def __sourceHashes(self):
+        return source_hashes(self.known_pools_path, sorted({file_path for _, file_path in self.DATASET_FILES}))
+    
+    def compileSnapshot(self):
+        '''
+        Writes the datasets and the unified index to known-pools/pools.snapshot,
+        which is loaded instead of the json files as long as they do not change.
+        Call on a BlockAnalyser of which the pool data was not updated.
+        '''
+        if self.__pool_data_updated:
+            raise RuntimeError("The pool data of this BlockAnalyser was updated, it does not match the known-pools files.")
+        snapshot_path = self.known_pools_path + SNAPSHOT_FILE
+        keys, masks, pool_ids = self.__unified_addresses.buffers()
+        write_snapshot(snapshot_path=snapshot_path,
+                       hashes=self.__sourceHashes(),
+                       sources=self.__snapshotSources(),
+                       arrays={"keys": keys, "masks": masks, "pool_ids": pool_ids},
+                       data={
+                           "datasets": [pool_data["data"] for pool_data in self.__datasets()],
+                           "tag_matchers": [pool_data["tag_matcher"].state() if pool_data["data"] is not None else None
+                                            for pool_data in self.__datasets()],
+                           "pool_names": self.__pool_names,
+                           "unified_tags": self.__unified_tags,
+                           "tag_matcher": self.__unified_tag_matcher.state(),
+                           "payout_addresses": self.__sourcePayoutAddresses()
+                           })
+        self.logger.info("Compiled known-pools data to [{}]".format(snapshot_path))
+        return snapshot_path
+    
+    def __buildUnifiedTags(self):
+        # Has to be called again when coinbase tags change, the pool ids are kept.
+        self.__unified_tags = {}
+        for source, pool_data in enumerate(self.__datasets()):
+            if pool_data["data"] is None:
+                continue
+            for rank, (tag, record) in enumerate(pool_data["data"]["coinbase_tags"].items()):
+                self.__unified_tags.setdefault(tag, []).append((source, rank, self.__poolId(record["name"])))
+        self.__unified_tag_matcher = TagMatcher(self.__unified_tags)
+    
+    def __poolId(self, pool_name):
+        if pool_name not in self.__pool_ids:
+            self.__pool_ids[pool_name] = len(self.__pool_names)
+            self.__pool_names.append(pool_name)
+        return self.__pool_ids[pool_name]
+    
+    def __compileTagMatcher(self, pool_data):
+        # Matches all coinbase tags of a dataset in one pass, see tag_matcher.py.
+        # Has to be called again when the coinbase tags of the dataset change.
+        if pool_data["data"] is not None:
+            pool_data["tag_matcher"] = TagMatcher(pool_data["data"]["coinbase_tags"])
+    
     def __load_json(self, file_path):
         self.logger.debug("Trying to load [{}] file into memory.".format(file_path))  
         try:
@@ -73,15 +212,13 @@ class BlockAnalyser():
             return None
         
     def __update_my_pool_data(self, entry_key, record, record_type):
-
-        my_data_updated = False
+        # New entries are journaled and folded into the in memory data at once,
+        # the journal is written to pools.json in the known-pools directory by __compactPoolDataJournal.
  
         if record_type == "payout_addresses":
             
             if entry_key not in self.my_pool_data['data']["payout_addresses"]:
                 self.logger.info("Adding payout address [{}] to pools.json for pool {}.".format(entry_key, record['name']))
-                self.my_pool_data['data']["payout_addresses"][entry_key] = record
-                my_data_updated = True
                 
             else:
                 self.logger.debug("Entry {} already exists".format(entry_key))
@@ -91,8 +228,6 @@ class BlockAnalyser():
             
             if entry_key not in self.my_pool_data['data']["coinbase_tags"]:
                 self.logger.info("Adding coinbase_tag {} to my_pool_data.".format(entry_key))
-                self.my_pool_data['data']["coinbase_tags"][entry_key] = record
-                my_data_updated = True
                 
             else:
                 self.logger.debug("Entry {} already exists".format(entry_key))
@@ -101,48 +236,95 @@ class BlockAnalyser():
         else:
             self.logger.error("Record type not supported: {}".format(record_type))
             return
-               
-        if my_data_updated:
-            self.logger.info("Writing changes to known-pools/pools.json file")
-            current_path = Utils.getCurrentPath()
-            with open(current_path + '/../known-pools/pools.json', mode='w', encoding='utf-8') as outfile:
-                json.dump(self.my_pool_data['data'], outfile, sort_keys=True, indent=4)
-                self.logger.info("known-pools/pools.json file updated.")
+        
+        self.openPoolDataJournal()
+        self.__pool_data_journal.append(record_type=record_type, key=entry_key, record=record)
+        self.__addMyPoolDataEntry(entry_key, record, record_type)
         return
     
+    def __addMyPoolDataEntry(self, entry_key, record, record_type):
+        # Adds an entry to my_pool_data and the unified index.
+        self.my_pool_data['data'][record_type][entry_key] = record
+        self.__pool_data_updated = True
+        if record_type == "payout_addresses":
+            self.__unified_addresses.add(address=entry_key,
+                                         source=self.SOURCES.index("My_initial_attribution"),
+                                         pool_id=self.__poolId(record['name']))
+            self.__address_filter.add(entry_key)
+            if self.__address_filter.count >= self.__address_filter.capacity:
+                # More addresses would raise the false positive rate, rebuild it with room for as many again
+                self.logger.info("Payout address filter is full, rebuilding it.")
+                self.__buildAddressFilter(sorted(set(self.__sourcePayoutAddresses()) | set(self.my_pool_data['data']['payout_addresses'])))
+        else:
+            self.__compileTagMatcher(self.my_pool_data)
+            self.__buildUnifiedTags()
+        self.clearMemo()
+    
+    def openPoolDataJournal(self):
+        '''
+        Makes this BlockAnalyser the writer of the pool data journal, until
+        persistMyPoolData. Entries left by an update run that did not finish are
+        added and written to pools.json first. Called by the first update, call it
+        before updating to attribute with those entries from the start.
+        BlockAnalysers that only attribute do not take the journal.
+        '''
+        if self.__owns_pool_data_journal:
+            return
+        if not self.__pool_data_journal.acquire():
+            raise RuntimeError("Another process updates the pool data in {}.".format(self.__pool_data_journal.data_file_path))
+        self.__owns_pool_data_journal = True
+        for record_type, entry_key, record in self.__pool_data_journal.replay():
+            self.__addMyPoolDataEntry(entry_key, record, record_type)
+        self.__compactPoolDataJournal()
+    
+    def __compactPoolDataJournal(self):
+        self.__pool_data_journal.compact(self.my_pool_data['data'])
+    
+    def persistMyPoolData(self):
+        # Writes the journaled entries to pools.json and releases the journal, call when done updating.
+        if self.__owns_pool_data_journal:
+            self.__compactPoolDataJournal()
+            self.__pool_data_journal.close()
+            self.__owns_pool_data_journal = False
+    
     def __getPoolNameFromData(self, coinbase_message, payout_addresses, pool_data, update_data):
         
-        pool_name_attribution = {
-            "pool_name": None,
-            "multiple_matches": False,
-            "payout_addresses_matches": None,
-            "coinbase_tag_matches": None
-            }
-        
         payout_address_matches = set()
         coinbase_tag_matches = set()
         
-        found_address_match = False
-        found_tag_match = False
-        
         self.logger.debug("Finding pool name using data from: {}".format(pool_data['name']))
+        tag_matcher = pool_data['tag_matcher']
         pool_data = pool_data['data']
         
         # Find matches
         #self.logger.debug("Looking for payout address matches.")
         for payout_address in payout_addresses:
             if payout_address in pool_data['payout_addresses']:
-                found_address_match = True
                 pool_name = pool_data["payout_addresses"][payout_address]["name"]
                 payout_address_matches.add(pool_name)
         
         #self.logger.debug("Looking for coinbase tag matches.")
-        for tag in pool_data["coinbase_tags"]:
-            
-            if tag in coinbase_message:
-                found_tag_match = True
-                pool_name = pool_data["coinbase_tags"][tag]["name"]
-                coinbase_tag_matches.add(pool_name)
+        for tag in tag_matcher.match(coinbase_message):
+            pool_name = pool_data["coinbase_tags"][tag]["name"]
+            coinbase_tag_matches.add(pool_name)
+        
+        return self.__resolvePoolName(payout_address_matches=payout_address_matches,
+                                      coinbase_tag_matches=coinbase_tag_matches,
+                                      payout_addresses=payout_addresses,
+                                      update_data=update_data)
+    
+    def __resolvePoolName(self, payout_address_matches, coinbase_tag_matches, payout_addresses, update_data):
+        # Determines the pool name from the pool names matched by payout address and by coinbase tag.
+        
+        pool_name_attribution = {
+            "pool_name": None,
+            "multiple_matches": False,
+            "payout_addresses_matches": None,
+            "coinbase_tag_matches": None
+            }
+        
+        found_address_match = len(payout_address_matches) > 0
+        found_tag_match = len(coinbase_tag_matches) > 0
                 
         # Handle matches
         if not found_address_match and not found_tag_match:
@@ -212,45 +394,116 @@ class BlockAnalyser():
             return pool_name_attribution
      
     
+    def getPoolNames(self):
+        # Returns the set of all pool names AttributePoolName can return.
+        return {"Unknown"} | set(self.__pool_names)
+    
     def updateMyPoolData(self, coinbase_message, payout_addresses, update_data):
         # Wrapped function call to call this method from outside and use only my_pool_data variable
         # Should update pools.json if new payout address is encoutered and update_data is True.
         _ = self.__getPoolNameFromData(coinbase_message, payout_addresses, self.my_pool_data, update_data)
+        # Checked on every call, so journaled entries are written on schedule also when no new ones are found.
+        if self.__owns_pool_data_journal and self.__pool_data_journal.compaction_due():
+            self.__compactPoolDataJournal()
         return     
     
+    def clearMemo(self):
+        # Has to be called when the pool data changes.
+        self.__memo.clear()
+    
+    def memoStatistics(self):
+        return {"hits": self.__memo_hits, "misses": self.__memo_misses, "size": len(self.__memo)}
+    
     def AttributePoolName(self, coinbase_message, payout_addresses):
         self.logger.debug("Attributing pool name using various pool_data files.")
+        matched_tags = self.__unified_tag_matcher.match(coinbase_message)
+        candidates = [payout_address for payout_address in payout_addresses if payout_address in self.__address_filter]
+        
+        # The results only depend on the matched tags and the addresses that may be known.
+        # Blocks of a pool usually share both, while the extranonce in the message changes.
+        memo_key = (tuple(matched_tags), frozenset(candidates))
+        source_results = self.__memo.get(memo_key)
+        if source_results is not None:
+            self.__memo.move_to_end(memo_key)
+            self.__memo_hits += 1
+        else:
+            self.__memo_misses += 1
+            source_results = self.__attributeMatches(matched_tags, candidates)
+            self.__memo[memo_key] = source_results
+            if len(self.__memo) > self.memo_size:
+                self.__memo.popitem(last=False)
+        
         results = {
             "coinbase_message": coinbase_message,
-            "payout_addresses": payout_addresses,
-            "0xB10C": self.__getPoolNameFromData(coinbase_message = coinbase_message,
-                                               payout_addresses = payout_addresses,
-                                               pool_data = self.B10C_data,
-                                               update_data = False),
-            
-            "Blockchain_com": self.__getPoolNameFromData(coinbase_message = coinbase_message,
-                                               payout_addresses = payout_addresses,
-                                               pool_data = self.blockchain_data,
-                                               update_data = False),
-            
-            "BTC_com": self.__getPoolNameFromData(coinbase_message = coinbase_message,
-                                               payout_addresses = payout_addresses,
-                                               pool_data = self.btc_data,
-                                               update_data = False),
-                        
-            "My_initial_attribution": self.__getPoolNameFromData(coinbase_message = coinbase_message,
-                                               payout_addresses = payout_addresses,
-                                               pool_data = self.my_pool_data,
-                                               update_data = False),
-            
-            "My_updated_attribution": self.__getPoolNameFromData(coinbase_message = coinbase_message,
-                                               payout_addresses = payout_addresses,
-                                               pool_data = self.my_pool_data_updated,
-                                               update_data = False)
-            
+            "payout_addresses": payout_addresses
             }
+        results.update(zip(self.SOURCES, source_results))
         self.logger.debug("Attribution complete.")
         return results
-
-      
-    
\ No newline at end of file
+    
+    def __attributeMatches(self, matched_tags, candidates):
+        # Find the matches of all sources at once using the unified index
+        payout_address_matches = [set() for _ in self.SOURCES]
+        coinbase_tag_matches = [[] for _ in self.SOURCES]
+        
+        for entry in self.__unified_addresses.get_many(candidates):
+            if entry is not None:
+                source_mask, pool_ids = entry
+                for source in range(len(self.SOURCES)):
+                    if source_mask >> source & 1:
+                        payout_address_matches[source].add(self.__pool_names[pool_ids[source]])
+        
+        for tag in matched_tags:
+            for source, rank, pool_id in self.__unified_tags[tag]:
+                coinbase_tag_matches[source].append((rank, pool_id))
+        
+        # Tags in dataset order, as __getPoolNameFromData finds them.
+        # payout_addresses is only used to update the pool data, which is off here.
+        return [self.__resolvePoolName(payout_address_matches=payout_address_matches[source],
+                                       coinbase_tag_matches={self.__pool_names[pool_id] for _, pool_id in sorted(coinbase_tag_matches[source])},
+                                       payout_addresses=candidates,
+                                       update_data=False)
+                for source in range(len(self.SOURCES))]
+    
+    def attributeBatch(self, blocks, run_id):
+        '''
+        Attributes pool names to a chunk of blocks. Blocks with the same coinbase
+        message and payout addresses (e.g. of a pool paying to a fixed address)
+        are only attributed once per chunk.
+        Returns a block_attributions document per block, ready to be bulk stored.
+        '''
+        documents = []
+        batch_results = {}
+        for block in blocks:
+            payout_addresses = list(block["payout_addresses"])
+            key = (block["coinbase_message"], tuple(payout_addresses))
+            results = batch_results.get(key)
+            if results is None:
+                results = batch_results[key] = self.AttributePoolName(coinbase_message=block["coinbase_message"],
+                                                                      payout_addresses=payout_addresses)
+            documents.append(self.__attributionDocument(run_id=run_id, block=block, results=results))
+        self.logger.debug("Attributed {} blocks, {} distinct.".format(len(documents), len(batch_results)))
+        return documents
+    
+    def __attributionDocument(self, run_id, block, results):
+        # Document stored in the block_attributions index
+        return {
+            "run_id": run_id,
+            "block_height": block["block_height"],
+            "block_hash": block["block_hash"],
+            "timestamp" : block["timestamp"],
+            "coinbase_message": block["coinbase_message"],
+            "payout_addresses": list(block["payout_addresses"]),
+            "fee_block_reward": block["fee_block_reward"],
+            "total_block_reward": block["total_block_reward"],
+            "0xB10C_results": results["0xB10C"],
+            "0xB10C_attribution": results["0xB10C"]["pool_name"],
+            "Blockchain_com_results": results["Blockchain_com"],
+            "Blockchain_com_attribution": results["Blockchain_com"]["pool_name"],
+            "BTC_com_results": results["BTC_com"],
+            "BTC_com_attribution": results["BTC_com"]["pool_name"],
+            "My_inital_results": results["My_initial_attribution"],
+            "My_initial_attribution": results["My_initial_attribution"]["pool_name"],
+            "My_updated_results": results["My_updated_attribution"],
+            "My_updated_attribution": results["My_updated_attribution"]["pool_name"]
+            }
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+A class file for a Bloom filter over strings.
+
+A Bloom filter answers "certainly not in the set" or "maybe in the set" using
+about 10 bits per item for a 1% false positive rate. BlockAnalyser checks the
+payout addresses of a block against it before looking them up in the address
+table, most payout addresses (e.g. of the outputs of FPPS payouts) belong to
+no known pool and are skipped after one or two bit tests.
+
+The bit positions are derived from Python's built-in hash() of the item,
+which is cached by str objects and cheap to compute. Because that hash is
+randomized per interpreter, a filter is only valid in the process that built
+it and in processes forked from it, it can not be stored.
+
+@author: Mischa van Reede
+"""
+
+import math
+
+
+class BloomFilter():
+
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Parameters
+        ----------
+        capacity : int
+            Number of items the filter is sized for. Adding more items is
+            possible, but increases the false positive rate.
+        error_rate : float
+            False positive rate at capacity items.
+
+        """
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self.__bits = bytearray((self.size + 7) // 8)
+
+    def __positions(self, item):
+        # Double hashing, the two halves of the 64-bit hash give all positions.
+        item_hash = hash(item) & 0xFFFFFFFFFFFFFFFF
+        position = item_hash & 0xFFFFFFFF
+        step = item_hash >> 32 | 1
+        for _ in range(self.hash_count):
+            yield position % self.size
+            position += step
+
+    def add(self, item):
+        for position in self.__positions(item):
+            self.__bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, items):
+        # Same positions as __positions(), inlined since whole datasets are added at load time
+        bits = self.__bits
+        size = self.size
+        hash_range = range(self.hash_count)
+        for item in items:
+            item_hash = hash(item) & 0xFFFFFFFFFFFFFFFF
+            position = item_hash & 0xFFFFFFFF
+            step = item_hash >> 32 | 1
+            for _ in hash_range:
+                index = position % size
+                bits[index >> 3] |= 1 << (index & 7)
+                position += step
+            self.count += 1
+
+    def __contains__(self, item):
+        # Same positions as __positions(), inlined since this is called for every payout address
+        item_hash = hash(item) & 0xFFFFFFFFFFFFFFFF
+        position = item_hash & 0xFFFFFFFF
+        step = item_hash >> 32 | 1
+        bits = self.__bits
+        size = self.size
+        for _ in range(self.hash_count):
+            index = position % size
+            if not bits[index >> 3] >> (index & 7) & 1:
+                return False
+            position += step
+        return True
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+A class file for the compact attribution schema.
+
+A compact attribution document references the attributed block by height and
+hash instead of repeating its coinbase message, payout addresses and rewards,
+and stores the pool name of every source as a small integer id from the
+pool_dictionary index. The matches of every source are only stored when the
+sources disagree on the pool name. Example:
+
+    {
+        "run_id": "...",
+        "block_height": 170000,
+        "block_hash": "...",
+        "0xB10C_pool": 12,
+        "Blockchain_com_pool": 12,
+        "BTC_com_pool": 12,
+        "My_initial_pool": 12,
+        "My_updated_pool": 12,
+        "agree": true,
+        "multiple_matches": 0       # bit i is set if source i had multiple matches
+    }
+
+expand_attribution() turns a compact document and its block back into a
+block_attributions document.
+
+@author: Mischa van Reede
+"""
+
+from .analytics import UNKNOWN_POOL
+
+
+# (results field in the block_attributions documents, field prefix in the compact documents)
+SOURCES = [("0xB10C_results", "0xB10C"),
+           ("Blockchain_com_results", "Blockchain_com"),
+           ("BTC_com_results", "BTC_com"),
+           ("My_inital_results", "My_initial"),
+           ("My_updated_results", "My_updated")]
+
+
+class PoolDictionary():
+    """
+    Maps pool names to small integer ids and back. Entries are stored in the
+    pool_dictionary index as {"pool_id": int, "pool_name": string} and are
+    never changed once stored. Add the names of a run with add_names() before
+    attributing blocks, so parallel writers never assign ids.
+    """
+
+
+    def __init__(self, storage_controller, logger, index="pool_dictionary"):
+        self.storage_controller = storage_controller
+        self.logger = logger
+        self.index = index
+
+        self.__ids = {}
+        self.__names = {}
+        self.load()
+
+    def load(self):
+        # (Re)loads all entries from the dictionary index.
+        self.__ids = {}
+        for hit in self.storage_controller.scan_docs(index=self.index, fields=["pool_id", "pool_name"]):
+            self.__ids[hit["_source"]["pool_name"]] = hit["_source"]["pool_id"]
+        self.__names = {pool_id: pool_name for pool_name, pool_id in self.__ids.items()}
+        self.logger.debug("Loaded {} pool names from index [{}]".format(len(self.__ids), self.index))
+
+    def add_names(self, pool_names):
+        """
+        Assigns ids to the pool names that do not have one yet and stores them.
+
+        Returns
+        -------
+        is_stored : Boolean
+            True if all new entries are stored succesfully.
+
+        """
+        new_entries = []
+        next_id = max(self.__names, default=-1) + 1
+        for pool_name in sorted(set(pool_names) - set(self.__ids)):
+            new_entries.append({"pool_id": next_id, "pool_name": pool_name})
+            next_id += 1
+        if not new_entries:
+            return True
+
+        self.logger.info("Adding {} pool names to index [{}]".format(len(new_entries), self.index))
+        if not self.storage_controller.bulk_store(records=new_entries, index_name=self.index):
+            self.logger.error("Failed to store the new pool names.")
+            return False
+        for entry in new_entries:
+            self.__ids[entry["pool_name"]] = entry["pool_id"]
+            self.__names[entry["pool_id"]] = entry["pool_name"]
+        return True
+
+    def get_id(self, pool_name):
+        return self.__ids[pool_name]
+
+    def get_name(self, pool_id):
+        return self.__names[pool_id]
+
+
+def compact_attribution(attribution, pool_dictionary):
+    """
+    Builds the compact attribution document of a block_attributions document.
+    """
+    document = {
+        "run_id": attribution["run_id"],
+        "block_height": attribution["block_height"],
+        "block_hash": attribution["block_hash"],
+        "multiple_matches": 0
+        }
+    for bit, (results_field, prefix) in enumerate(SOURCES):
+        document[prefix + "_pool"] = pool_dictionary.get_id(attribution[results_field]["pool_name"])
+        # multiple_matches can be the tuple (True,), see BlockAnalyser
+        if attribution[results_field]["multiple_matches"]:
+            document["multiple_matches"] |= 1 << bit
+
+    document["agree"] = len({document[prefix + "_pool"] for _, prefix in SOURCES}) == 1
+    if not document["agree"]:
+        document["details"] = {
+            prefix: {
+                "payout_addresses_matches": [pool_dictionary.get_id(name) for name in attribution[results_field]["payout_addresses_matches"]],
+                "coinbase_tag_matches": [pool_dictionary.get_id(name) for name in attribution[results_field]["coinbase_tag_matches"]]
+                }
+            for results_field, prefix in SOURCES
+            }
+    return document
+
+
+def expand_attribution(document, block, pool_dictionary):
+    """
+    Builds the block_attributions document from a compact attribution document
+    and the stored block it references. The match lists of the sources are
+    only known if the sources disagreed, they are None otherwise.
+    """
+    expanded = {
+        "run_id": document["run_id"],
+        "block_height": block["block_height"],
+        "block_hash": block["block_hash"],
+        "timestamp" : block["timestamp"],
+        "coinbase_message": block["coinbase_message"],
+        "payout_addresses": list(block["payout_addresses"]),
+        "fee_block_reward": block["fee_block_reward"],
+        "total_block_reward": block["total_block_reward"]
+        }
+    details = document.get("details", {})
+    for bit, (results_field, prefix) in enumerate(SOURCES):
+        pool_name = pool_dictionary.get_name(document[prefix + "_pool"])
+        source_details = details.get(prefix)
+        results = {
+            "pool_name": pool_name,
+            "multiple_matches": bool(document["multiple_matches"] & (1 << bit)),
+            "payout_addresses_matches": None,
+            "coinbase_tag_matches": None
+            }
+        if source_details is not None:
+            results["payout_addresses_matches"] = [pool_dictionary.get_name(pool_id) for pool_id in source_details["payout_addresses_matches"]]
+            results["coinbase_tag_matches"] = [pool_dictionary.get_name(pool_id) for pool_id in source_details["coinbase_tag_matches"]]
+        elif pool_name == UNKNOWN_POOL and not results["multiple_matches"]:
+            # Unknown without multiple matches means nothing matched
+            results["payout_addresses_matches"] = []
+            results["coinbase_tag_matches"] = []
+        expanded[results_field] = results
+        expanded[prefix + "_attribution"] = pool_name
+    return expanded
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Delta encoding of the records in the api_block_data_conflicts index.
+
+When the scrapers return different data for a block, the conflict is stored
+as the block of the first scraper (base_block) plus, for every other scraper,
+only the fields in which its block differs from the base block. Conflicts
+usually differ in a single field (e.g. payout_addresses of p2pk outputs or
+fee_block_reward), so a record holds one block instead of one per scraper.
+The names of the differing fields are stored in conflicting_fields, which can
+be aggregated on. Example:
+
+    {
+        "block_hash": "...",
+        "block_height": 1000,
+        "scrapers": ["BlockchainScraper", "BlockstreamScraper"],
+        "base_block": {...},
+        "conflicting_fields": ["payout_addresses"],
+        "diffs": [
+            {"scraper": "BlockstreamScraper", "fields": {"payout_addresses": [...]}, "missing_fields": []}
+            ]
+    }
+
+decode_conflict() reconstructs the full view, the block of every scraper,
+in the format of the records stored before delta encoding (gathered_data).
+
+@author: Mischa van Reede
+"""
+
+
+def encode_conflict(block_hash, scraper_names, blocks):
+    """
+    Builds the delta encoded conflict record of the blocks returned by the
+    scrapers, the block height is set by the caller.
+    """
+    base_block = blocks[0]
+    conflicting_fields = set()
+    diffs = []
+    for scraper_name, block in zip(scraper_names[1:], blocks[1:]):
+        fields = {field: value for field, value in block.items() if field not in base_block or base_block[field] != value}
+        missing_fields = sorted(field for field in base_block if field not in block)
+        if fields or missing_fields:
+            diffs.append({"scraper": scraper_name, "fields": fields, "missing_fields": missing_fields})
+            conflicting_fields.update(fields)
+            conflicting_fields.update(missing_fields)
+    return {
+        "block_hash": block_hash,
+        "block_height": None,
+        "scrapers": list(scraper_names),
+        "base_block": base_block,
+        "conflicting_fields": sorted(conflicting_fields),
+        "diffs": diffs
+        }
+
+
+def decode_conflict(record):
+    """
+    Returns the conflict record with the block of every scraper in gathered_data,
+    as it was stored before delta encoding. Records in that format are returned as is.
+    """
+    if "gathered_data" in record:
+        return record
+
+    diffs = {diff["scraper"]: diff for diff in record["diffs"]}
+    gathered_data = []
+    for scraper_name in record["scrapers"]:
+        block = dict(record["base_block"])
+        diff = diffs.get(scraper_name)
+        if diff is not None:
+            block.update(diff["fields"])
+            for field in diff["missing_fields"]:
+                del block[field]
+        gathered_data.append({"scraper": scraper_name, "block": block})
+    return {
+        "block_hash": record["block_hash"],
+        "block_height": record["block_height"],
+        "gathered_data": gathered_data
+        }
+
+
+def conflicts_by_field(es_controller, start_height=None, end_height=None, index="api_block_data_conflicts"):
+    """
+    Number of conflicts per conflicting field, with the lowest and highest
+    height it occurs at, computed by an Elasticsearch aggregation. Only
+    delta encoded records are counted.
+
+    Returns
+    -------
+    table : dict
+        Columns field, conflicts, first_height, last_height.
+
+    """
+    height_range = {}
+    if start_height is not None:
+        height_range["gte"] = start_height
+    if end_height is not None:
+        height_range["lte"] = end_height
+    filters = [{"range": {"block_height": height_range}}] if height_range else []
+
+    aggregations = es_controller.aggregate(index=index, filters=filters, aggs={
+        "fields": {
+            "terms": {"field": es_controller.aggregatable_field(index, "conflicting_fields"), "size": 100},
+            "aggs": {
+                "first_height": {"min": {"field": "block_height"}},
+                "last_height": {"max": {"field": "block_height"}}
+                }
+            }
+        })
+    rows = [[bucket["key"], bucket["doc_count"], int(bucket["first_height"]["value"]), int(bucket["last_height"]["value"])]
+            for bucket in aggregations["fields"]["buckets"]]
+    return {"columns": ["field", "conflicts", "first_height", "last_height"], "rows": rows}
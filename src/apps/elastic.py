@@ -18,16 +18,30 @@ Elasticsearch mapping information: https://www.elastic.co/guide/en/elasticsearch
 #ES stores json documents.
 
 
+import os
+import re
 import sys
 import time
+import json
+import glob
+import fcntl
+import hashlib
 import elasticsearch
+import elasticsearch.helpers
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search
+from contextlib import contextmanager
 
+from .storage import StorageController
+from .utils import Utils
 
 
 
-class ElasticsearchController():
+
+class ElasticsearchController(StorageController):
+    
+    FEATURES = frozenset([StorageController.AGGREGATIONS, StorageController.ASYNC_STORAGE, StorageController.SERVER_SIDE_TASKS,
+                          StorageController.CONCURRENT_WRITES])
     
     
     def __init__(self, config, logger):
@@ -35,7 +49,14 @@ class ElasticsearchController():
         self.logger = logger
         self.es_connection = self.__connect_elasticsearch()
         
+        # Seconds writers wait for an index that migrate_index made read-only
+        self.write_block_timeout = self.config.getint('Elasticsearch', 'write_block_timeout', fallback=3600)
+        
+        # Backing indices of partitioned indices, per alias. Filled on first use.
+        self.__partitions = {}
+        
         self.__create_all_indices()
+        self.__recover_bulk_ingest_settings()
         
         
     def __connect_elasticsearch(self):
@@ -75,22 +96,164 @@ class ElasticsearchController():
         """
         index_names = ElasticsearchIndexes.INDEX_NAMES
         self.logger.info("Checking if the following indices need to be created: {}".format(index_names))
-        
+
         for index in index_names:
-            # Create needed databases/indices
+            # Create needed databases/indices, behind an alias with the index name
             if not self.__index_exists(index):
-                body = {**ElasticsearchIndexes.SETTINGS, **ElasticsearchIndexes.MAPPINGS[index]}
-                self.__create_index(index_name=index, index_body=body)
+                versioned_index = self.__versioned_index_name(index)
+                self.__create_index(index_name=versioned_index, index_body=self.__versioned_index_body(index))
+                self.__swap_alias(alias_name=index, new_index=versioned_index)
                 continue
             self.logger.info("Index {} already exists.".format(index))
+            if self.__versioned_index_name(index) not in self.__get_alias_indices(index):
+                self.logger.warning("Index [{}] does not use mapping version {}. Run the migrate_indices command to upgrade it.".format(
+                    index, ElasticsearchIndexes.INDEX_VERSIONS[index]))
+                self.__add_new_fields(index)
+            elif index in ElasticsearchIndexes.PARTITIONED_INDICES:
+                self.__ensure_write_index(index)
         self.logger.info("All indices have been created.")
-    
-        
-    
+
+
+
     #============================================
     # Indices
-    #============================================    
-    
+    #============================================
+
+    def __versioned_index_name(self, index_name, version=None):
+        # Name of the concrete index that backs the alias index_name.
+        if version is None:
+            version = ElasticsearchIndexes.INDEX_VERSIONS[index_name]
+        return "{}_v{}".format(index_name, version)
+
+    def __versioned_index_body(self, index_name):
+        # Settings and mappings for the current mapping version of index_name.
+        version = ElasticsearchIndexes.INDEX_VERSIONS[index_name]
+        settings = ElasticsearchIndexes.VERSIONED_SETTINGS[version][index_name]
+        mappings = ElasticsearchIndexes.VERSIONED_MAPPINGS[version][index_name]
+        return {**settings, **mappings}
+
+    def __partition_index_body(self, index_name):
+        # Settings and mappings for a partition of index_name, see PARTITIONED_INDICES.
+        body = self.__versioned_index_body(index_name)
+        number_of_shards = ElasticsearchIndexes.PARTITIONED_INDICES[index_name]["number_of_shards"]
+        if number_of_shards:
+            body["settings"] = {**body["settings"], "number_of_shards": number_of_shards}
+        return body
+
+    def __add_new_fields(self, index_name):
+        """
+        Adds the fields of the current mapping version that the live index does
+        not have yet, so records in the current format are not dynamically
+        mapped until the index is migrated. Changed fields still need migrate_indices.
+        """
+        version = ElasticsearchIndexes.INDEX_VERSIONS[index_name]
+        properties = ElasticsearchIndexes.VERSIONED_MAPPINGS[version][index_name]["mappings"]["properties"]
+        live_fields = set()
+        for index_mapping in self.es_connection.indices.get_mapping(index=index_name).values():
+            live_fields.update(index_mapping["mappings"].get("properties", {}))
+        new_fields = {field: mapping for field, mapping in properties.items() if field not in live_fields}
+        if not new_fields:
+            return
+        self.logger.info("Adding fields {} of mapping version {} to index [{}]".format(sorted(new_fields), version, index_name))
+        try:
+            self.es_connection.indices.put_mapping(index=index_name, body={"properties": new_fields})
+        except Exception as e:
+            self.logger.error("Could not add the fields to index [{}]: {}".format(index_name, e))
+
+    def __get_alias_indices(self, alias_name):
+        """
+        Returns the names of the concrete indices an alias points to.
+        Returns an empty list if alias_name is not an alias.
+        """
+        try:
+            if self.es_connection.indices.exists_alias(name=alias_name):
+                return list(self.es_connection.indices.get_alias(name=alias_name).keys())
+        except Exception as e:
+            self.logger.error("An error has occurred: {}".format(e))
+        return []
+
+    def __swap_alias(self, alias_name, new_index, partitions=()):
+        """
+        Atomically points alias_name to new_index, and to the partitions of a
+        partitioned index. Old indices behind the alias are detached but kept.
+        A legacy concrete index with the same name as the alias is removed in
+        the same request, make sure its data has been reindexed.
+        """
+        actions = []
+        old_indices = self.__get_alias_indices(alias_name)
+        if old_indices:
+            actions.extend({"remove": {"index": index, "alias": alias_name}} for index in old_indices if index != new_index)
+        elif self.__index_exists(alias_name):
+            self.logger.info("Removing legacy index [{}] to free its name for the alias.".format(alias_name))
+            actions.append({"remove_index": {"index": alias_name}})
+        # Writes to the alias go to new_index, also after partitions are added to it
+        actions.append({"add": {"index": new_index, "alias": alias_name, "is_write_index": True}})
+        actions.extend({"add": {"index": partition, "alias": alias_name, "is_write_index": False}} for partition in partitions)
+
+        self.logger.debug("Updating aliases: {}".format(actions))
+        self.es_connection.indices.update_aliases(body={"actions": actions})
+        self.__partitions.pop(alias_name, None)
+        self.logger.info("Alias [{}] now points to index [{}]".format(alias_name, new_index))
+
+    def migrate_index(self, index_name):
+        """
+        Moves the data stored under index_name to a new concrete index that uses the
+        current mapping version, then points the index_name alias to it.
+
+        The old index is set to read-only after the first reindex pass, a second pass
+        copies the documents written in the meantime. Writers wait while the
+        index is read-only (at most write_block_timeout seconds, see is_write_block)
+        and continue on the new index after the alias swap.
+        The documents of a partitioned index are copied into the partitions of the
+        new mapping version, which join the alias in the swap (see __migration_partitions).
+
+        Parameters
+        ----------
+        index_name : string
+            Name of the index (alias) to migrate, one of ElasticsearchIndexes.INDEX_NAMES.
+
+        Returns
+        -------
+        migrated : Boolean
+            True if the alias points to the current mapping version after the call.
+
+        """
+        new_index = self.__versioned_index_name(index_name)
+        old_indices = self.__get_alias_indices(index_name)
+
+        if new_index in old_indices:
+            self.logger.info("Index [{}] is already on mapping version {}.".format(index_name, ElasticsearchIndexes.INDEX_VERSIONS[index_name]))
+            return True
+
+        if not self.__index_exists(new_index):
+            self.__create_index(index_name=new_index, index_body=self.__versioned_index_body(index_name))
+
+        if not self.__index_exists(index_name):
+            self.logger.info("Nothing to migrate for [{}], only creating the alias.".format(index_name))
+            self.__swap_alias(alias_name=index_name, new_index=new_index)
+            return True
+
+        source_indices = old_indices if old_indices else [index_name]
+        self.logger.info("Migrating index [{}] from {} to [{}]".format(index_name, source_indices, new_index))
+        targets = self.__migration_partitions(index_name, new_index)
+        if not self.__reindex(source_index=index_name, targets=targets):
+            self.logger.error("Initial reindex of [{}] failed. Alias not swapped.".format(index_name))
+            return False
+
+        # Block writes on the old index and copy the documents written during the first pass.
+        self.es_connection.indices.put_settings(index=",".join(source_indices), body={"index.blocks.write": True})
+        targets = self.__migration_partitions(index_name, new_index)
+        if not self.__reindex(source_index=index_name, targets=targets, create_only=True):
+            self.logger.error("Catch-up reindex of [{}] failed. Re-enabling writes on the old index.".format(index_name))
+            self.es_connection.indices.put_settings(index=",".join(source_indices), body={"index.blocks.write": False})
+            return False
+
+        partitions = sorted({partition for partition, _, _ in targets if partition != new_index})
+        self.__swap_alias(alias_name=index_name, new_index=new_index, partitions=partitions)
+        self.logger.info("Migration of [{}] complete. Old indices {} are kept read-only.".format(
+            index_name, [index for index in source_indices if index != index_name]))
+        return True
+
     def __create_index(self, index_name, index_body):
         """
             Create index and mapping for index Crawl Peer Info
@@ -134,8 +297,11 @@ class ElasticsearchController():
         # Delete specified index from ES instance, maybe add { ignore=[400, 404] }  as argument if there are errors.
         self.logger.info("Trying to delete index [{}]".format(index_name))
         if self.__index_exists(index_name):
-            try: 
-                self.es_connection.indices.delete(index=index_name)
+            try:
+                # Aliases are resolved to the concrete (versioned) indices behind them.
+                indices = self.__get_alias_indices(index_name) or [index_name]
+                self.es_connection.indices.delete(index=",".join(indices))
+                self.__partitions.pop(index_name, None)
                 self.logger.info("Index with name [{}] deleted".format(index_name))
                 return
             except Exception as e:
@@ -147,6 +313,22 @@ class ElasticsearchController():
     #============================================
     # Methods for interacting with the instance
     #============================================ 
+    @staticmethod
+    def is_write_block(error):
+        """
+        Returns True if error, an exception or the result item of a bulk action,
+        means that the index is read-only, e.g. while migrate_index copies it.
+        Writers wait for the block to be lifted instead of counting it as a failed attempt.
+        """
+        if isinstance(error, dict):
+            # {"index": {"status": 403, "error": {"type": "cluster_block_exception", ...}}}
+            # or {"index": {"error": "...", "exception": TransportError}} if the request failed
+            result = next(iter(error.values()), {})
+            error = result.get("exception") or result.get("error")
+            if isinstance(error, dict):
+                return error.get("type") == "cluster_block_exception"
+        return getattr(error, "error", None) == "cluster_block_exception"
+
     def store(self, record, index_name):
         """
             Store a data record in a specified index index
@@ -164,17 +346,25 @@ class ElasticsearchController():
             True if record is stored succesfully.
         """
         assert(self.__index_exists(index_name))
+        target_index = self.__partition_for_record(index_name, record)
                     
         try_count = 0
         max_tries = 5
+        write_block_deadline = None
         while True:
             try:
-                self.logger.debug("Storing object in index: {}".format(index_name))
-                self.es_connection.index(index=index_name, body=record)
+                self.logger.debug("Storing object in index: {}".format(target_index))
+                self.es_connection.index(index=target_index, body=record)
                 #self.logger.debug("Storing object: {}".format(outcome))
                 is_stored = True
                 break
             except Exception as ex:
+                if self.is_write_block(ex):
+                    write_block_deadline = write_block_deadline or time.monotonic() + self.write_block_timeout
+                    if time.monotonic() < write_block_deadline:
+                        self.logger.info("Index [{}] is read-only while it is migrated, waiting to store the document.".format(index_name))
+                        time.sleep(1)
+                        continue
                 self.logger.error("An error occurred when storing the document: {}".format(str(ex)))
                 #self.logger.error("Error for record : {}".format(record))
                 
@@ -189,14 +379,15 @@ class ElasticsearchController():
     
     def bulk_store(self, records, index_name):
         """
-        Stores many records in one go.
+        Stores many records in one go. Only the records that failed are sent
+        again, records that were stored are not duplicated by a retry.
 
         """
         assert(self.__index_exists(index_name))
         
-        action = [
+        actions = [
             {
-                "_index": index_name,
+                "_index": self.__partition_for_record(index_name, record),
                 "_source": record
             }
             for record in records
@@ -204,23 +395,43 @@ class ElasticsearchController():
         
         try_count = 0
         max_tries = 5
+        write_block_deadline = None
         while True:
+            self.logger.info("Storing [{}] records in index: [{}]".format(len(actions), index_name))
+            failed_actions = []
+            write_blocked = False
+            position = 0
             try:
-                self.logger.info("Storing [{}] records in index: [{}]".format(len(records), index_name))
-                elasticsearch.helpers.bulk(self.es_connection, actions=action)
-                is_stored = True
-                self.logger.debug("Storing records was succesful")
-                break
+                # Results are yielded in the order of the actions
+                for ok, item in elasticsearch.helpers.streaming_bulk(self.es_connection, actions=actions,
+                                                                     raise_on_error=False, raise_on_exception=False):
+                    if not ok:
+                        failed_actions.append(actions[position])
+                        write_blocked = write_blocked or self.is_write_block(item)
+                    position += 1
             except Exception as ex:
                 self.logger.error("An error occurred when storing the documents: {}".format(str(ex)))
-                time.sleep(1)
-                try_count += 1
-                self.logger.info("Trying to store data again. Attempt {} out of {}".format(try_count, max_tries))
-                if try_count >= max_tries:
-                    self.logger.error("All {} attemps to store the record failed.".format(max_tries))
-                    is_stored = False
-                    break
-        return is_stored
+                # Results of the actions after position are unknown
+                failed_actions.extend(actions[position:])
+                write_blocked = self.is_write_block(ex)
+            if not failed_actions:
+                self.logger.debug("Storing records was succesful")
+                return True
+            actions = failed_actions
+            
+            if write_blocked:
+                write_block_deadline = write_block_deadline or time.monotonic() + self.write_block_timeout
+                if time.monotonic() < write_block_deadline:
+                    self.logger.info("Index [{}] is read-only while it is migrated, waiting to store {} documents.".format(index_name, len(actions)))
+                    time.sleep(1)
+                    continue
+            try_count += 1
+            self.logger.error("Failed to store {} documents.".format(len(actions)))
+            if try_count >= max_tries:
+                self.logger.error("All {} attemps to store the record failed.".format(max_tries))
+                return False
+            self.logger.info("Trying to store the failed documents again. Attempt {} out of {}".format(try_count, max_tries))
+            time.sleep(1)
     
     
     def remove_all_but_one_by_query(self, index, query):
@@ -246,34 +457,151 @@ class ElasticsearchController():
             self.logger.debug("Only 1 document returned with query: \"{}\"".format(query))
   
 
-    def query_all_docs(self, index):
-        self.logger.debug("Querying index {} to obtain all records using .scan()".format(index))
-        query = "*"
-        search_context = Search(using=self.es_connection, index=index)
-        s = search_context.query('query_string', query=query)
-        self.logger.debug("Found a total of {} records".format(s.count()))
-        results = [doc.to_dict() for doc in s.scan()]
+    def remove_duplicates(self, index, field="block_height", page_size=1000):
+        """
+        Removes documents with duplicate values for field, keeping one document per value.
+
+        Walks all values of field with a composite aggregation. For every bucket
+        with more than one document the ids of its documents are taken from a
+        top_hits sub aggregation, the first is kept and the others are bulk deleted
+        by id. Composite aggregations do not support min_doc_count, single document
+        buckets are skipped client side. Values with more documents than top_hits
+        returns are handled in a next pass.
+
+        Parameters
+        ----------
+        index : string
+            Index (or alias) to deduplicate.
+        field : string
+            Field that identifies a duplicate, e.g. block_height or block_hash.
+            Must be a keyword or numeric field.
+        page_size : int
+            Number of buckets per request.
+
+        Returns
+        -------
+        total_deleted : int
+            Number of documents deleted.
+
+        """
+        max_hits = 100
+        total_deleted = 0
+        self.logger.info("Removing documents with duplicate [{}] values from index [{}]".format(field, index))
+        while True:
+            body = {
+                "size": 0,
+                "aggs": {
+                    "values": {
+                        "composite": {
+                            "size": page_size,
+                            "sources": [{field: {"terms": {"field": field}}}]
+                            },
+                        "aggs": {
+                            "docs": {"top_hits": {"size": max_hits, "_source": False}}
+                            }
+                        }
+                    }
+                }
+            duplicates_found = 0
+            truncated_buckets = 0
+            while True:
+                response = self.es_connection.search(index=index, body=body, request_timeout=300)
+                aggregation = response["aggregations"]["values"]
+                docs_to_delete = []
+                for bucket in aggregation["buckets"]:
+                    if bucket["doc_count"] < 2:
+                        continue
+                    duplicates_found += 1
+                    if bucket["doc_count"] > max_hits:
+                        truncated_buckets += 1
+                    # Keep the first document, delete the others
+                    docs_to_delete.extend(bucket["docs"]["hits"]["hits"][1:])
+                if docs_to_delete:
+                    total_deleted += self.bulk_delete(docs_to_delete)
+                if "after_key" not in aggregation or not aggregation["buckets"]:
+                    break
+                body["aggs"]["values"]["composite"]["after"] = aggregation["after_key"]
+
+            self.logger.info("Found {} values with duplicates.".format(duplicates_found))
+            if not truncated_buckets:
+                break
+            self.logger.info("{} values had more than {} documents, starting another pass.".format(truncated_buckets, max_hits))
+            self.es_connection.indices.refresh(index=index)
+
+        self.logger.info("Deleted {} duplicate documents from index [{}]".format(total_deleted, index))
+        return total_deleted
+
+    def query_all_docs(self, index, fields=None):
+        # Returns the (partial) sources of all documents in index as a list, see scan_docs.
+        self.logger.debug("Querying index {} to obtain all records".format(index))
+        results = [hit["_source"] for hit in self.scan_docs(index=index, fields=fields)]
+        self.logger.debug("Found a total of {} records".format(len(results)))
         return results
     
+    def query_all_docs_with_metadata(self, index, fields=None):
+        # Returns all documents in index as a list of dicts with the keys index, id and data.
+        self.logger.debug("Querying index {} to obtain all records".format(index))
+        results = [{"index": hit["_index"], "id": hit["_id"], "data": hit["_source"]}
+                   for hit in self.scan_docs(index=index, fields=fields)]
+        self.logger.debug("Found a total of {} records".format(len(results)))
+        return results
     
-    def query_all_docs_with_metadata(self, index):
-        self.logger.debug("Querying index {} to obtain all records using .scan()".format(index))
-        query = "*"
-        search_context = Search(using=self.es_connection, index=index)
-        s = search_context.query('query_string', query=query)
-        self.logger.debug("Found a total of {} records".format(s.count()))
-        results = []
-        for doc in s.scan():
-            result = doc.meta.to_dict()
-            result["data"] = doc.to_dict()
-            results.append(result)
-        
-        #results = [doc.meta.to_dict().update({"_source": doc.to_dict()}) for doc in s.scan()]
-        if len(results) > 0:
-            self.logger.debug("Document structure (dict keys): {}".format(results[0].keys()))
+    def scan_docs(self, index, fields=None, sort=None, page_size=1000, keep_alive="5m"):
+        """
+        Lazily yields all documents in an index, one page at a time, so the
+        memory used does not depend on the size of the index.
+
+        Parameters
+        ----------
+        index : string
+            Index (or alias) to read.
+        fields : list of strings, optional
+            Only fetch these fields of the documents, fetches the full source by default.
+        sort : list of strings, optional
+            Fields to order the documents by (ascending). The combination of
+            fields should be unique per document. Unordered by default, which
+            is the cheapest way to read an index.
+        page_size : int
+            Number of documents fetched per request.
+        keep_alive : string
+            Time the search context is kept open between two requests.
+
+        Yields
+        ------
+        hit : dict
+            Dict with the keys _index, _id and _source (the partial document).
+
+        """
+        self.logger.debug("Streaming documents from index [{}]".format(index))
+        body = {"query": {"match_all": {}}}
+        if fields is not None:
+            body["_source"] = list(fields)
+
+        if sort is None:
+            for hit in elasticsearch.helpers.scan(self.es_connection, query=body, index=index, size=page_size, scroll=keep_alive):
+                yield hit
         else:
-            self.logger.dubug("No results returned.")
-        return results
+            body["sort"] = [{field: "asc"} for field in sort]
+            yield from self.__iter_point_in_time(index, body, page_size, keep_alive)
+        self.logger.debug("Done streaming documents.")
+    
+    def __iter_point_in_time(self, index, body, page_size, keep_alive):
+        # Pages through a point in time of index with search_after, body must sort on a unique combination of fields.
+        pit_id = self.es_connection.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+        body = dict(body, size=page_size, track_total_hits=False, pit={"id": pit_id, "keep_alive": keep_alive})
+        try:
+            while True:
+                response = self.es_connection.search(body=body)
+                hits = response["hits"]["hits"]
+                yield from hits
+                if len(hits) < page_size:
+                    break
+                # The point in time id can change between requests
+                pit_id = response.get("pit_id", pit_id)
+                body["pit"]["id"] = pit_id
+                body["search_after"] = hits[-1]["sort"]
+        finally:
+            self.es_connection.close_point_in_time(body={"id": pit_id})
     
     def query_es(self, index=None, query=None, max_results=0):
         self.logger.debug("Querying ES instance.")
@@ -303,31 +631,878 @@ class ElasticsearchController():
         self.logger.error("ES Query failed. Returning None.")
         return None
     
+    def iter_blocks(self, start_height, end_height, fields=None, index="blocks_from_scrapers_updated", page_size=5000, keep_alive="5m", run_id=None):
+        """
+        Lazily yields the stored blocks with start_height <= block_height <= end_height,
+        ordered by height. Pages through a point in time of the index with
+        search_after, so the result is consistent while the index is written to.
+        Multiple documents can be returned for a height if duplicates are stored.
+
+        Parameters
+        ----------
+        start_height : int
+            Height of the first block.
+        end_height : int
+            Height of the last block (inclusive).
+        fields : list of strings, optional
+            Only return these fields of the stored blocks, returns the full document by default.
+        index : string
+            Index (or alias) to read the blocks from.
+        page_size : int
+            Number of blocks fetched per request.
+        keep_alive : string
+            Time the point in time is kept open between two requests.
+        run_id : string, optional
+            Only return documents of this attribution run, for indices with
+            per block documents of attribution runs.
+
+        Yields
+        ------
+        block : dict
+            The (partial) source of a stored block.
+
+        """
+        self.logger.debug("Streaming blocks between heights {} and {} from index [{}]".format(start_height, end_height, index))
+        # Only open the point in time on the partitions that can hold the range
+        search_indices = self.partitions_for_height_range(index, start_height, end_height)
+        body = {
+            "query": {
+                "bool": {
+                    "filter": [{"range": {"block_height": {"gte": start_height, "lte": end_height}}}]
+                    }
+                },
+            # block_hash breaks ties between duplicate heights for search_after
+            "sort": [{"block_height": "asc"}, {"block_hash": "asc"}]
+            }
+        if fields is not None:
+            body["_source"] = list(fields)
+        if run_id is not None:
+            body["query"]["bool"]["filter"].append({"term": {"run_id": run_id}})
+            search_indices = [self.get_partition_for_value(index, run_id) or index]
+
+        for hit in self.__iter_point_in_time(",".join(search_indices), body, page_size, keep_alive):
+            yield hit["_source"]
+        self.logger.debug("Done streaming blocks.")
+
+    def aggregate(self, index, aggs, filters=None):
+        """
+        Runs aggregations on the documents matching all filters, without
+        returning any documents.
+
+        Parameters
+        ----------
+        index : string
+            Index (or alias) to aggregate over.
+        aggs : dict
+            Aggregations in query DSL.
+        filters : list of dicts, optional
+            Filter clauses in query DSL, aggregates over all documents by default.
+
+        Returns
+        -------
+        aggregations : dict
+            The aggregations part of the response.
+
+        """
+        body = {
+            "size": 0,
+            "track_total_hits": False,
+            "query": {"bool": {"filter": filters or []}},
+            "aggs": aggs
+            }
+        response = self.es_connection.search(index=index, body=body, request_timeout=300)
+        return response["aggregations"]
+
+    def aggregatable_field(self, index, field):
+        """
+        Returns field, or its keyword subfield if field is mapped as text in
+        any index behind index, e.g. when it was dynamically mapped because
+        records in a newer format were written before migrate_indices.
+        """
+        mappings = self.es_connection.indices.get_field_mapping(index=index, fields=field)
+        for index_mapping in mappings.values():
+            field_mapping = index_mapping["mappings"].get(field)
+            if field_mapping and field_mapping["mapping"][field.split(".")[-1]].get("type") == "text":
+                return field + ".keyword"
+        return field
+
+    def lookup_docs(self, index, field, values, chunk_size=1000):
+        """
+        Looks up the documents for many values of a field at once, using a
+        single terms filter per chunk of values instead of one query per value.
+
+        Parameters
+        ----------
+        index : string
+            Index (or alias) to search.
+        field : string
+            Field to match the values against, e.g. block_height or block_hash.
+        values : iterable
+            Values to look up.
+        chunk_size : int
+            Number of values resolved per request.
+
+        Returns
+        -------
+        results : dict
+            Maps every looked up value to a list of matching hits (dicts with
+            _index, _id and _source). Values without a match map to an empty list.
+
+        """
+        results = {value: [] for value in values}
+        unique_values = list(results)
+        self.logger.debug("Looking up {} values of field [{}] in index [{}]".format(len(unique_values), field, index))
+
+        for offset in range(0, len(unique_values), chunk_size):
+            chunk = unique_values[offset:offset+chunk_size]
+            query = {
+                "query": {
+                    "bool": {
+                        "filter": [{"terms": {field: chunk}}]
+                        }
+                    }
+                }
+            for hit in elasticsearch.helpers.scan(self.es_connection, query=query, index=index, size=chunk_size):
+                value = hit["_source"].get(field)
+                if value in results:
+                    results[value].append(hit)
+        self.logger.debug("Found documents for {} out of {} values".format(sum(1 for hits in results.values() if hits), len(unique_values)))
+        return results
+
+    def find_block_heights(self, coinbase_tags=(), payout_addresses=(), start_height=None, end_height=None, index="blocks_from_scrapers_updated", chunk_size=100):
+        """
+        Finds the blocks that contain any of the coinbase tags or payout addresses,
+        using the inverted indices of the blocks index: a terms filter on the
+        payout_addresses keywords and wildcard queries on the coinbase_message.wildcard
+        subfield (mapping version 2), which match substrings like `tag in coinbase_message`.
+
+        Parameters
+        ----------
+        coinbase_tags : iterable of strings
+        payout_addresses : iterable of strings
+        start_height, end_height : int, optional
+            Only search blocks in this height range (inclusive).
+        chunk_size : int
+            Number of tags (or thousands of addresses) searched per request.
+
+        Returns
+        -------
+        heights : list
+            Sorted heights of the matching blocks.
+
+        """
+        payout_addresses = list(payout_addresses)
+        clauses = [{"terms": {"payout_addresses": payout_addresses[offset:offset+1000]}} for offset in range(0, len(payout_addresses), 1000)]
+        clauses.extend({"wildcard": {"coinbase_message.wildcard": {"value": "*" + re.sub(r"([\\*?])", r"\\\1", tag) + "*"}}}
+                       for tag in coinbase_tags)
+
+        height_range = {}
+        if start_height is not None:
+            height_range["gte"] = start_height
+        if end_height is not None:
+            height_range["lte"] = end_height
+        filters = [{"range": {"block_height": height_range}}] if height_range else []
+
+        self.logger.debug("Searching blocks in index [{}] with {} queries".format(index, len(clauses)))
+        heights = set()
+        for offset in range(0, len(clauses), chunk_size):
+            query = {
+                "query": {
+                    "bool": {
+                        "filter": filters,
+                        "should": clauses[offset:offset+chunk_size],
+                        "minimum_should_match": 1
+                        }
+                    },
+                "_source": ["block_height"]
+                }
+            for hit in elasticsearch.helpers.scan(self.es_connection, query=query, index=index, size=5000):
+                heights.add(hit["_source"]["block_height"])
+        self.logger.debug("Found {} matching blocks".format(len(heights)))
+        return sorted(heights)
+
+    def bulk_delete(self, docs):
+        """
+        Deletes many documents in one go.
+
+        Parameters
+        ----------
+        docs : iterable of dicts
+            Hits (or other dicts) containing the _index and _id of the documents to delete.
+
+        Returns
+        -------
+        deleted : int
+            Number of deleted documents.
+
+        """
+        actions = (
+            {
+                "_op_type": "delete",
+                "_index": doc["_index"],
+                "_id": doc["_id"]
+            }
+            for doc in docs
+        )
+        deleted, errors = elasticsearch.helpers.bulk(self.es_connection, actions=actions, raise_on_error=False)
+        if errors:
+            self.logger.error("Failed to delete {} documents: {}".format(len(errors), errors[:10]))
+        self.logger.debug("Deleted {} documents.".format(deleted))
+        return deleted
+
+    def bulk_increment(self, index_name, docs, counters):
+        """
+        Adds the counter fields of every document to the stored document with
+        the same id, with scripted upserts. Documents that are not stored yet
+        are created.
+
+        Parameters
+        ----------
+        index_name : string
+            Index (or alias) to write to.
+        docs : iterable of dicts
+            Dicts with the _id and _source of the documents.
+        counters : list of strings
+            Numeric fields of the documents that are added up.
+
+        Returns
+        -------
+        is_stored : Boolean
+            True if all documents are stored succesfully.
+
+        """
+        script = " ".join("ctx._source.{field} += params.{field};".format(field=field) for field in counters)
+        actions = (
+            {
+                "_op_type": "update",
+                "_index": index_name,
+                "_id": doc["_id"],
+                "retry_on_conflict": 3,
+                "script": {
+                    "source": script,
+                    "params": {field: doc["_source"][field] for field in counters}
+                    },
+                "upsert": doc["_source"]
+            }
+            for doc in docs
+        )
+        updated, errors = elasticsearch.helpers.bulk(self.es_connection, actions=actions, raise_on_error=False)
+        if errors:
+            self.logger.error("Failed to update {} documents: {}".format(len(errors), errors[:10]))
+            return False
+        self.logger.debug("Updated {} documents.".format(updated))
+        return True
+
+    def delete_by_filters(self, index, filters):
+        """
+        Deletes all documents matching the filter clauses (query DSL) and waits
+        until they are deleted.
+
+        Returns
+        -------
+        deleted : int
+            Number of deleted documents.
+
+        """
+        self.logger.info("Deleting documents in index [{}] matching {}".format(index, filters))
+        response = self.es_connection.delete_by_query(index=index,
+                                                      body={"query": {"bool": {"filter": filters}}},
+                                                      conflicts="proceed",
+                                                      refresh=True,
+                                                      request_timeout=600)
+        return response["deleted"]
+
     def delete_doc(self, index, doc_type, doc_id):
         """
         Delete document with doc_id from specified index.
+        The index can be an alias over several partitions, which does not
+        accept deletes by id, so the document is deleted from the concrete
+        index it is found in.
 
         """
         self.logger.debug("Deleting doc with id {} from index {}".format(doc_id, index))
-        self.es_connection.delete(index=index, id=doc_id, doc_type=doc_type)
+        response = self.es_connection.search(index=index, body={"query": {"ids": {"values": [doc_id]}}, "_source": False})
+        hits = response["hits"]["hits"]
+        if not hits:
+            self.logger.warning("No document with id {} found in index {}".format(doc_id, index))
+            return
+        for hit in hits:
+            self.es_connection.delete(index=hit["_index"], id=doc_id, doc_type=doc_type)
         self.logger.debug("Doc deleted.")
     
     
-    def reindex_data(self, source_index, dest_index):
+    def reindex_data(self, source_index, dest_index, create_only=False, requests_per_second=None):
+        """
+        Copies all documents from source_index to dest_index, keeping their ids.
+        With create_only set, documents that already exist in dest_index are skipped.
+        Runs as a sliced server side task, this method polls the task until it is done.
+        A partitioned dest_index is reindexed one partition at a time, see __reindex_partitions.
+
+        """
+        if not self.__reindex(source_index, self.__reindex_partitions(source_index, dest_index), create_only, requests_per_second):
+            return False
+        self.logger.debug("Seems reindex was successfull. You can now delete index [{}]".format(source_index))
+        return True
+
+    def __reindex(self, source_index, targets, create_only=False, requests_per_second=None):
+        # Runs one reindex task per (dest index, query, script) of targets, see __reindex_partitions.
+        for partition, query, script in targets:
+            task_id = self.submit_reindex(source_index=source_index,
+                                          dest_index=partition,
+                                          create_only=create_only,
+                                          requests_per_second=requests_per_second,
+                                          query=query,
+                                          script=script)
+            result = self.wait_for_task(task_id)
+            self.logger.debug("Result:  {}".format(result))
+            if not result or result.get('timed_out') or result.get('failures'):
+                self.logger.debug("Something went wrong.")
+                return False
+        return True
+
+    def __reindex_partitions(self, source_index, dest_index):
+        """
+        Splits a reindex into the alias of a partitioned index, which would write
+        all documents to its write index, into one reindex per partition.
+
+        Returns
+        -------
+        partitions : list
+            (dest index, query, script) tuples, the query and script select
+            the documents of source_index for the dest index, see __partition_queries.
+            A None query selects all documents.
+
+        """
+        partitioning = ElasticsearchIndexes.PARTITIONED_INDICES.get(dest_index)
+        if partitioning is None or not self.__get_partitions(dest_index):
+            return [(dest_index, None, None)]
+        return [(self.__partition_for_record(dest_index, {partitioning["field"]: value}), query, script)
+                for value, query, script in self.__partition_queries(source_index, dest_index)] + [
+                (dest_index, self.__unpartitioned_query(dest_index), None)]
+
+    def __migration_partitions(self, index_name, new_index):
+        """
+        Like __reindex_partitions, for migrate_index: the documents of a partitioned
+        index go to the partitions of the new mapping version, which are created
+        but only added to the alias when it is swapped to new_index.
+        """
+        if index_name not in ElasticsearchIndexes.PARTITIONED_INDICES:
+            return [(new_index, None, None)]
+        partitions = []
+        for value, query, script in self.__partition_queries(index_name, index_name):
+            partition = self.__partition_name(index_name, value)
+            if not self.__index_exists(partition):
+                self.__create_index(index_name=partition, index_body=self.__partition_index_body(index_name))
+            partitions.append((partition, query, script))
+        partitions.append((new_index, self.__unpartitioned_query(index_name), None))
+        return partitions
+
+    def __unpartitioned_query(self, index_name):
+        # Selects the documents without the partitioning field, they are stored in the versioned base index
+        return {"bool": {"must_not": {"exists": {"field": ElasticsearchIndexes.PARTITIONED_INDICES[index_name]["field"]}}}}
+
+    def __partition_queries(self, source_index, index_name):
+        """
+        Returns a (value, query, script) tuple for every height bucket or run_id
+        of the partitioned index index_name that has documents in source_index.
+        The query, and the reindex script if it is not None, select these
+        documents, the value names their partition.
+
+        Values are listed with a composite aggregation. A field that can not be
+        aggregated on (run_id is a text field without keyword subfield in the
+        v1 mappings) is scanned for its values instead, and the script skips
+        the documents of other values, since a term query on text does not
+        match whole values.
+        """
+        partitioning = ElasticsearchIndexes.PARTITIONED_INDICES[index_name]
+        field = partitioning["field"]
+        aggregation_field = self.aggregatable_field(source_index, field)
+        if aggregation_field != field and not self.__field_exists(source_index, aggregation_field):
+            values = set()
+            query = {"_source": [field], "query": {"exists": {"field": field}}}
+            for hit in elasticsearch.helpers.scan(self.es_connection, query=query, index=source_index, size=5000):
+                values.add(hit["_source"][field])
+            script = {"source": "if (ctx._source[params.field] != params.value) { ctx.op = 'noop' }", "lang": "painless"}
+            return [(value, {"exists": {"field": field}}, {**script, "params": {"field": field, "value": value}})
+                    for value in sorted(values)]
+
+        if partitioning["size"]:
+            value_source = {"histogram": {"field": aggregation_field, "interval": partitioning["size"]}}
+        else:
+            value_source = {"terms": {"field": aggregation_field}}
+        body = {"size": 0, "aggs": {"values": {"composite": {"size": 1000, "sources": [{"value": value_source}]}}}}
+        queries = []
+        while True:
+            aggregation = self.es_connection.search(index=source_index, body=body, request_timeout=300)["aggregations"]["values"]
+            for bucket in aggregation["buckets"]:
+                value = bucket["key"]["value"]
+                if partitioning["size"]:
+                    value = int(value)
+                    query = {"range": {aggregation_field: {"gte": value, "lt": value + partitioning["size"]}}}
+                else:
+                    query = {"term": {aggregation_field: value}}
+                queries.append((value, query, None))
+            if "after_key" not in aggregation or not aggregation["buckets"]:
+                break
+            body["aggs"]["values"]["composite"]["after"] = aggregation["after_key"]
+        return queries
+
+    def __field_exists(self, index, field):
+        # True if field (e.g. a keyword subfield) is mapped in an index behind index.
+        mappings = self.es_connection.indices.get_field_mapping(index=index, fields=field)
+        return any(field in index_mapping["mappings"] for index_mapping in mappings.values())
+
+    #============================================
+    # Partitions
+    #============================================
+
+    def get_write_index(self, index_name, record):
+        # Concrete index (partition) a record for index_name is written to.
+        return self.__partition_for_record(index_name, record)
+
+    def __partition_for_record(self, index_name, record):
+        """
+        Returns the concrete index a record is written to. Records of partitioned
+        indices go to the backing index of their height bucket or run_id, which
+        is created and added to the alias on first use. Other records are written
+        to index_name itself.
+        """
+        partitioning = ElasticsearchIndexes.PARTITIONED_INDICES.get(index_name)
+        if partitioning is None or record.get(partitioning["field"]) is None:
+            return index_name
+        if not self.__get_partitions(index_name):
+            # Legacy index that is not an alias yet, it is partitioned after migrate_indices
+            return index_name
+
+        partition = self.__partition_name(index_name, record[partitioning["field"]])
+        if partition not in self.__get_partitions(index_name):
+            self.__create_partition(index_name, partition)
+        return partition
+
+    def __partition_name(self, index_name, value):
+        # Name of the backing index for a height or run_id of a partitioned index.
+        partitioning = ElasticsearchIndexes.PARTITIONED_INDICES[index_name]
+        base_index = self.__versioned_index_name(index_name)
+        if partitioning["size"]:
+            first_height = (value // partitioning["size"]) * partitioning["size"]
+            return "{}_h{:07d}".format(base_index, first_height)
+        # Index names must be lowercase and can not contain characters like / or :
+        slug = re.sub(r"[^a-z0-9]+", "-", str(value).lower()).strip("-")[:64]
+        digest = hashlib.sha1(str(value).encode("utf-8")).hexdigest()[:8]
+        return "{}_run-{}-{}".format(base_index, slug, digest)
+
+    def __get_partitions(self, index_name):
+        # Cached set of the indices behind the alias of a partitioned index.
+        if index_name not in self.__partitions:
+            self.__partitions[index_name] = set(self.__get_alias_indices(index_name))
+        return self.__partitions[index_name]
+
+    def __create_partition(self, index_name, partition):
+        if not self.__index_exists(partition):
+            self.__create_index(index_name=partition, index_body=self.__partition_index_body(index_name))
+        # An alias over several indices only accepts writes if one of them is the write index
+        self.es_connection.indices.update_aliases(body={"actions": [
+            {"add": {"index": self.__versioned_index_name(index_name), "alias": index_name, "is_write_index": True}},
+            {"add": {"index": partition, "alias": index_name, "is_write_index": False}}
+            ]})
+        self.__get_partitions(index_name).add(partition)
+        self.logger.info("Added partition [{}] to alias [{}]".format(partition, index_name))
+
+    def __ensure_write_index(self, index_name):
+        # Makes the versioned index the write index of the alias of a partitioned index, for partitions added without one.
+        base_index = self.__versioned_index_name(index_name)
+        aliases = self.es_connection.indices.get_alias(name=index_name)
+        if aliases.get(base_index, {}).get("aliases", {}).get(index_name, {}).get("is_write_index"):
+            return
+        self.logger.info("Making [{}] the write index of alias [{}]".format(base_index, index_name))
+        self.es_connection.indices.update_aliases(body={"actions": [
+            {"add": {"index": base_index, "alias": index_name, "is_write_index": True}}
+            ]})
+
+    def __height_partitions(self, index_name):
+        """
+        Returns a dict that maps the height partitions of index_name to
+        the (first_height, last_height) they hold.
+        """
+        partitioning = ElasticsearchIndexes.PARTITIONED_INDICES.get(index_name)
+        if partitioning is None or not partitioning["size"]:
+            return {}
+        height_partitions = {}
+        for partition in self.__get_partitions(index_name):
+            match = re.search(r"_h(\d{7})$", partition)
+            if match:
+                first_height = int(match.group(1))
+                height_partitions[partition] = (first_height, first_height + partitioning["size"] - 1)
+        return height_partitions
+
+    def partitions_for_height_range(self, index_name, start_height, end_height):
+        """
+        Returns the indices that can hold documents with a height between
+        start_height and end_height: the overlapping height partitions and all
+        other indices behind the alias (e.g. migrated data without partitions).
+        Returns [index_name] if the index is not partitioned by height.
+        """
+        height_partitions = self.__height_partitions(index_name)
+        if not height_partitions:
+            return [index_name]
+        indices = [index for index in self.__get_partitions(index_name) if index not in height_partitions]
+        indices.extend(partition for partition, (first_height, last_height) in height_partitions.items()
+                       if first_height <= end_height and start_height <= last_height)
+        return sorted(indices)
+
+    def get_partition_for_value(self, index_name, value):
+        """
+        Returns the name of the partition that holds documents with the given
+        height or run_id, None if no such partition exists.
+        """
+        if index_name not in ElasticsearchIndexes.PARTITIONED_INDICES:
+            return None
+        partition = self.__partition_name(index_name, value)
+        return partition if partition in self.__get_partitions(index_name) else None
+
+    def drop_partition(self, index_name, partition):
+        """
+        Deletes a backing index of a partitioned index, dropping all documents of
+        its height bucket or run at once.
+        """
+        if partition not in self.__get_partitions(index_name) or partition == self.__versioned_index_name(index_name):
+            self.logger.error("[{}] is not a partition of index [{}]".format(partition, index_name))
+            return False
+        self.logger.info("Dropping partition [{}] of index [{}]".format(partition, index_name))
+        self.es_connection.indices.delete(index=partition)
+        self.__get_partitions(index_name).discard(partition)
+        return True
+
+
+    #============================================
+    # Bulk ingest
+    #============================================
+
+    # Settings applied to indices while bulk ingesting. Documents are not made
+    # searchable until the ingest is done and the translog is fsynced in the
+    # background instead of on every request.
+    BULK_INGEST_SETTINGS = {
+        "index.refresh_interval": "-1",
+        "index.translog.durability": "async"
+        }
+
+    @contextmanager
+    def bulk_ingest(self, index_names, force_merge=False):
+        """
+        Context manager that relaxes the refresh interval and translog durability
+        of the given indices during a large write, e.g.:
+
+            with es_controller.bulk_ingest(["blocks_from_scrapers_updated"]):
+                es_controller.bulk_store(...)
+
+        The original settings are restored on exit, also when an exception or
+        KeyboardInterrupt is raised. They are written to a file per process
+        first, so they are restored by the next controller that is created
+        after the process crashed. Indices that are also bulk ingested by
+        another running process keep the relaxed settings until the last
+        ingest is done. Afterwards the indices are refreshed and optionally
+        force merged.
+
+        Parameters
+        ----------
+        index_names : list of strings
+            Indices (or aliases) that are written to.
+        force_merge : Boolean
+            Force merge the indices to a single segment after the ingest.
+
+        """
+        indices = []
+        for index_name in index_names:
+            indices.extend(self.__get_alias_indices(index_name) or [index_name])
+        index_list = ",".join(indices)
+
+        with self.__bulk_ingest_lock():
+            # Indices relaxed by another ingest already have the bulk settings, keep the originals it saved
+            saved_settings = {}
+            for settings in self.__saved_bulk_ingest_settings().values():
+                saved_settings.update(settings)
+            original_settings = {}
+            response = self.es_connection.indices.get_settings(index=index_list, flat_settings=True)
+            for index, index_settings in response.items():
+                # None resets a setting that was not set explicitly to its default
+                original_settings[index] = saved_settings.get(index, {key: index_settings["settings"].get(key) for key in self.BULK_INGEST_SETTINGS})
+            self.__save_bulk_ingest_settings(original_settings)
+
+        docs_before = self.es_connection.count(index=index_list)["count"]
+        start = time.time()
+        self.logger.info("Starting bulk ingest on indices {}".format(indices))
+        self.es_connection.indices.put_settings(index=index_list, body=self.BULK_INGEST_SETTINGS)
+        try:
+            yield
+        finally:
+            self.__restore_bulk_ingest_settings(os.getpid())
+            self.es_connection.indices.refresh(index=index_list)
+            elapsed = time.time() - start
+            docs_written = self.es_connection.count(index=index_list)["count"] - docs_before
+            self.logger.info("Bulk ingest done: {} documents in {:.1f} seconds ({:.1f} docs/s)".format(
+                docs_written, elapsed, docs_written / elapsed if elapsed > 0 else 0))
+            if force_merge:
+                self.logger.info("Force merging indices {}".format(indices))
+                self.es_connection.indices.forcemerge(index=index_list, max_num_segments=1, request_timeout=3600)
+                self.logger.info("Force merge done.")
+
+    def __bulk_ingest_settings_path(self, pid):
+        # Original settings saved by the bulk ingest of process pid
+        return Utils.getCurrentPath() + '/../logs/bulk_ingest_settings.{}.json'.format(pid)
+
+    @contextmanager
+    def __bulk_ingest_lock(self):
+        # Serializes saving and restoring settings between processes
+        with open(Utils.getCurrentPath() + '/../logs/bulk_ingest_settings.lock', mode='w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __saved_bulk_ingest_settings(self):
+        # Original settings saved by bulk ingests, per pid of the process that saved them.
+        saved_settings = {}
+        for path in glob.glob(self.__bulk_ingest_settings_path("*")):
+            match = re.search(r"\.(\d+)\.json$", path)
+            if match is None:
+                continue
+            with open(path, mode='r', encoding='utf-8') as file:
+                saved_settings[int(match.group(1))] = json.load(file)
+        return saved_settings
+
+    @staticmethod
+    def __process_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # Running under another user
+            return True
+        return True
+
+    def __save_bulk_ingest_settings(self, original_settings):
+        with open(self.__bulk_ingest_settings_path(os.getpid()), mode='w', encoding='utf-8') as outfile:
+            json.dump(original_settings, outfile, indent=4)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def __restore_bulk_ingest_settings(self, pid):
+        """
+        Restores the index settings saved by the bulk ingest of process pid.
+        Indices that another running process is still bulk ingesting are
+        skipped, that process restores them when it is done.
+        """
+        with self.__bulk_ingest_lock():
+            saved_settings = self.__saved_bulk_ingest_settings()
+            original_settings = saved_settings.pop(pid, None)
+            if original_settings is None:
+                return
+            ingesting = {index for other_pid, settings in saved_settings.items() if self.__process_alive(other_pid) for index in settings}
+            for index, index_settings in original_settings.items():
+                if index in ingesting:
+                    self.logger.info("Index [{}] is still bulk ingested by another process, leaving its settings.".format(index))
+                    continue
+                if not self.__index_exists(index):
+                    continue
+                self.logger.info("Restoring settings of index [{}]: {}".format(index, index_settings))
+                self.es_connection.indices.put_settings(index=index, body=index_settings)
+            os.remove(self.__bulk_ingest_settings_path(pid))
+
+    def __recover_bulk_ingest_settings(self):
+        # Restores the settings of bulk ingests whose process died before restoring them.
+        for pid in self.__saved_bulk_ingest_settings():
+            if not self.__process_alive(pid):
+                self.logger.warning("The bulk ingest of process {} did not finish, restoring its index settings.".format(pid))
+                self.__restore_bulk_ingest_settings(pid)
+
+
+    #============================================
+    # Server side tasks
+    #============================================
+
+    def submit_reindex(self, source_index, dest_index, create_only=False, requests_per_second=None, query=None, script=None):
+        """
+        Submits a reindex from source_index to dest_index as a server side task.
+
+        Parameters
+        ----------
+        source_index : string
+            Index (or alias) to copy the documents from.
+        dest_index : string
+            Index to copy the documents to.
+        create_only : Boolean
+            Skip documents that already exist in dest_index.
+        requests_per_second : float, optional
+            Throttles the reindex, unthrottled by default.
+        query : dict, optional
+            Only reindex the documents matching this query (query DSL).
+        script : dict, optional
+            Painless script run on every document, see the reindex API.
+
+        Returns
+        -------
+        task_id : string
+            Id of the task, used to track its progress.
+
+        """
         assert(self.__index_exists(source_index) and self.__index_exists(dest_index))
-        self.logger.info("Reindexing data from index [{}] to [{}]".format(source_index, dest_index))
-        result = self.es_connection.reindex({
+        self.logger.info("Submitting reindex of data from index [{}] to [{}]".format(source_index, dest_index))
+        body = {
             "source": {"index": source_index},
             "dest": {"index": dest_index}
-            }, wait_for_completion=True, request_timeout=300)
-        self.logger.debug("Result:  {}".format(result))
-        
-        if result['total'] and result['took'] and not result['timed_out']:
-            self.logger.debug("Seems reindex was successfull. You can now delete index [{}]".format(source_index))
-        else:
-            self.logger.debug("Something went wrong.")
-            
-       
+            }
+        if query is not None:
+            body["source"]["query"] = query
+        if script is not None:
+            body["script"] = script
+        if create_only:
+            body["dest"]["op_type"] = "create"
+            body["conflicts"] = "proceed"
+        response = self.es_connection.reindex(body,
+                                              wait_for_completion=False,
+                                              slices="auto",
+                                              requests_per_second=requests_per_second if requests_per_second else -1)
+        task_id = response["task"]
+        self.__save_pending_task(task_id, "reindex {} -> {}".format(source_index, dest_index))
+        return task_id
+
+    def submit_delete_by_range(self, index, start_height, end_height, field="block_height", requests_per_second=None):
+        """
+        Submits the deletion of all documents with start_height <= field <= end_height
+        as a sliced server side delete by query task.
+
+        Returns
+        -------
+        task_id : string
+            Id of the task, used to track its progress.
+
+        """
+        assert(self.__index_exists(index))
+        if field == "block_height":
+            # Partitions that lie entirely within the range are dropped as a whole
+            for partition, (first_height, last_height) in self.__height_partitions(index).items():
+                if start_height <= first_height and last_height <= end_height:
+                    self.drop_partition(index, partition)
+            index = ",".join(self.partitions_for_height_range(index, start_height, end_height))
+        self.logger.info("Submitting deletion of documents in index [{}] with {} between {} and {}".format(index, field, start_height, end_height))
+        body = {
+            "query": {
+                "bool": {
+                    "filter": [{"range": {field: {"gte": start_height, "lte": end_height}}}]
+                    }
+                }
+            }
+        response = self.es_connection.delete_by_query(index=index,
+                                                      body=body,
+                                                      wait_for_completion=False,
+                                                      slices="auto",
+                                                      conflicts="proceed",
+                                                      requests_per_second=requests_per_second if requests_per_second else -1)
+        task_id = response["task"]
+        self.__save_pending_task(task_id, "delete {} {}-{} from {}".format(field, start_height, end_height, index))
+        return task_id
+
+    def delete_by_range(self, index, start_height, end_height, field="block_height", requests_per_second=None):
+        """
+        Deletes the documents with start_height <= field <= end_height with a
+        server side task (see submit_delete_by_range) and waits until it is done.
+
+        Returns
+        -------
+        deleted : int
+            Number of deleted documents, None if the task failed.
+
+        """
+        task_id = self.submit_delete_by_range(index=index,
+                                              start_height=start_height,
+                                              end_height=end_height,
+                                              field=field,
+                                              requests_per_second=requests_per_second)
+        self.logger.info("Use the track_tasks command to resume tracking task [{}] after a disconnect.".format(task_id))
+        result = self.wait_for_task(task_id)
+        return None if result is None else result["deleted"]
+
+    def get_task(self, task_id):
+        """
+        Returns the state of a server side task: a dict with the keys completed,
+        task (including the status with progress counters) and, once completed,
+        response or error.
+
+        """
+        return self.es_connection.tasks.get(task_id=task_id)
+
+    def wait_for_task(self, task_id, poll_interval=10):
+        """
+        Polls a server side task until it is completed and logs its progress.
+        Can be called again for the same task after the client disconnected,
+        ES keeps the result of completed tasks in the .tasks index.
+
+        Returns
+        -------
+        response : dict
+            Response of the completed task, None if the task failed.
+
+        """
+        self.logger.info("Tracking progress of task [{}]".format(task_id))
+        while True:
+            try:
+                task = self.get_task(task_id)
+            except elasticsearch.exceptions.NotFoundError:
+                self.logger.error("Task [{}] was not found.".format(task_id))
+                self.__remove_pending_task(task_id)
+                return None
+            except Exception as ex:
+                self.logger.warning("Couldn't get the status of task [{}]: {}. Trying again.".format(task_id, str(ex)))
+                time.sleep(poll_interval)
+                continue
+
+            status = task["task"].get("status", {})
+            done = status.get("created", 0) + status.get("updated", 0) + status.get("deleted", 0) + status.get("version_conflicts", 0)
+            total = status.get("total", 0)
+            self.logger.info("Task [{}]: {} out of {} documents processed.".format(task_id, done, total))
+
+            if task["completed"]:
+                break
+            time.sleep(poll_interval)
+
+        self.__remove_pending_task(task_id)
+        if "error" in task:
+            self.logger.error("Task [{}] failed: {}".format(task_id, task["error"]))
+            return None
+        self.logger.info("Task [{}] completed.".format(task_id))
+        return task.get("response")
+
+    def get_pending_tasks(self):
+        """
+        Returns the tasks submitted by this application that have not been tracked
+        to completion, as a dict mapping task ids to their descriptions.
+        """
+        try:
+            with open(self.__pending_tasks_path(), mode='r', encoding='utf-8') as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    def __pending_tasks_path(self):
+        return Utils.getCurrentPath() + '/../logs/es_tasks.json'
+
+    def __save_pending_task(self, task_id, description):
+        # Keep track of submitted tasks so their progress can be resumed after a disconnect.
+        self.logger.info("Submitted task [{}]: {}".format(task_id, description))
+        tasks = self.get_pending_tasks()
+        tasks[task_id] = description
+        with open(self.__pending_tasks_path(), mode='w', encoding='utf-8') as outfile:
+            json.dump(tasks, outfile, indent=4)
+
+    def __remove_pending_task(self, task_id):
+        tasks = self.get_pending_tasks()
+        if tasks.pop(task_id, None) is not None:
+            with open(self.__pending_tasks_path(), mode='w', encoding='utf-8') as outfile:
+                json.dump(tasks, outfile, indent=4)
+
+
     def isConnected(self):
         connected = False
         self.logger.debug("Checking if es_connection is connected to an Elasticsearch instance.")
@@ -346,7 +1521,10 @@ class ElasticsearchIndexes():
     INDEX_NAMES = ["blocks_from_scrapers_updated", 
                    "skipped_blocks", 
                    "api_block_data_conflicts", 
-                   "block_attributions"]
+                   "block_attributions",
+                   "pool_rollups",
+                   "compact_attributions",
+                   "pool_dictionary"]
     
     SETTINGS = {
             "settings" : {
@@ -494,10 +1672,203 @@ class ElasticsearchIndexes():
                     }                
                 }
             }
+        }
 
+    # Indices whose documents are spread over several backing indices behind
+    # the index alias, one per block of "size" heights or one per run_id.
+    # A whole height range or run is dropped by deleting its backing index.
+    # Documents without the field are stored in the versioned base index.
+    # Partitions use the settings of their index, with number_of_shards if set:
+    # every attribution run adds a partition, one shard each keeps the shard count of the cluster in check.
+    PARTITIONED_INDICES = {
+        "blocks_from_scrapers_updated": {"field": "block_height", "size": 100000, "number_of_shards": None},
+        "block_attributions": {"field": "run_id", "size": None, "number_of_shards": 1},
+        "compact_attributions": {"field": "run_id", "size": None, "number_of_shards": 1}
+        }
 
+    # Mapping version used for the concrete index behind each index alias,
+    # e.g. alias "skipped_blocks" -> index "skipped_blocks_v2".
+    # Bump the version and add a new entry to VERSIONED_SETTINGS and
+    # VERSIONED_MAPPINGS when a mapping changes, then run migrate_indices.
+    INDEX_VERSIONS = {
+        "blocks_from_scrapers_updated": 2,
+        "skipped_blocks": 2,
+        "api_block_data_conflicts": 3,
+        "block_attributions": 2,
+        "pool_rollups": 2,
+        "compact_attributions": 2,
+        "pool_dictionary": 2
         }
-    
 
-    
-    
\ No newline at end of file
+    # Index sorting on block_height keeps documents of neighbouring heights
+    # together on disk, so range queries and height ordered scans can stop early.
+    # Sorting is not allowed on indices with nested fields, the v2 mappings
+    # therefore store the per source results as (non-indexed) objects.
+    SORTED_BY_HEIGHT = {
+        "settings" : {
+            "number_of_shards": 5,
+            "number_of_replicas": 0,
+            "index": {
+                "sort.field": "block_height",
+                "sort.order": "asc"
+                }
+            }
+        }
+
+    # Rollup rows are small and few, one shard sorted by day suffices.
+    SORTED_BY_DAY = {
+        "settings" : {
+            "number_of_shards": 1,
+            "number_of_replicas": 0,
+            "index": {
+                "sort.field": "day",
+                "sort.order": "asc"
+                }
+            }
+        }
+
+    SINGLE_SHARD = {
+        "settings" : {
+            "number_of_shards": 1,
+            "number_of_replicas": 0
+            }
+        }
+
+    VERSIONED_SETTINGS = {
+        1: dict.fromkeys(INDEX_NAMES, SETTINGS),
+        2: {**dict.fromkeys(INDEX_NAMES, SORTED_BY_HEIGHT), "pool_rollups": SORTED_BY_DAY, "pool_dictionary": SINGLE_SHARD},
+        3: {"api_block_data_conflicts": SORTED_BY_HEIGHT}
+        }
+
+    # Identifiers are keywords (exact term lookups, doc values for sorting and
+    # aggregations), text fields have norms disabled since no scoring is needed.
+    # Objects that are only read back are not indexed at all (enabled: false).
+    VERSIONED_MAPPINGS = {
+        1: MAPPINGS,
+        2: {
+            "blocks_from_scrapers_updated": {
+                "mappings": {
+                    "properties": {
+                        "block_hash": {"type": "keyword"},
+                        "prev_block_hash": {"type": "keyword"},
+                        "block_height": {"type": "integer"},
+                        "timestamp" : {"type": "date"},
+                        "coinbase_tx_hash": {"type": "keyword"},
+                        "coinbase_message": {
+                            "type": "text",
+                            "norms": False,
+                            "fields": {
+                                "wildcard": {"type": "wildcard"}
+                                }
+                            },
+                        "payout_addresses": {"type": "keyword"},
+                        "fee_block_reward": {"type": "long"},
+                        "total_block_reward": {"type": "long"}
+                        }
+                    }
+                },
+            "skipped_blocks": {
+                "mappings": {
+                    "properties": {
+                        "block_height": {"type": "integer"},
+                        "block_hash": {"type": "keyword"},
+                        "reason_for_skipping": {"type": "keyword"}
+                        }
+                    }
+                },
+            "api_block_data_conflicts": {
+                "mappings": {
+                    "properties": {
+                        "block_height": {"type": "integer"},
+                        "block_hash": {"type": "keyword"},
+                        "gathered_data": {
+                            "type": "object",
+                            "enabled": False
+                            }
+                        }
+                    }
+                },
+            "block_attributions": {
+                "mappings": {
+                    "properties": {
+                        "run_id": {"type": "keyword"},
+                        "block_height": {"type": "integer"},
+                        "block_hash": {"type": "keyword"},
+                        "timestamp" : {"type": "date"},
+                        "coinbase_message": {"type": "text", "norms": False},
+                        "payout_addresses": {"type": "keyword"},
+                        "fee_block_reward": {"type": "long"},
+                        "total_block_reward": {"type": "long"},
+                        "0xB10C_results": {"type": "object", "enabled": False},
+                        "0xB10C_attribution" : {"type": "keyword"},
+                        "Blockchain_com_results": {"type": "object", "enabled": False},
+                        "Blockchain_com_attribution" : {"type": "keyword"},
+                        "BTC_com_results": {"type": "object", "enabled": False},
+                        "BTC_com_attribution" : {"type": "keyword"},
+                        "My_inital_results": {"type": "object", "enabled": False},
+                        "My_initial_attribution" : {"type": "keyword"},
+                        "My_updated_results": {"type": "object", "enabled": False},
+                        "My_updated_attribution" : {"type": "keyword"}
+                        }
+                    }
+                },
+            # Blocks per run, attribution source, day and pool, see rollup.py
+            "pool_rollups": {
+                "mappings": {
+                    "properties": {
+                        "run_id": {"type": "keyword"},
+                        "source": {"type": "keyword"},
+                        "day": {"type": "date", "format": "yyyy-MM-dd"},
+                        "pool": {"type": "keyword"},
+                        "block_count": {"type": "long"},
+                        "total_block_reward": {"type": "long"},
+                        "fee_block_reward": {"type": "long"},
+                        "unknown_block_count": {"type": "long"}
+                        }
+                    }
+                },
+            # See compact_attributions.py
+            "compact_attributions": {
+                "mappings": {
+                    "properties": {
+                        "run_id": {"type": "keyword"},
+                        "block_height": {"type": "integer"},
+                        "block_hash": {"type": "keyword"},
+                        "0xB10C_pool": {"type": "short"},
+                        "Blockchain_com_pool": {"type": "short"},
+                        "BTC_com_pool": {"type": "short"},
+                        "My_initial_pool": {"type": "short"},
+                        "My_updated_pool": {"type": "short"},
+                        "agree": {"type": "boolean"},
+                        "multiple_matches": {"type": "byte"},
+                        "details": {"type": "object", "enabled": False}
+                        }
+                    }
+                },
+            "pool_dictionary": {
+                "mappings": {
+                    "properties": {
+                        "pool_id": {"type": "short"},
+                        "pool_name": {"type": "keyword"}
+                        }
+                    }
+                }
+            },
+        3: {
+            # Delta encoded conflicts, see conflicts.py. gathered_data holds
+            # records from before the delta encoding.
+            "api_block_data_conflicts": {
+                "mappings": {
+                    "properties": {
+                        "block_height": {"type": "integer"},
+                        "block_hash": {"type": "keyword"},
+                        "scrapers": {"type": "keyword"},
+                        "base_block": {"type": "object", "enabled": False},
+                        "conflicting_fields": {"type": "keyword"},
+                        "diffs": {"type": "object", "enabled": False},
+                        "gathered_data": {"type": "object", "enabled": False}
+                        }
+                    }
+                }
+            }
+        }
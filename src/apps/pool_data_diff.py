@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Finds the coinbase tags and payout addresses whose attribution changed
+between two versions of the known-pools data.
+
+The attribution of a block by a source only depends on the tags of the
+source that occur in its coinbase message and the addresses of the source it
+pays to. A block therefore only needs to be attributed again if it contains
+a tag or address that was added, removed or moved to another pool in any of
+the sources, see BMPIFunctions.reattributeChangedBlocks.
+
+@author: Mischa van Reede
+"""
+
+import json
+
+from .attribute_blocks import BlockAnalyser
+
+
+def load_pool_datasets(known_pools_path, logger):
+    """
+    Loads the data of every source from a known-pools directory, in the order
+    of BlockAnalyser.SOURCES. Missing files are returned as None.
+    """
+    datasets = []
+    for _, file_path in BlockAnalyser.DATASET_FILES:
+        try:
+            with open(known_pools_path + file_path, mode='r', encoding="utf8") as file:
+                datasets.append(json.load(file))
+        except IOError:
+            logger.warning("Could not load [{}], treating it as empty.".format(known_pools_path + file_path))
+            datasets.append(None)
+    return datasets
+
+
+def diff_pool_data(old_datasets, new_datasets):
+    """
+    Compares the datasets of every source.
+
+    Returns
+    -------
+    changes : dict
+        The changed "coinbase_tags" and "payout_addresses", as sets. An entry
+        is changed if it exists in only one of the versions or its pool name differs.
+
+    """
+    changes = {"coinbase_tags": set(), "payout_addresses": set()}
+    for old_data, new_data in zip(old_datasets, new_datasets):
+        for record_type, changed in changes.items():
+            old_records = old_data[record_type] if old_data is not None else {}
+            new_records = new_data[record_type] if new_data is not None else {}
+            for key in old_records.keys() | new_records.keys():
+                if key not in old_records or key not in new_records or old_records[key]["name"] != new_records[key]["name"]:
+                    changed.add(key)
+    return changes
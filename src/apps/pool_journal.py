@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+A class file for the journal of entries added to a known-pools data file.
+
+Rewriting a known-pools file for every added payout address or coinbase tag
+means serializing the whole file each time. Instead, added entries are
+appended to a journal next to the file, one JSON encoded line per entry:
+
+    {"record_type": "payout_addresses", "key": "1Abc...", "record": {"name": "..."}}
+
+The journal is compacted into the data file (rewritten once, then the journal
+is emptied) at most every compact_interval seconds and when the writer is
+done. If a run stops before compacting, the next writer replays the journal
+when it takes the journal, so no entry is lost. Only the process holding
+<data_file_path>.journal.lock appends to, replays or compacts the journal.
+
+@author: Mischa van Reede
+"""
+
+import os
+import json
+import time
+import fcntl
+
+
+class PoolDataJournal():
+
+
+    def __init__(self, logger, data_file_path, compact_interval=60):
+        """
+        Parameters
+        ----------
+        logger : Logger
+        data_file_path : string
+            Known-pools data file, the journal is <data_file_path>.journal.
+        compact_interval : int
+            Minimum number of seconds between two compactions.
+
+        """
+        self.logger = logger
+        self.data_file_path = data_file_path
+        self.journal_path = data_file_path + ".journal"
+        self.compact_interval = compact_interval
+
+        self.__file = None
+        self.__lock_file = None
+        self.__pending_entries = 0
+        self.__last_compaction = time.monotonic()
+
+    def acquire(self):
+        """
+        Makes this the writer of the journal, until close.
+
+        Returns
+        -------
+        acquired : bool
+            False if another process writes the journal.
+
+        """
+        if self.__lock_file is not None:
+            return True
+        lock_file = open(self.journal_path + ".lock", mode='w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.__lock_file = lock_file
+        return True
+
+    def replay(self):
+        """
+        Reads the entries left in the journal by a previous run.
+
+        Returns
+        -------
+        entries : list
+            (record_type, key, record) tuples, in the order they were added.
+
+        """
+        entries = []
+        if not os.path.exists(self.journal_path):
+            return entries
+        with open(self.journal_path, mode='r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written last line of a run that stopped while appending
+                    self.logger.warning("Skipping incomplete journal line in {}".format(self.journal_path))
+                    continue
+                entries.append((entry["record_type"], entry["key"], entry["record"]))
+        self.__pending_entries = len(entries)
+        if entries:
+            self.logger.info("Replayed {} entries from {}".format(len(entries), self.journal_path))
+        return entries
+
+    def __open(self):
+        # Starts on a new line if the last line was only partially written
+        partial_line = False
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > 0:
+            with open(self.journal_path, mode='rb') as file:
+                file.seek(-1, os.SEEK_END)
+                partial_line = file.read(1) != b"\n"
+        self.__file = open(self.journal_path, mode='a', encoding='utf-8')
+        if partial_line:
+            self.__file.write("\n")
+
+    def append(self, record_type, key, record):
+        # Appends an entry, it is durable when this returns. Requires acquire.
+        if self.__file is None:
+            self.__open()
+        self.__file.write(json.dumps({"record_type": record_type, "key": key, "record": record}) + "\n")
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__pending_entries += 1
+
+    def compaction_due(self):
+        return self.__pending_entries > 0 and time.monotonic() - self.__last_compaction >= self.compact_interval
+
+    def compact(self, data):
+        """
+        Writes data, which includes all journaled entries, to the data file and
+        empties the journal. The data file is replaced atomically, a crash
+        leaves either the old file and the journal or the new file.
+        """
+        if self.__pending_entries == 0:
+            return
+        self.logger.info("Writing {} journaled entries to {}".format(self.__pending_entries, self.data_file_path))
+        temporary_path = self.data_file_path + ".tmp"
+        with open(temporary_path, mode='w', encoding='utf-8') as outfile:
+            json.dump(data, outfile, sort_keys=True, indent=4)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(temporary_path, self.data_file_path)
+
+        self.__close_file()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.__pending_entries = 0
+        self.__last_compaction = time.monotonic()
+        self.logger.info("{} updated.".format(self.data_file_path))
+
+    def __close_file(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def close(self):
+        # Closes the journal and releases it to other writers.
+        self.__close_file()
+        if self.__lock_file is not None:
+            self.__lock_file.close()
+            self.__lock_file = None
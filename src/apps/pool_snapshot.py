@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+A binary snapshot of the compiled known-pools data, for a fast start of BlockAnalyser.
+
+Loading the known-pools JSON files and building the unified index of
+BlockAnalyser (tag matcher, address table and filter) is done once by
+compile_known_pools, which writes the result to known-pools/pools.snapshot.
+BlockAnalyser loads the snapshot instead, if it was compiled from the current
+files. The snapshot is memory mapped, the address table arrays are used in
+place and shared by all processes that load the snapshot.
+
+File layout (native byte order, sections are 8-byte aligned):
+
+    b"BMPISNAP"                 magic
+    uint32 little-endian        length of the header
+    4 bytes                     padding
+    header                      JSON, see write_snapshot()
+    keys section                uint64 per address, see address_table.py
+    masks section               uint8 per address
+    pool_ids section            int32 per address and source
+    data section                marshal encoded dict with the rest of the index
+
+The header holds the SHA-256 hash of every source file and the attribution
+sources in the order of the address table columns. A snapshot of other files,
+other sources, another format version or another byte order is not loaded,
+nor is one whose sections do not match its header.
+
+@author: Mischa van Reede
+"""
+
+import sys
+import os
+import json
+import mmap
+import marshal
+import hashlib
+
+
+MAGIC = b"BMPISNAP"
+FORMAT_VERSION = 2
+SNAPSHOT_FILE = "pools.snapshot"
+
+ARRAY_SECTIONS = [("keys", "Q"), ("masks", "B"), ("pool_ids", "i")]
+
+
+def source_hashes(known_pools_path, file_paths):
+    # SHA-256 of every source file, None for missing files.
+    hashes = {}
+    for file_path in file_paths:
+        try:
+            with open(known_pools_path + file_path, mode='rb') as file:
+                hashes[file_path] = hashlib.sha256(file.read()).hexdigest()
+        except IOError:
+            hashes[file_path] = None
+    return hashes
+
+
+def _align(offset):
+    return (offset + 7) // 8 * 8
+
+
+def write_snapshot(snapshot_path, hashes, sources, arrays, data):
+    """
+    Writes a snapshot, replacing the file atomically.
+
+    Parameters
+    ----------
+    snapshot_path : string
+    hashes : dict
+        Hashes of the source files, see source_hashes().
+    sources : list
+        [source name, dataset file] of every attribution source, in the order
+        of the address table columns and of the datasets in data.
+    arrays : dict
+        Address table arrays by section name, see ARRAY_SECTIONS.
+    data : dict
+        Rest of the index, only types supported by marshal. Holds "datasets"
+        and "tag_matchers" lists with an entry per source.
+
+    """
+    sections = [(name, arrays[name].tobytes()) for name, _ in ARRAY_SECTIONS]
+    sections.append(("data", marshal.dumps(data)))
+
+    offsets = {}
+    offset = 0
+    for name, content in sections:
+        offsets[name] = [offset, len(content)]
+        offset = _align(offset + len(content))
+    header = json.dumps({
+        "format_version": FORMAT_VERSION,
+        "byteorder": sys.byteorder,
+        "source_hashes": hashes,
+        "sources": sources,
+        "source_count": len(sources),
+        "sections": offsets
+        }).encode("utf-8")
+    body_start = _align(16 + len(header))
+
+    temporary_path = snapshot_path + ".tmp"
+    with open(temporary_path, mode='wb') as file:
+        file.write(MAGIC + len(header).to_bytes(4, "little") + bytes(4) + header)
+        file.write(bytes(body_start - 16 - len(header)))
+        for name, content in sections:
+            file.write(content)
+            file.write(bytes(_align(len(content)) - len(content)))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, snapshot_path)
+
+
+def load_snapshot(snapshot_path, hashes, sources, logger):
+    """
+    Memory maps a snapshot.
+
+    Returns
+    -------
+    snapshot : dict or None
+        source_count, the address table arrays as memoryviews by section
+        name and data. None if there is no valid snapshot of the current source
+        files (hashes) and sources (see write_snapshot) in this format.
+
+    """
+    try:
+        with open(snapshot_path, mode='rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError):
+        # Missing or empty file
+        logger.debug("No known-pools snapshot at [{}]".format(snapshot_path))
+        return None
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        logger.warning("[{}] is not a known-pools snapshot, ignoring it.".format(snapshot_path))
+        return None
+    header_length = int.from_bytes(buffer[8:12], "little")
+    header = json.loads(buffer[16:16+header_length].decode("utf-8"))
+    if header["format_version"] != FORMAT_VERSION or header["byteorder"] != sys.byteorder:
+        logger.info("Known-pools snapshot [{}] has another format, run compile_known_pools.".format(snapshot_path))
+        return None
+    if header["source_hashes"] != hashes:
+        logger.info("Known-pools files changed since [{}] was compiled, run compile_known_pools.".format(snapshot_path))
+        return None
+    if header["sources"] != sources or header["source_count"] != len(sources):
+        logger.info("Known-pools snapshot [{}] was compiled for other sources, run compile_known_pools.".format(snapshot_path))
+        return None
+
+    body = memoryview(buffer)[_align(16 + header_length):]
+    def section(name):
+        offset, length = header["sections"][name]
+        return body[offset:offset+length]
+
+    snapshot = None
+    if _valid_sections(header, len(body)):
+        try:
+            snapshot = {"source_count": header["source_count"], "data": marshal.loads(section("data"))}
+        except (EOFError, ValueError, TypeError):
+            snapshot = None
+    if snapshot is None or any(len(snapshot["data"][name]) != len(sources) for name in ("datasets", "tag_matchers")):
+        logger.warning("Known-pools snapshot [{}] is damaged, ignoring it. Run compile_known_pools.".format(snapshot_path))
+        return None
+    for name, typecode in ARRAY_SECTIONS:
+        snapshot[name] = section(name).cast(typecode)
+    logger.debug("Loaded known-pools snapshot [{}]".format(snapshot_path))
+    return snapshot
+
+
+def _valid_sections(header, body_length):
+    # The sections lie within the file and the address table arrays have the sizes of source_count columns.
+    sections = header["sections"]
+    if any(name not in sections or sections[name][0] < 0 or sum(sections[name]) > body_length
+           for name in [name for name, _ in ARRAY_SECTIONS] + ["data"]):
+        return False
+    address_count, remainder = divmod(sections["keys"][1], 8)
+    return (remainder == 0
+            and sections["masks"][1] == address_count
+            and sections["pool_ids"][1] == address_count * 4 * header["source_count"])
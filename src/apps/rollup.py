@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+A class file that maintains the pool_rollups index.
+
+The rollup index holds one row per attribution run, attribution source, day
+and pool with the number of blocks, the summed block and fee rewards and the
+number of blocks without a known pool. Rows are updated incrementally while
+blocks are attributed and can be rebuilt from the block_attributions index.
+Share charts over the whole chain read a few thousand rows instead of all
+attribution documents.
+
+Rows have a deterministic id, adding the same block twice counts it twice.
+Rebuild the rollups of a run after attributing a height range again.
+
+@author: Mischa van Reede
+"""
+
+import hashlib
+from datetime import datetime, timezone
+
+from .analytics import ATTRIBUTION_FIELDS, UNKNOWN_POOL
+
+
+class PoolRollup():
+
+    COUNTERS = ["block_count", "total_block_reward", "fee_block_reward", "unknown_block_count"]
+
+
+    def __init__(self, es_controller, logger, index="pool_rollups", attribution_index="block_attributions", flush_interval=1000):
+        self.es_controller = es_controller
+        self.logger = logger
+        self.index = index
+        self.attribution_index = attribution_index
+        self.flush_interval = flush_interval
+
+        # Row id -> row with the counts that are not written yet
+        self.__pending_rows = {}
+        self.__pending_blocks = 0
+
+    def __row(self, run_id, source, day, pool):
+        row_id = hashlib.sha1("|".join([run_id, source, day, pool]).encode("utf-8")).hexdigest()
+        if row_id not in self.__pending_rows:
+            self.__pending_rows[row_id] = {"run_id": run_id, "source": source, "day": day, "pool": pool,
+                                           **dict.fromkeys(self.COUNTERS, 0)}
+        return self.__pending_rows[row_id]
+
+    #============================================
+    # Incremental updates
+    #============================================
+
+    def add(self, attribution):
+        """
+        Counts a stored block_attributions document. The counts are written
+        every flush_interval blocks and on flush().
+        """
+        day = datetime.fromtimestamp(attribution["timestamp"] / 1000, tz=timezone.utc).strftime("%Y-%m-%d")
+        for source in ATTRIBUTION_FIELDS:
+            pool = attribution[source]
+            row = self.__row(attribution["run_id"], source, day, pool)
+            row["block_count"] += 1
+            row["total_block_reward"] += attribution["total_block_reward"] or 0
+            row["fee_block_reward"] += attribution["fee_block_reward"] or 0
+            row["unknown_block_count"] += int(pool == UNKNOWN_POOL)
+
+        self.__pending_blocks += 1
+        if self.__pending_blocks >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending counts to the rollup index. Counts that could not be
+        written are kept for the next flush.
+
+        Returns
+        -------
+        is_stored : Boolean
+
+        """
+        if not self.__pending_rows:
+            return True
+        self.logger.info("Updating {} rollup rows with {} blocks.".format(len(self.__pending_rows), self.__pending_blocks))
+        docs = [{"_id": row_id, "_source": row} for row_id, row in self.__pending_rows.items()]
+        if not self.es_controller.bulk_increment(index_name=self.index, docs=docs, counters=self.COUNTERS):
+            self.logger.error("Failed to update the rollup rows, trying again with the next flush.")
+            return False
+        self.__pending_rows = {}
+        self.__pending_blocks = 0
+        return True
+
+    #============================================
+    # Rebuilding
+    #============================================
+
+    def rebuild(self, run_id, page_size=1000):
+        """
+        Replaces the rollup rows of a run by rows aggregated from its
+        block_attributions documents, with a composite aggregation per source.
+
+        Returns
+        -------
+        rows : int
+            Number of rollup rows written.
+
+        """
+        self.logger.info("Rebuilding the rollup rows of run [{}]".format(run_id))
+        self.es_controller.delete_by_filters(index=self.index, filters=[{"term": {"run_id": run_id}}])
+        self.__pending_rows = {}
+        self.__pending_blocks = 0
+
+        search_index = self.es_controller.get_partition_for_value(self.attribution_index, run_id) or self.attribution_index
+        total_rows = 0
+        for source in ATTRIBUTION_FIELDS:
+            composite = {
+                "size": page_size,
+                "sources": [
+                    {"day": {"date_histogram": {"field": "timestamp", "calendar_interval": "day", "format": "yyyy-MM-dd"}}},
+                    {"pool": {"terms": {"field": source}}}
+                    ]
+                }
+            while True:
+                aggregations = self.es_controller.aggregate(index=search_index, filters=[{"term": {"run_id": run_id}}], aggs={
+                    "rows": {
+                        "composite": composite,
+                        "aggs": {
+                            "total_block_reward": {"sum": {"field": "total_block_reward"}},
+                            "fee_block_reward": {"sum": {"field": "fee_block_reward"}}
+                            }
+                        }
+                    })
+                buckets = aggregations["rows"]["buckets"]
+                for bucket in buckets:
+                    row = self.__row(run_id, source, bucket["key"]["day"], bucket["key"]["pool"])
+                    row["block_count"] = bucket["doc_count"]
+                    row["total_block_reward"] = int(bucket["total_block_reward"]["value"])
+                    row["fee_block_reward"] = int(bucket["fee_block_reward"]["value"])
+                    row["unknown_block_count"] = bucket["doc_count"] if bucket["key"]["pool"] == UNKNOWN_POOL else 0
+                total_rows += len(buckets)
+                if not self.flush():
+                    raise RuntimeError("Failed to write the rebuilt rollup rows of run {}".format(run_id))
+                if "after_key" not in aggregations["rows"] or not buckets:
+                    break
+                composite["after"] = aggregations["rows"]["after_key"]
+
+        self.logger.info("Rebuilt {} rollup rows of run [{}]".format(total_rows, run_id))
+        return total_rows
+
+    #============================================
+    # Queries
+    #============================================
+
+    def pool_share_history(self, run_id, field="My_updated_attribution", interval="month", start_day=None, end_day=None, max_pools=500):
+        """
+        Blocks and share of the blocks per pool per calendar interval, read
+        from the rollup rows.
+
+        Parameters
+        ----------
+        run_id : string
+            Attribution run.
+        field : string
+            Attribution source, see ATTRIBUTION_FIELDS.
+        interval : string
+            Calendar interval of a period: day, week, month, quarter or year.
+        start_day, end_day : string, optional
+            First and last day (yyyy-MM-dd) to include.
+
+        Returns
+        -------
+        table : dict
+            Columns period, pool, blocks, share, total_block_reward, fee_block_reward, unknown_blocks.
+
+        """
+        filters = [{"term": {"run_id": run_id}}, {"term": {"source": field}}]
+        day_range = {}
+        if start_day is not None:
+            day_range["gte"] = start_day
+        if end_day is not None:
+            day_range["lte"] = end_day
+        if day_range:
+            filters.append({"range": {"day": day_range}})
+
+        sums = {counter: {"sum": {"field": counter}} for counter in self.COUNTERS}
+        aggregations = self.es_controller.aggregate(index=self.index, filters=filters, aggs={
+            "periods": {
+                "date_histogram": {"field": "day", "calendar_interval": interval, "format": "yyyy-MM-dd", "min_doc_count": 1},
+                "aggs": {
+                    "blocks": {"sum": {"field": "block_count"}},
+                    "pools": {"terms": {"field": "pool", "size": max_pools, "order": {"block_count": "desc"}}, "aggs": sums}
+                    }
+                }
+            })
+
+        rows = []
+        for period in aggregations["periods"]["buckets"]:
+            period_blocks = period["blocks"]["value"]
+            for pool in period["pools"]["buckets"]:
+                blocks = int(pool["block_count"]["value"])
+                rows.append([period["key_as_string"],
+                             pool["key"],
+                             blocks,
+                             round(blocks / period_blocks, 6) if period_blocks else 0,
+                             int(pool["total_block_reward"]["value"]),
+                             int(pool["fee_block_reward"]["value"]),
+                             int(pool["unknown_block_count"]["value"])])
+        return {"columns": ["period", "pool", "blocks", "share", "total_block_reward", "fee_block_reward", "unknown_blocks"], "rows": rows}
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+A class file for a durable, append-only spool between gathering and storage.
+
+Gathered records are appended to segment files on disk before they are
+stored. A drainer thread ships sealed segments to the storage backend in
+bulk and deletes a segment once the backend acknowledged all its records.
+Gathering therefore continues while the backend is unavailable, memory use
+is bounded by the segment size and nothing is lost if the process crashes.
+
+Layout of the spool directory:
+    <spool_dir>/<index_name>/<sequence number>.open   segment that is appended to
+    <spool_dir>/<index_name>/<sequence number>.log    sealed segment, ready to be shipped
+    <spool_dir>/writer.lock                           locked by the process appending to the spool
+    <spool_dir>/drain.lock                            locked by the process shipping segments
+    <spool_dir>/sequence                              last sequence number given to a segment
+
+Sequence numbers increase over all indices and runs, also after the drainer
+removed all segments, so sorting by sequence number gives the oldest segment.
+
+Every line of a segment is a JSON encoded record. Open segments are only
+sealed by a new spool if no writer holds writer.lock, so a drain_spool run
+does not take the segments of a running gather.
+
+@author: Mischa van Reede
+"""
+
+import os
+import json
+import time
+import fcntl
+import threading
+
+
+class RecordSpool():
+
+
+    def __init__(self, logger, storage_controller, spool_dir, segment_records=1000, sync_every=10, writer=True):
+        """
+        Parameters
+        ----------
+        logger : Logger
+        storage_controller : StorageController
+            Backend the spooled records are shipped to. Used by the drainer
+            thread, do not share it with other threads.
+        spool_dir : string
+            Directory that holds the segments.
+        segment_records : int
+            Number of records after which a segment is sealed.
+        sync_every : int
+            Number of appended records after which the segment is fsynced.
+        writer : Boolean
+            Whether records are appended to this spool. A spool directory has
+            one writer at a time, a spool that only drains can be used while
+            a writer is running.
+
+        """
+        self.logger = logger
+        self.storage_controller = storage_controller
+        self.spool_dir = spool_dir
+        self.segment_records = segment_records
+        self.sync_every = sync_every
+
+        # Open segment per index: [file object, path, record count, records since last fsync]
+        self.__open_segments = {}
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__wake = threading.Event()
+        self.__drainer = None
+        self.__sequence_number = None
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.__writer_lock = self.__try_lock("writer.lock")
+        if self.__writer_lock is None:
+            if writer:
+                raise RuntimeError("Spool directory {} is in use by another process.".format(self.spool_dir))
+            self.logger.info("Spool directory {} is being written to, only sealed segments are drained.".format(self.spool_dir))
+            return
+        # No other writer is running, open segments were left by a run that stopped
+        self.__recover()
+        if not writer:
+            self.__writer_lock.close()
+            self.__writer_lock = None
+
+    def __try_lock(self, lock_name):
+        # Exclusively locks a file in the spool directory. Returns the open lock
+        # file, closing it releases the lock. None if another process holds the lock.
+        lock_file = open(os.path.join(self.spool_dir, lock_name), mode='w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def __index_dirs(self):
+        # (index_name, directory) of every index with segments
+        return [(index_name, os.path.join(self.spool_dir, index_name)) for index_name in sorted(os.listdir(self.spool_dir))
+                if os.path.isdir(os.path.join(self.spool_dir, index_name))]
+
+    def __recover(self):
+        # Seals segments that were still open when the previous run stopped.
+        for index_name, index_dir in self.__index_dirs():
+            for file_name in os.listdir(index_dir):
+                if file_name.endswith(".open"):
+                    self.logger.info("Recovering spool segment {}/{}".format(index_name, file_name))
+                    path = os.path.join(index_dir, file_name)
+                    os.replace(path, path[:-len(".open")] + ".log")
+
+    def __segment_files(self, index_dir, extension):
+        # (sequence number, file name) of the segments in index_dir with the given extension
+        return [(int(file_name[:-len(extension)]), file_name) for file_name in os.listdir(index_dir) if file_name.endswith(extension)]
+
+    def __next_segment_path(self, index_dir):
+        # Only the writer creates segments. The last sequence number is persisted, so
+        # numbering continues after the drainer removed all segments. Existing
+        # segments are counted too, in case the sequence file is missing.
+        sequence_path = os.path.join(self.spool_dir, "sequence")
+        if self.__sequence_number is None:
+            self.__sequence_number = max((sequence_number for _, directory in self.__index_dirs()
+                                          for extension in (".open", ".log")
+                                          for sequence_number, _ in self.__segment_files(directory, extension)), default=0)
+            if os.path.exists(sequence_path):
+                with open(sequence_path, mode='r', encoding='utf-8') as file:
+                    self.__sequence_number = max(self.__sequence_number, int(file.read() or 0))
+        self.__sequence_number += 1
+        with open(sequence_path + ".tmp", mode='w', encoding='utf-8') as file:
+            file.write(str(self.__sequence_number))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(sequence_path + ".tmp", sequence_path)
+        return os.path.join(index_dir, "{:012d}.open".format(self.__sequence_number))
+
+    #============================================
+    # Writing
+    #============================================
+
+    def append(self, record, index_name):
+        """
+        Appends a record for index_name to the spool. The record is durable
+        after the next fsync, at most sync_every records later or on flush().
+        """
+        with self.__lock:
+            if index_name not in self.__open_segments:
+                index_dir = os.path.join(self.spool_dir, index_name)
+                os.makedirs(index_dir, exist_ok=True)
+                path = self.__next_segment_path(index_dir)
+                self.__open_segments[index_name] = [open(path, mode='a', encoding='utf-8'), path, 0, 0]
+
+            segment = self.__open_segments[index_name]
+            segment[0].write(json.dumps(record) + "\n")
+            segment[2] += 1
+            segment[3] += 1
+            if segment[3] >= self.sync_every:
+                self.__sync(segment)
+            if segment[2] >= self.segment_records:
+                self.__seal(index_name)
+
+    def flush(self):
+        # Fsyncs and seals all open segments, so the drainer can ship them.
+        with self.__lock:
+            for index_name in list(self.__open_segments):
+                self.__seal(index_name)
+
+    def __sync(self, segment):
+        segment[0].flush()
+        os.fsync(segment[0].fileno())
+        segment[3] = 0
+
+    def __seal(self, index_name):
+        file, path, _, _ = self.__open_segments.pop(index_name)
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        os.replace(path, path[:-len(".open")] + ".log")
+        self.__wake.set()
+
+    #============================================
+    # Draining
+    #============================================
+
+    def pending_segments(self):
+        # Returns the sealed segments as (index_name, path) tuples, oldest first.
+        segments = []
+        for index_name, index_dir in self.__index_dirs():
+            segments.extend((sequence_number, index_name, os.path.join(index_dir, file_name))
+                            for sequence_number, file_name in self.__segment_files(index_dir, ".log"))
+        return [(index_name, path) for _, index_name, path in sorted(segments)]
+
+    def drain(self):
+        """
+        Ships all sealed segments to the storage backend. A segment is deleted
+        after all its records are stored. Stops at the first segment that can
+        not be stored, it is tried again on the next call. Only one process
+        drains a spool directory at a time.
+
+        Returns
+        -------
+        drained : Boolean
+            True if no sealed segments are left.
+
+        """
+        drain_lock = self.__try_lock("drain.lock")
+        if drain_lock is None:
+            self.logger.info("Spool directory {} is being drained by another process.".format(self.spool_dir))
+            return False
+        try:
+            return self.__drain_segments()
+        finally:
+            drain_lock.close()
+
+    def __drain_segments(self):
+        for index_name, path in self.pending_segments():
+            records = []
+            with open(path, mode='r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Partially written last line of a segment that was open during a crash
+                        self.logger.warning("Skipping unreadable line in spool segment {}".format(path))
+            if records and not self.storage_controller.bulk_store(records=records, index_name=index_name):
+                self.logger.error("Failed to ship spool segment {}, trying again later.".format(path))
+                return False
+            os.remove(path)
+            self.logger.debug("Shipped {} records from spool segment {}".format(len(records), path))
+        return True
+
+    def __drain_loop(self, retry_interval):
+        while not self.__stop.is_set():
+            self.__wake.wait(timeout=retry_interval)
+            self.__wake.clear()
+            try:
+                self.drain()
+            except Exception as ex:
+                self.logger.error("An error occurred while draining the spool: {}".format(str(ex)))
+
+    def start_drainer(self, retry_interval=30):
+        # Starts the background thread that ships sealed segments.
+        self.__drainer = threading.Thread(target=self.__drain_loop, args=(retry_interval,), name="spool-drainer", daemon=True)
+        self.__drainer.start()
+        self.__wake.set()
+        self.logger.info("Spool drainer started for spool directory: {}".format(self.spool_dir))
+
+    def close(self, timeout=300):
+        """
+        Seals the open segments, stops the drainer and tries to ship what is left
+        for at most timeout seconds. Segments that could not be shipped stay on
+        disk and are shipped by the next run.
+        """
+        self.flush()
+        if self.__drainer is not None:
+            self.__stop.set()
+            self.__wake.set()
+            self.__drainer.join()
+            self.__drainer = None
+        # All segments are sealed, another run can write to the spool directory
+        if self.__writer_lock is not None:
+            self.__writer_lock.close()
+            self.__writer_lock = None
+
+        deadline = time.time() + timeout
+        while not self.drain():
+            if time.time() > deadline:
+                self.logger.warning("{} spool segments left on disk, they are shipped on the next run.".format(len(self.pending_segments())))
+                return False
+            time.sleep(10)
+        self.logger.info("Spool drained.")
+        return True
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+A class file used to store the application data in an embedded SQLite database.
+
+Every index is a table with the document as JSON and the fields used for
+lookups (block_height, block_hash, run_id) as indexed columns. Writes of many
+records are done in a single transaction.
+
+Settings in the [Storage] section of settings.conf:
+    backend = sqlite
+    sqlite_path = ../data/bmpi.sqlite
+
+@author: Mischa van Reede
+"""
+
+import os
+import json
+import uuid
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from .storage import StorageController
+from .tag_matcher import TagMatcher
+
+
+class SQLiteStorageController(StorageController):
+
+    # Document fields that are stored in their own (indexed) column
+    COLUMNS = ["block_height", "block_hash", "run_id"]
+
+
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.connection = self.__connect_sqlite()
+        # Serializes write transactions, e.g. of the spool drainer thread
+        self.__lock = threading.RLock()
+        self.__tables = set()
+
+
+    def __connect_sqlite(self):
+        """
+        Opens the SQLite database file specified in the config file, creates it if needed.
+
+        Returns
+        -------
+        connection : sqlite3.Connection
+
+        """
+        db_path = self.config.get('Storage', 'sqlite_path', fallback='../data/bmpi.sqlite')
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        connection = sqlite3.connect(db_path, check_same_thread=False)
+        # Write ahead logging allows reading while a batch is written
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        self.logger.debug("Connected to SQLite database at: {}".format(db_path))
+        return connection
+
+    def __table(self, index_name):
+        # Returns the quoted table name of an index, creates the table and its indexes on first use.
+        table = '"{}"'.format(index_name.replace('"', ''))
+        if index_name not in self.__tables:
+            with self.__lock, self.connection:
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS {} (_id TEXT PRIMARY KEY, block_height INTEGER, block_hash TEXT, run_id TEXT, source TEXT NOT NULL)".format(table))
+                for column in self.COLUMNS:
+                    self.connection.execute('CREATE INDEX IF NOT EXISTS "{index}_{column}" ON {table} ({column})'.format(
+                        index=index_name.replace('"', ''), column=column, table=table))
+            self.__tables.add(index_name)
+        return table
+
+    def __column(self, field):
+        # SQL expression for a document field.
+        if field in self.COLUMNS:
+            return field
+        return "json_extract(source, '$.{}')".format(field.replace("'", ""))
+
+    def __row(self, record):
+        return (uuid.uuid4().hex,
+                record.get("block_height"),
+                record.get("block_hash"),
+                record.get("run_id"),
+                json.dumps(record))
+
+    #============================================
+    # Indices
+    #============================================
+
+    def delete_index(self, index_name):
+        self.logger.info("Trying to delete index [{}]".format(index_name))
+        with self.__lock, self.connection:
+            self.connection.execute("DROP TABLE IF EXISTS {}".format(self.__table(index_name)))
+        self.__tables.discard(index_name)
+        self.logger.info("Index with name [{}] deleted".format(index_name))
+
+    def migrate_index(self, index_name):
+        # Tables have no mapping versions, nothing to migrate.
+        self.logger.info("Index [{}] does not need to be migrated.".format(index_name))
+        return True
+
+    def get_partition_for_value(self, index_name, value):
+        # Tables are not partitioned.
+        return None
+
+    def drop_partition(self, index_name, partition):
+        self.logger.error("The SQLite backend does not partition index [{}]".format(index_name))
+        return False
+
+    #============================================
+    # Writing
+    #============================================
+
+    def store(self, record, index_name):
+        return self.bulk_store([record], index_name)
+
+    def bulk_store(self, records, index_name):
+        self.logger.info("Storing [{}] records in index: [{}]".format(len(records), index_name))
+        try:
+            with self.__lock, self.connection:
+                self.connection.executemany("INSERT INTO {} VALUES (?, ?, ?, ?, ?)".format(self.__table(index_name)),
+                                            (self.__row(record) for record in records))
+        except sqlite3.Error as ex:
+            self.logger.error("An error occurred when storing the documents: {}".format(str(ex)))
+            return False
+        self.logger.debug("Storing records was succesful")
+        return True
+
+    def delete_doc(self, index, doc_type, doc_id):
+        self.logger.debug("Deleting doc with id {} from index {}".format(doc_id, index))
+        with self.__lock, self.connection:
+            self.connection.execute("DELETE FROM {} WHERE _id = ?".format(self.__table(index)), (doc_id,))
+        self.logger.debug("Doc deleted.")
+
+    def bulk_delete(self, docs):
+        deleted = 0
+        with self.__lock, self.connection:
+            for doc in docs:
+                deleted += self.connection.execute("DELETE FROM {} WHERE _id = ?".format(self.__table(doc["_index"])), (doc["_id"],)).rowcount
+        self.logger.debug("Deleted {} documents.".format(deleted))
+        return deleted
+
+    def remove_duplicates(self, index, field="block_height"):
+        self.logger.info("Removing documents with duplicate [{}] values from index [{}]".format(field, index))
+        table = self.__table(index)
+        column = self.__column(field)
+        with self.__lock, self.connection:
+            deleted = self.connection.execute(
+                "DELETE FROM {table} WHERE {column} IS NOT NULL AND rowid NOT IN (SELECT MIN(rowid) FROM {table} GROUP BY {column})".format(
+                    table=table, column=column)).rowcount
+        self.logger.info("Deleted {} duplicate documents from index [{}]".format(deleted, index))
+        return deleted
+
+    @contextmanager
+    def bulk_ingest(self, index_names, force_merge=False):
+        """
+        Skips fsyncs during a large write, the database file is synced and its
+        statistics updated afterwards. force_merge also rebuilds (vacuums) the file.
+        """
+        self.logger.info("Starting bulk ingest on indices {}".format(index_names))
+        self.connection.execute("PRAGMA synchronous=OFF")
+        try:
+            yield
+        finally:
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("ANALYZE")
+            if force_merge:
+                self.logger.info("Vacuuming the database.")
+                self.connection.execute("VACUUM")
+            self.logger.info("Bulk ingest done.")
+
+    #============================================
+    # Reading
+    #============================================
+
+    def __project(self, document, fields):
+        if fields is None:
+            return document
+        return {field: document[field] for field in fields if field in document}
+
+    def query_all_docs(self, index, fields=None):
+        self.logger.debug("Querying index {} to obtain all records".format(index))
+        return [hit["_source"] for hit in self.scan_docs(index=index, fields=fields)]
+
+    def query_all_docs_with_metadata(self, index, fields=None):
+        self.logger.debug("Querying index {} to obtain all records".format(index))
+        return [{"index": hit["_index"], "id": hit["_id"], "data": hit["_source"]}
+                for hit in self.scan_docs(index=index, fields=fields)]
+
+    def __iter_pages(self, table, where, parameters, order, page_size):
+        """
+        Yields pages of (_id, source) rows ordered by the order expressions.
+        Pages are fetched with a keyset (the order values and rowid of the
+        last row), so no read transaction stays open between pages and the
+        connection can write while a scan is in progress, also when other
+        processes write to the database.
+        """
+        keys = list(order) + ["rowid"]
+        last_row = None
+        while True:
+            conditions = list(where)
+            page_parameters = list(parameters)
+            if last_row is not None:
+                conditions.append("({}) > ({})".format(", ".join(keys), ", ".join("?" * len(keys))))
+                page_parameters.extend(last_row)
+            query = "SELECT {}, _id, source FROM {}{} ORDER BY {} LIMIT ?".format(
+                ", ".join(keys), table, " WHERE " + " AND ".join(conditions) if conditions else "", ", ".join(keys))
+            rows = self.connection.execute(query, page_parameters + [page_size]).fetchall()
+            if not rows:
+                break
+            yield [row[len(keys):] for row in rows]
+            last_row = rows[-1][:len(keys)]
+
+    def scan_docs(self, index, fields=None, sort=None, page_size=1000):
+        self.logger.debug("Streaming documents from index [{}]".format(index))
+        # NULL values would break the keyset comparison
+        order = ["IFNULL({}, '')".format(self.__column(field)) for field in sort or []]
+        for rows in self.__iter_pages(self.__table(index), [], [], order, page_size):
+            for doc_id, source in rows:
+                yield {"_index": index, "_id": doc_id, "_source": self.__project(json.loads(source), fields)}
+        self.logger.debug("Done streaming documents.")
+
+    def iter_blocks(self, start_height, end_height, fields=None, index="blocks_from_scrapers_updated", page_size=5000, run_id=None):
+        self.logger.debug("Streaming blocks between heights {} and {} from index [{}]".format(start_height, end_height, index))
+        where = ["block_height BETWEEN ? AND ?"]
+        parameters = [start_height, end_height]
+        if run_id is not None:
+            where.append("run_id = ?")
+            parameters.append(run_id)
+        for rows in self.__iter_pages(self.__table(index), where, parameters, ["block_height", "IFNULL(block_hash, '')"], page_size):
+            for doc_id, source in rows:
+                yield self.__project(json.loads(source), fields)
+        self.logger.debug("Done streaming blocks.")
+
+    def lookup_docs(self, index, field, values, chunk_size=500):
+        results = {value: [] for value in values}
+        unique_values = list(results)
+        table = self.__table(index)
+        column = self.__column(field)
+        self.logger.debug("Looking up {} values of field [{}] in index [{}]".format(len(unique_values), field, index))
+        for offset in range(0, len(unique_values), chunk_size):
+            chunk = unique_values[offset:offset+chunk_size]
+            query = "SELECT _id, source FROM {} WHERE {} IN ({})".format(table, column, ",".join("?" * len(chunk)))
+            for doc_id, source in self.connection.execute(query, chunk):
+                document = json.loads(source)
+                value = document.get(field)
+                if value in results:
+                    results[value].append({"_index": index, "_id": doc_id, "_source": document})
+        return results
+
+    def find_block_heights(self, coinbase_tags=(), payout_addresses=(), start_height=None, end_height=None, index="blocks_from_scrapers_updated", chunk_size=500):
+        # Tables have no index on the document fields. The coinbase messages are read
+        # in one table scan and matched with a TagMatcher, the addresses are matched
+        # per chunk of chunk_size addresses.
+        table = self.__table(index)
+        where = ["1"]
+        parameters = []
+        if start_height is not None:
+            where.append("block_height >= ?")
+            parameters.append(start_height)
+        if end_height is not None:
+            where.append("block_height <= ?")
+            parameters.append(end_height)
+
+        heights = set()
+        tag_matcher = TagMatcher(coinbase_tags)
+        if tag_matcher.tags:
+            cursor = self.connection.execute("SELECT block_height, json_extract(source, '$.coinbase_message') FROM {} WHERE {}".format(
+                table, " AND ".join(where)), parameters)
+            for rows in iter(lambda: cursor.fetchmany(10000), []):
+                heights.update(height for height, coinbase_message in rows if coinbase_message is not None and tag_matcher.match(coinbase_message))
+
+        payout_addresses = list(payout_addresses)
+        for offset in range(0, len(payout_addresses), chunk_size):
+            chunk = payout_addresses[offset:offset+chunk_size]
+            query = "SELECT DISTINCT block_height FROM {} WHERE {} AND EXISTS (SELECT 1 FROM json_each(source, '$.payout_addresses') WHERE value IN ({}))".format(
+                table, " AND ".join(where), ",".join("?" * len(chunk)))
+            heights.update(height for height, in self.connection.execute(query, parameters + chunk).fetchall())
+        return sorted(heights)
+
+    #============================================
+    # Long running operations
+    #============================================
+
+    def reindex_data(self, source_index, dest_index, create_only=False, requests_per_second=None):
+        self.logger.info("Reindexing data from index [{}] to [{}]".format(source_index, dest_index))
+        with self.__lock, self.connection:
+            self.connection.execute("INSERT {} INTO {} SELECT * FROM {}".format(
+                "OR IGNORE" if create_only else "OR REPLACE", self.__table(dest_index), self.__table(source_index)))
+        return True
+
+    def delete_by_range(self, index, start_height, end_height, field="block_height", requests_per_second=None):
+        # Deletes are fast locally, they run in the calling process instead of as a task.
+        self.logger.info("Deleting documents in index [{}] with {} between {} and {}".format(index, field, start_height, end_height))
+        with self.__lock, self.connection:
+            deleted = self.connection.execute("DELETE FROM {} WHERE {} BETWEEN ? AND ?".format(
+                self.__table(index), self.__column(field)), (start_height, end_height)).rowcount
+        return deleted
+
+    def isConnected(self):
+        try:
+            self.connection.execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            self.logger.error("There is no connection to the SQLite database.")
+            return False
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+A class file that describes the storage backends used by the application.
+
+The application stores its data in named indices (blocks_from_scrapers_updated,
+skipped_blocks, api_block_data_conflicts, block_attributions, ...). A storage
+backend implements the methods of StorageController for these indices:
+    - ElasticsearchController() [elastic.py], the default backend.
+    - SQLiteStorageController() [sqlite_storage.py], an embedded local backend
+      for offline analysis, tests and benchmarks without an Elasticsearch instance.
+
+The backend is selected with the backend variable in the [Storage] section of settings.conf.
+
+Operations that only some backends offer are declared as features (see
+StorageController.FEATURES), commands that need them check for the feature
+with require() instead of for a backend class.
+
+@author: Mischa van Reede
+"""
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+
+class UnsupportedFeatureError(NotImplementedError):
+    # Raised when a command needs a feature the configured backend does not offer.
+    pass
+
+
+class StorageController(ABC):
+    """
+    Interface of a storage backend. Documents are dicts, hits returned by the
+    lookup methods are dicts with the keys _index, _id and _source.
+    """
+
+    # Optional features of a backend:
+    #   AGGREGATIONS       aggregate(), bulk_increment() and delete_by_filters(), used by
+    #                      the pool and conflict statistics and the rollup index
+    #   ASYNC_STORAGE      storing from an asyncio event loop, see async_elastic.py
+    #   SERVER_SIDE_TASKS  submit_delete_by_range() and wait_for_task(), tasks that
+    #                      outlive the process and are tracked with get_pending_tasks()
+    #   CONCURRENT_WRITES  several processes can write at the same time
+    AGGREGATIONS = "aggregations"
+    ASYNC_STORAGE = "async_storage"
+    SERVER_SIDE_TASKS = "server_side_tasks"
+    CONCURRENT_WRITES = "concurrent_writes"
+
+    # Features offered by the backend
+    FEATURES = frozenset()
+
+    def supports(self, feature):
+        return feature in self.FEATURES
+
+    def require(self, feature, operation):
+        # Raises UnsupportedFeatureError if the backend does not offer feature, operation is named in the message.
+        if feature not in self.FEATURES:
+            raise UnsupportedFeatureError("The storage backend {} does not support {} (needed for: {}).".format(
+                type(self).__name__, feature, operation))
+
+    #============================================
+    # Indices
+    #============================================
+
+    @abstractmethod
+    def delete_index(self, index_name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def migrate_index(self, index_name):
+        # Moves the data of an index to its current mapping version.
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_partition_for_value(self, index_name, value):
+        # Name of the partition holding documents with the given height or run_id, None if there is none.
+        raise NotImplementedError
+
+    @abstractmethod
+    def drop_partition(self, index_name, partition):
+        raise NotImplementedError
+
+    #============================================
+    # Writing
+    #============================================
+
+    @abstractmethod
+    def store(self, record, index_name):
+        # Stores a single record, returns True if the record is stored.
+        raise NotImplementedError
+
+    @abstractmethod
+    def bulk_store(self, records, index_name):
+        # Stores many records in one go, returns True if the records are stored.
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_doc(self, index, doc_type, doc_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def bulk_delete(self, docs):
+        # Deletes the documents (dicts with _index and _id), returns the number of deleted documents.
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_duplicates(self, index, field="block_height"):
+        # Keeps one document per value of field, returns the number of deleted documents.
+        raise NotImplementedError
+
+    @contextmanager
+    def bulk_ingest(self, index_names, force_merge=False):
+        # Tunes the backend for a large write to the given indices, does nothing by default.
+        yield
+
+    #============================================
+    # Reading
+    #============================================
+
+    @abstractmethod
+    def query_all_docs(self, index, fields=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def query_all_docs_with_metadata(self, index, fields=None):
+        # Returns a list of dicts with the keys index, id and data (the document).
+        raise NotImplementedError
+
+    @abstractmethod
+    def scan_docs(self, index, fields=None, sort=None, page_size=1000):
+        # Yields all hits of an index page by page, optionally projected on fields and ordered by the sort fields.
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_blocks(self, start_height, end_height, fields=None, index="blocks_from_scrapers_updated", run_id=None):
+        # Yields the stored blocks with start_height <= block_height <= end_height ordered by height,
+        # optionally only the documents of an attribution run.
+        raise NotImplementedError
+
+    @abstractmethod
+    def lookup_docs(self, index, field, values, chunk_size=1000):
+        # Returns a dict that maps every value to a list of hits whose field equals the value.
+        raise NotImplementedError
+
+    def get_blocks_by_heights(self, heights, index="blocks_from_scrapers_updated"):
+        # Returns a dict that maps each height to a list of hits for stored blocks at that height.
+        return self.lookup_docs(index=index, field="block_height", values=heights)
+
+    def get_blocks_by_hashes(self, block_hashes, index="blocks_from_scrapers_updated"):
+        # Returns a dict that maps each block hash to a list of hits for stored blocks with that hash.
+        return self.lookup_docs(index=index, field="block_hash", values=block_hashes)
+
+    @abstractmethod
+    def find_block_heights(self, coinbase_tags=(), payout_addresses=(), start_height=None, end_height=None, index="blocks_from_scrapers_updated"):
+        # Returns the sorted heights of the stored blocks whose coinbase message contains
+        # one of the tags or that pay to one of the addresses.
+        raise NotImplementedError
+
+    #============================================
+    # Long running operations
+    #============================================
+
+    @abstractmethod
+    def reindex_data(self, source_index, dest_index, create_only=False, requests_per_second=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_by_range(self, index, start_height, end_height, field="block_height", requests_per_second=None):
+        # Deletes the documents with start_height <= field <= end_height, returns the number
+        # of deleted documents, None if the deletion failed.
+        raise NotImplementedError
+
+    def submit_delete_by_range(self, index, start_height, end_height, field="block_height", requests_per_second=None):
+        # Starts deleting the documents in a height range, returns a task id for wait_for_task.
+        self.require(self.SERVER_SIDE_TASKS, "Submitting a delete task")
+
+    def wait_for_task(self, task_id, poll_interval=10):
+        # Waits for a task and returns its response, None if it failed.
+        self.require(self.SERVER_SIDE_TASKS, "Tracking tasks")
+
+    def get_pending_tasks(self):
+        return {}
+
+    #============================================
+    # Aggregations
+    #============================================
+
+    def aggregate(self, index, aggs, filters=None):
+        # Runs aggregations (query DSL) on the documents matching all filters, returns the aggregations.
+        self.require(self.AGGREGATIONS, "Aggregating")
+
+    def aggregatable_field(self, index, field):
+        # Name to aggregate field by, e.g. the keyword subfield of a text field.
+        self.require(self.AGGREGATIONS, "Aggregating")
+
+    def bulk_increment(self, index_name, docs, counters):
+        # Adds the counters of the docs (dicts with _id and _source) to the stored documents, creating missing ones.
+        self.require(self.AGGREGATIONS, "Incrementing counters")
+
+    def delete_by_filters(self, index, filters):
+        # Deletes the documents matching all filter clauses (query DSL), returns the number of deleted documents.
+        self.require(self.AGGREGATIONS, "Deleting by filters")
+
+    @abstractmethod
+    def isConnected(self):
+        raise NotImplementedError
+
+
+def create_storage_controller(config, logger):
+    """
+    Creates the storage backend selected in the [Storage] section of the config
+    file. Defaults to Elasticsearch if the section is missing.
+    """
+    backend = config.get('Storage', 'backend', fallback='elasticsearch').lower()
+    logger.info("Using storage backend: {}".format(backend))
+
+    if backend == 'elasticsearch':
+        from .elastic import ElasticsearchController
+        return ElasticsearchController(config=config, logger=logger)
+    if backend == 'sqlite':
+        from .sqlite_storage import SQLiteStorageController
+        return SQLiteStorageController(config=config, logger=logger)
+
+    raise ValueError("Unknown storage backend in settings.conf: {}".format(backend))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+A class file for matching many coinbase tags against a coinbase message at once.
+
+TagMatcher compiles a list of tags into an Aho-Corasick automaton. match()
+finds every tag that occurs in a message in a single pass over the message,
+so the time per message does not depend on the number of tags. The result is
+the same as checking `tag in message` for every tag.
+
+@author: Mischa van Reede
+"""
+
+
+class TagMatcher():
+
+
+    def __init__(self, tags):
+        """
+        Parameters
+        ----------
+        tags : iterable of strings
+            Tags to match. match() returns the matching tags in this order.
+
+        """
+        self.tags = list(tags)
+
+        # State 0 is the root. Per state: transitions, failure link and the
+        # indices of the tags that end in the state or its failure states.
+        self.__goto = [{}]
+        self.__fail = [0]
+        self.__output = [[]]
+        self.__build()
+
+    def __build(self):
+        for tag_index, tag in enumerate(self.tags):
+            state = 0
+            for character in tag:
+                next_state = self.__goto[state].get(character)
+                if next_state is None:
+                    next_state = len(self.__goto)
+                    self.__goto[state][character] = next_state
+                    self.__goto.append({})
+                    self.__fail.append(0)
+                    self.__output.append([])
+                state = next_state
+            self.__output[state].append(tag_index)
+
+        # The empty tag matches every message, it is added in match() and not
+        # propagated to the other states.
+        self.__root_output = self.__output[0]
+        self.__output[0] = []
+
+        # Breadth first, so the failure state of a state is done before the state itself.
+        queue = list(self.__goto[0].values())
+        for state in queue:
+            for character, next_state in self.__goto[state].items():
+                fail_state = self.__fail[state]
+                while fail_state and character not in self.__goto[fail_state]:
+                    fail_state = self.__fail[fail_state]
+                self.__fail[next_state] = self.__goto[fail_state].get(character, 0)
+                self.__output[next_state] = self.__output[next_state] + self.__output[self.__fail[next_state]]
+                queue.append(next_state)
+
+    def state(self):
+        # The compiled automaton as lists and dicts, see from_state().
+        return {"tags": self.tags, "goto": self.__goto, "fail": self.__fail,
+                "output": self.__output, "root_output": self.__root_output}
+
+    @classmethod
+    def from_state(cls, state):
+        # Restores a matcher from state() without compiling the tags again.
+        matcher = cls.__new__(cls)
+        matcher.tags = list(state["tags"])
+        matcher.__goto = state["goto"]
+        matcher.__fail = state["fail"]
+        matcher.__output = state["output"]
+        matcher.__root_output = state["root_output"]
+        return matcher
+
+    def match(self, text):
+        """
+        Returns the tags that occur in text, in the order of the tags given to the constructor.
+        """
+        goto = self.__goto
+        fail = self.__fail
+        output = self.__output
+
+        matches = set(self.__root_output)
+        state = 0
+        for character in text:
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            if output[state]:
+                matches.update(output[state])
+        return [self.tags[tag_index] for tag_index in sorted(matches)]
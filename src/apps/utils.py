@@ -18,6 +18,9 @@ from time import time
 
 class Utils():
     
+    # pool_data.json as last read by loadPoolData, with the (modification time, size) of the file
+    pool_data_cache = {"stat": None, "data": None}
+    
 
     def getCurrentPath():
         """
@@ -81,10 +84,20 @@ class Utils():
     
         
     
+    def loadPoolData(pool_data_path='../pools/pool_data.json'):
+        """
+            Returns the contents of pool_data.json, the file is only read again
+            when it changed on disk (e.g. by addAddressToPoolData).
+        """
+        stat = os.stat(pool_data_path)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        if Utils.pool_data_cache["stat"] != stat_key:
+            with open(file=pool_data_path, mode='r', encoding='utf-8') as f:
+                Utils.pool_data_cache = {"stat": stat_key, "data": json.load(f)}
+        return Utils.pool_data_cache["data"]
+    
     def getPoolName(coinbase_message, payout_address, logger):
-        f = open(file="../pools/pool_data.json", mode='r', encoding='utf-8')
-        pool_data_json = json.load(f)
-        f.close()
+        pool_data_json = Utils.loadPoolData()
         tag_match = False
         address_match = False
         tag_match_name_list = []